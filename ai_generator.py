@@ -1,150 +1,171 @@
 import os
-import json
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import openai
 from dotenv import load_dotenv
+from llm_backends import create_backend
+from response_cache import ResponseCache, RESPONSE_CACHE_ENABLED
+from prompt_compactor import PromptCompactor, PROMPT_COMPACTION_ENABLED
+from thread_coalescer import coalesce_emails, COALESCE_ENABLED
+from rules_classifier import RulesClassifier
+from state_store import StateStore, FETCHED
+from spool_log import SegmentedSpool, read_record
+from priority_scheduler import get_priority_scheduler
 
 # Load environment variables
 load_dotenv()
-ASSISTANT_ID = os.getenv('OPENAI_ASSISTANT_ID')
+# Maximum number of model requests in flight at once, across every generate pool in the process
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '4'))
 
 class AIGenerator:
-    def __init__(self):
+    def __init__(self, max_concurrency=None, backend=None, cache=None, compactor=None, rules=None):
         """Initialize AI Generator."""
-        openai.api_key = os.getenv('OPENAI_API_KEY')
-        self.client = openai.OpenAI()
+        self.backend = backend or create_backend()
+        self.rules = rules if rules is not None else RulesClassifier.from_file()
+        self.cache = cache if cache is not None else (ResponseCache() if RESPONSE_CACHE_ENABLED else None)
+        self.compactor = compactor if compactor is not None else (PromptCompactor() if PROMPT_COMPACTION_ENABLED else None)
+        self.max_concurrency = max_concurrency or AI_MAX_CONCURRENCY
+        self.model_slots = threading.BoundedSemaphore(self.max_concurrency)
+        self.priority = get_priority_scheduler()
         self.emails_received_dir = 'Emails_Received'
         self.emails_to_send_dir = 'Emails_To_Send'
+        # When False, responses are only tracked in the state index and passed on in memory
+        self.durable = True
         os.makedirs(self.emails_to_send_dir, exist_ok=True)
+        self.spool = SegmentedSpool.for_directory(self.emails_to_send_dir, 'responses', key='email_id')
         self._load_processed_responses()
 
     def _load_processed_responses(self):
-        """Load list of already processed email IDs."""
-        self.processed_email_ids = set()
-        for file in os.listdir(self.emails_to_send_dir):
-            if file.endswith('.json'):
-                self.processed_email_ids.add(file.split('_')[-1].replace('.json', ''))
+        """Open the state index of email lifecycle states."""
+        self.state = StateStore.for_path()
+        self.state.migrate_spools(self.emails_received_dir, self.emails_to_send_dir)
 
     def get_unprocessed_emails(self):
         """Get list of emails that haven't been processed yet."""
         unprocessed_emails = []
-        for file in os.listdir(self.emails_received_dir):
-            if not file.endswith('.json'):
+        for row in self.state.in_state(FETCHED):
+            if not row['email_path']:
+                # Left over from a non-durable streaming run that stopped before generating
+                self.state.mark_failed(row['id'], "Email was never written to disk")
                 continue
-            
-            email_id = file.split('_')[-1].replace('.json', '')
-            if email_id not in self.processed_email_ids:
-                try:
-                    with open(os.path.join(self.emails_received_dir, file), 'r', encoding='utf-8') as f:
-                        email_content = json.load(f)
-                        unprocessed_emails.append(email_content)
-                except Exception as e:
-                    print(f"Error loading email from {file}: {e}")
+            try:
+                unprocessed_emails.append(read_record(row['email_path']))
+            except FileNotFoundError:
+                self.state.mark_failed(row['id'], f"Email file missing: {row['email_path']}")
+            except Exception as e:
+                print(f"Error loading email from {row['email_path']}: {e}")
         
         print(f"\nFound {len(unprocessed_emails)} unprocessed emails")
         return unprocessed_emails
 
     def generate_response(self, email_content):
-        """Generate AI response using OpenAI Assistant."""
-        try:
-            if not ASSISTANT_ID:
-                raise Exception("OPENAI_ASSISTANT_ID not found in environment variables")
-
-            # Create a thread
-            thread = self.client.beta.threads.create()
-
-            # Add message to thread
-            self.client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=
-                        f"From: {email_content['sender']}\n"
-                        f"Subject: {email_content['subject']}\n"
-                        f"Message: {email_content['body']}"
-            )
-
-            # Run the assistant
-            run = self.client.beta.threads.runs.create(
-                thread_id=thread.id,
-                assistant_id=ASSISTANT_ID
-            )
+        """Generate AI response using the configured backend."""
+        response_data = self.generate(email_content)
+        return response_data['response'] if response_data else None
 
-            # Wait for completion
-            while True:
-                run = self.client.beta.threads.runs.retrieve(
-                    thread_id=thread.id,
-                    run_id=run.id
-                )
-                if run.status == 'completed':
-                    break
-                elif run.status in ['failed', 'cancelled', 'expired']:
-                    raise Exception(f"Assistant run failed with status: {run.status}")
-                time.sleep(1)
-
-            # Get the assistant's response
-            messages = self.client.beta.threads.messages.list(thread_id=thread.id)
-            for message in messages.data:
-                if message.role == "assistant":
-                    response_content = message.content[0].text.value
-                    self.save_response(email_content, response_content)
-                    
-                    # Preview the response
-                    print("\nGenerated Response:")
-                    print("-" * 50)
-                    print(response_content)
-                    print("-" * 50)
-                    
-                    return response_content
-
-            return None
+    def generate(self, email_content):
+        """Generate and save a response, returning the saved response data."""
+        try:
+            # Known cases are answered by local rules without the model or the cache
+            classified = self.rules.classify(email_content) if self.rules else None
+            response_content = self.cache.get(email_content) if self.cache and not classified else None
+            if classified:
+                response_content = classified[1]
+            elif response_content:
+                print(f"Using cached response for email {email_content['id']}")
+            else:
+                # The model sees the compacted body; the saved records keep the original
+                prompt_email = self.compactor.compact(email_content) if self.compactor else email_content
+                with self.model_slots:
+                    response_content = self.backend.generate(prompt_email)
+                if not response_content:
+                    return None
+                if self.cache:
+                    self.cache.put(email_content, response_content)
+
+            response_data = self.save_response(email_content, response_content)
+            
+            # Preview the response
+            print("\nGenerated Response:")
+            print("-" * 50)
+            print(response_content)
+            print("-" * 50)
+            
+            return response_data
         except Exception as e:
             print(f"Error generating response: {e}")
             return None
 
+    def build_response_data(self, email_content, response_content):
+        """Build the record handed to EmailSender for a generated response."""
+        return {
+            'email_id': email_content['id'],
+            'thread_id': email_content['thread_id'],
+            'original_email': {
+                'sender': email_content['sender'],
+                'subject': email_content['subject'],
+                'body': email_content['body'],
+                'message_id': email_content.get('message_id', ''),  # Include Message-ID
+                'labels': email_content.get('labels', []),  # Lets the sender compute label changes locally
+                'internal_date': email_content.get('internal_date'),  # When it arrived, for scheduling and response times
+                'coalesced': email_content.get('coalesced', [])  # Earlier messages this reply also answers
+            },
+            'response': response_content,
+            'timestamp': datetime.now().strftime('%Y%m%d_%H%M%S')
+        }
+
     def save_response(self, email_content, response_content):
-        """Save the generated response to a file."""
+        """Append the generated response to the response spool and return its data."""
         try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_response_{email_content['id']}.json"
-            filepath = os.path.join(self.emails_to_send_dir, filename)
-
-            response_data = {
-                'email_id': email_content['id'],
-                'thread_id': email_content['thread_id'],
-                'original_email': {
-                    'sender': email_content['sender'],
-                    'subject': email_content['subject'],
-                    'body': email_content['body'],
-                    'message_id': email_content.get('message_id', '')  # Include Message-ID
-                },
-                'response': response_content,
-                'timestamp': timestamp
-            }
-
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(response_data, f, indent=2, ensure_ascii=False)
-
-            self.processed_email_ids.add(email_content['id'])
-            print(f"Saved response to {filepath}")
-            return True
+            response_data = self.build_response_data(email_content, response_content)
+            filepath = None
+            if self.durable:
+                filepath = self.spool.append(response_data)
+                print(f"Saved response to {filepath}")
+
+            response_data['path'] = filepath
+            self.state.mark_generated(email_content['id'], filepath)
+            for coalesced in email_content.get('coalesced', []):
+                self.state.mark_coalesced(coalesced['id'])
+            return response_data
         except Exception as e:
             print(f"Error saving response: {e}")
-            return False
+            return None
 
     def process_pending_emails(self):
-        """Process all pending emails and generate responses."""
+        """Process all pending emails and generate responses concurrently."""
         unprocessed_emails = self.get_unprocessed_emails()
         response_count = 0
-        
-        for email in unprocessed_emails:
-            print(f"\nProcessing email from: {email['sender']}")
-            print(f"Subject: {email['subject']}")
-            response = self.generate_response(email)
-            if response:
-                print("Successfully generated and saved response")
-                response_count += 1
-            else:
-                print("Failed to generate response")
+        if not unprocessed_emails:
+            return response_count
+        if COALESCE_ENABLED:
+            unprocessed_emails = coalesce_emails(unprocessed_emails)
+        # The executor starts work in submission order, so the most urgent emails go first
+        unprocessed_emails = self.priority.sort(unprocessed_emails)
+
+        print(f"Generating responses with {self.backend.name} backend, up to {self.max_concurrency} at a time")
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {executor.submit(self.generate_response, email): email
+                       for email in unprocessed_emails}
+            for future in as_completed(futures):
+                email = futures[future]
+                print(f"\nProcessed email from: {email['sender']}")
+                print(f"Subject: {email['subject']}")
+                if future.result():
+                    print("Successfully generated and saved response")
+                    response_count += 1
+                else:
+                    print("Failed to generate response")
+
+        if self.cache:
+            self.cache.save()
+            stats = self.cache.stats()
+            print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+        if self.rules:
+            self.rules.report()
+        if self.compactor:
+            stats = self.compactor.stats()
+            print(f"Prompt compaction: {stats['tokens_before']} -> {stats['tokens_after']} tokens "
+                  f"over {stats['emails']} emails")
         
         return response_count
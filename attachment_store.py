@@ -0,0 +1,98 @@
+import os
+import base64
+import hashlib
+import tempfile
+from rate_limiter import get_scheduler
+
+ATTACHMENTS_ENABLED = os.getenv('ATTACHMENTS_ENABLED', '1') == '1'
+ATTACHMENTS_DIR = os.getenv('ATTACHMENTS_DIR', 'Attachments')
+# Attachments larger than this are recorded but never downloaded
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', str(25 * 1024 * 1024)))
+# Base64 characters decoded per write; must be a multiple of 4
+DECODE_CHUNK_CHARS = 256 * 1024
+
+STORED = 'stored'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class AttachmentStore:
+    """Content-addressed attachment storage: each distinct file is kept once under its SHA-256."""
+
+    def __init__(self, service, root=None, max_bytes=None):
+        self.service = service
+        self.scheduler = get_scheduler()
+        self.root = root or ATTACHMENTS_DIR
+        self.max_bytes = ATTACHMENT_MAX_BYTES if max_bytes is None else max_bytes
+        self.stats = {STORED: 0, SKIPPED: 0, FAILED: 0, 'duplicates': 0}
+
+    def path_for(self, digest):
+        """Return the storage path for a content hash."""
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _write_encoded(self, data):
+        """Decode base64url data to a temp file chunk by chunk; returns (temp path, digest, size)."""
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for start in range(0, len(data), DECODE_CHUNK_CHARS):
+                    chunk = data[start:start + DECODE_CHUNK_CHARS]
+                    chunk += '=' * (-len(chunk) % 4)
+                    decoded = base64.urlsafe_b64decode(chunk)
+                    digest.update(decoded)
+                    size += len(decoded)
+                    f.write(decoded)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest(), size
+
+    def _store_encoded(self, data):
+        """Store base64url data under its content hash and return (digest, path, size)."""
+        tmp_path, digest, size = self._write_encoded(data)
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            self.stats['duplicates'] += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return digest, path, size
+
+    def download(self, message_id, attachment):
+        """Download one attachment descriptor and return its metadata record.
+
+        Attachments over the size limit are skipped; their record keeps the
+        attachment ID, so they can still be fetched from Gmail by hand.
+        """
+        record = {key: attachment.get(key) for key in ('filename', 'mime_type', 'size', 'attachment_id')}
+        size = attachment.get('size') or 0
+        if size > self.max_bytes:
+            record['status'] = SKIPPED
+        else:
+            try:
+                data = attachment.get('data')
+                if not data:
+                    response = self.scheduler.execute(self.service.users().messages().attachments().get(
+                        userId='me',
+                        messageId=message_id,
+                        id=attachment['attachment_id']
+                    ))
+                    data = response.get('data', '')
+                digest, path, stored_size = self._store_encoded(data)
+                record.update(status=STORED, sha256=digest, path=path, size=stored_size)
+            except Exception as e:
+                print(f"Error downloading attachment {attachment.get('filename')} of message {message_id}: {e}")
+                record.update(status=FAILED, error=str(e))
+        self.stats[record['status']] += 1
+        return record
+
+    def store_all(self, email_content):
+        """Replace an email's attachment descriptors with download records."""
+        attachments = email_content.get('attachments') or []
+        email_content['attachments'] = [self.download(email_content['id'], attachment)
+                                        for attachment in attachments]
+        return email_content['attachments']
@@ -0,0 +1,99 @@
+"""Measure cold-start time of each entry point.
+
+Every sample runs in a fresh interpreter, so nothing is shared between
+samples except the OS file cache. Run with `python bench_startup.py`.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+ENTRY_POINTS = [
+    'run_pipeline',
+    'auto_email_responder',
+    'email_handler',
+    'ai_generator',
+    'email_sender',
+    'pipeline_daemon',
+]
+
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+error = None
+try:
+    import {module}
+except Exception as e:
+    error = f"{{type(e).__name__}}: {{e}}"
+elapsed = time.perf_counter() - start
+heavy = [name for name in ('openai', 'googleapiclient', 'google_auth_oauthlib') if name in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'error': error, 'heavy_modules': heavy}}))
+"""
+
+SERVICE_PROBE = """
+import time, json
+import httplib2
+import gmail_service
+# The first build includes importing googleapiclient
+start = time.perf_counter()
+document = gmail_service.get_discovery_document()
+from googleapiclient.discovery import build_from_document
+build_from_document(document, http=httplib2.Http())
+first = time.perf_counter() - start
+start = time.perf_counter()
+build_from_document(gmail_service.get_discovery_document(), http=httplib2.Http())
+print(json.dumps({'seconds': first, 'rebuild_seconds': time.perf_counter() - start, 'error': None}))
+"""
+
+
+def run_probe(code, cwd):
+    """Run a probe in a fresh interpreter and return its JSON result and wall time."""
+    completed = subprocess.run([sys.executable, '-c', code], cwd=cwd, capture_output=True, text=True)
+    if completed.returncode != 0 or not completed.stdout.strip():
+        return {'seconds': None, 'error': completed.stderr.strip().splitlines()[-1:] or 'no output'}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    seconds = [sample['seconds'] for sample in samples if sample.get('seconds') is not None]
+    if not seconds:
+        return None
+    return {'median_ms': statistics.median(seconds) * 1000, 'min_ms': min(seconds) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="samples per entry point")
+    parser.add_argument('--output', help="also write results as JSON to this file")
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in ENTRY_POINTS:
+        samples = [run_probe(IMPORT_PROBE.format(module=module), cwd) for _ in range(args.repeat)]
+        results[module] = dict(summarize(samples) or {}, error=samples[-1].get('error'),
+                               heavy_modules=samples[-1].get('heavy_modules', []))
+    samples = [run_probe(SERVICE_PROBE, cwd) for _ in range(args.repeat)]
+    results['gmail_service.build'] = dict(summarize(samples) or {}, error=samples[-1].get('error'))
+
+    print(f"{'entry point':<24} {'median ms':>10} {'min ms':>10}  notes")
+    for name, result in results.items():
+        median = f"{result['median_ms']:.1f}" if 'median_ms' in result else '-'
+        minimum = f"{result['min_ms']:.1f}" if 'min_ms' in result else '-'
+        notes = []
+        if result.get('heavy_modules'):
+            notes.append(f"eagerly imports {', '.join(result['heavy_modules'])}")
+        if result.get('error'):
+            notes.append(str(result['error']))
+        notes = '; '.join(notes)
+        print(f"{name:<24} {median:>10} {minimum:>10}  {notes}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,166 @@
 import os
+import json
+import gzip
+import time
 import shutil
 from datetime import datetime
+from state_store import StateStore, SENT, FAILED, IN_FLIGHT_STATES
+from spool_log import compact_pipeline_spools
+
+# Records are kept this many days after they were sent or failed
+CLEANUP_MAX_AGE_DAYS = float(os.getenv('CLEANUP_MAX_AGE_DAYS', '0'))
+# Only emails in these states are ever removed
+CLEANUP_STATES = {state.strip() for state in os.getenv('CLEANUP_STATES', f'{SENT},{FAILED}').split(',') if state.strip()}
+# Once the spool directories exceed this size, removable records are dropped regardless of age; 0 disables
+CLEANUP_MAX_TOTAL_MB = float(os.getenv('CLEANUP_MAX_TOTAL_MB', '0'))
+# Directory for gzip archives of removed records; empty disables archiving
+CLEANUP_ARCHIVE_DIR = os.getenv('CLEANUP_ARCHIVE_DIR', '')
+CLEANUP_ARCHIVE_MAX_FILES = int(os.getenv('CLEANUP_ARCHIVE_MAX_FILES', '30'))
+CLEANUP_BATCH_SIZE = int(os.getenv('CLEANUP_BATCH_SIZE', '500'))
+# The spool segment being written is only compacted after this many seconds without writes
+CLEANUP_SEAL_IDLE_SECONDS = float(os.getenv('CLEANUP_SEAL_IDLE_SECONDS', '0'))
+
 
 class CleanupUtil:
+    def __init__(self, max_age_days=None, states=None, max_total_mb=None, archive_dir=None, state=None,
+                 seal_idle=None):
+        """Initialize the cleanup engine with a retention policy.
+
+        `seal_idle` should cover the time between a spool append and its
+        state update when other threads may be writing during cleanup.
+        """
+        self.max_age = (CLEANUP_MAX_AGE_DAYS if max_age_days is None else max_age_days) * 86400
+        # In-flight work is never removable, whatever the configuration says
+        self.states = set(states or CLEANUP_STATES) - IN_FLIGHT_STATES
+        self.max_total_bytes = (CLEANUP_MAX_TOTAL_MB if max_total_mb is None else max_total_mb) * 1024 * 1024
+        self.archive_dir = CLEANUP_ARCHIVE_DIR if archive_dir is None else archive_dir
+        self.state = state or StateStore.for_path()
+        self.seal_idle = CLEANUP_SEAL_IDLE_SECONDS if seal_idle is None else seal_idle
+
+    def is_removable(self, row, ignore_age=False):
+        """Check whether an email's records may be removed under the retention policy."""
+        if row is None or row['state'] not in self.states:
+            return False
+        return ignore_age or row['updated_at'] <= time.time() - self.max_age
+
+    def _archive(self, records):
+        """Append removed records to today's gzip archive and drop the oldest archives."""
+        if not self.archive_dir or not records:
+            return
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"archive-{datetime.now().strftime('%Y%m%d')}.jsonl.gz")
+        # Each append adds a gzip member; readers see one continuous stream
+        with gzip.open(path, 'at', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        with os.scandir(self.archive_dir) as it:
+            archives = sorted(entry.path for entry in it
+                              if entry.name.startswith('archive-') and entry.name.endswith('.jsonl.gz'))
+        for old_path in archives[:-CLEANUP_ARCHIVE_MAX_FILES]:
+            os.remove(old_path)
+
+    def _total_size(self, directories):
+        """Return the bytes used by the directories, including their subdirectories."""
+        total = 0
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file():
+                        total += entry.stat().st_size
+                    elif entry.is_dir():
+                        total += self._total_size([entry.path])
+        return total
+
+    def _scan_legacy_files(self, directories):
+        """Yield (email_id, path, size, mtime) for per-email JSON files, oldest first."""
+        entries = []
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith('.json'):
+                        stat = entry.stat()
+                        email_id = entry.name.split('_')[-1].replace('.json', '')
+                        entries.append((stat.st_mtime, email_id, entry.path, stat.st_size))
+        for mtime, email_id, path, size in sorted(entries):
+            yield email_id, path, size, mtime
+
+    def _delete_batch(self, paths):
+        """Archive and delete a batch of per-email JSON files."""
+        if self.archive_dir:
+            records = []
+            for path in paths:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        records.append(json.load(f))
+                except Exception as e:
+                    print(f"Error reading {path} for the archive: {e}")
+            self._archive(records)
+        deleted = 0
+        for path in paths:
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    def _cleanup_legacy_files(self, directories, ignore_age=False, bytes_to_free=None):
+        """Delete removable per-email JSON files in batches, stopping once bytes_to_free are freed."""
+        deleted = freed = 0
+        batch = []
+        for email_id, path, size, mtime in self._scan_legacy_files(directories):
+            if bytes_to_free is not None and freed >= bytes_to_free:
+                break
+            if self.is_removable(self.state.get(email_id), ignore_age):
+                batch.append(path)
+                freed += size
+            if len(batch) >= CLEANUP_BATCH_SIZE:
+                deleted += self._delete_batch(batch)
+                batch = []
+        if batch:
+            deleted += self._delete_batch(batch)
+        return deleted
+
     def cleanup_processed_files(self, emails_received_dir, emails_sent_dir):
-        """Delete processed emails and their responses."""
+        """Remove records of processed emails according to the retention policy.
+
+        Emails that are still waiting for a response or to be sent are kept.
+        """
         try:
-            # Delete processed emails
-            for file in os.listdir(emails_received_dir):
-                if file.endswith('.json'):
-                    file_path = os.path.join(emails_received_dir, file)
-                    os.remove(file_path)
-                    print(f"Deleted processed email: {file}")
-
-            # Delete sent responses and pending responses
-            # First delete files in the root of emails_sent_dir
-            for file in os.listdir(emails_sent_dir):
-                if file.endswith('.json'):
-                    file_path = os.path.join(emails_sent_dir, file)
-                    os.remove(file_path)
-                    print(f"Deleted pending response: {file}")
-
-            # Then delete files in the Sent subdirectory
-            sent_dir = os.path.join(emails_sent_dir, 'Sent')
-            if os.path.exists(sent_dir):
-                for file in os.listdir(sent_dir):
-                    if file.endswith('.json'):
-                        file_path = os.path.join(sent_dir, file)
-                        os.remove(file_path)
-                        print(f"Deleted sent response: {file}")
-
-            print("Successfully cleaned up processed files")
+            directories = [emails_received_dir, emails_sent_dir, os.path.join(emails_sent_dir, 'Sent')]
+            # The Sent folder is counted as part of emails_sent_dir
+            measured = [emails_received_dir, emails_sent_dir]
+            # Age and state first
+            deleted = self._cleanup_legacy_files(directories)
+            removed, dropped = compact_pipeline_spools(
+                emails_received_dir, emails_sent_dir, self.state,
+                is_expired=self.is_removable, on_drop=self._archive, seal_idle=self.seal_idle
+            )
+
+            # Then, if still over the size limit, anything removable, oldest first
+            if self.max_total_bytes:
+                def under_limit():
+                    return self._total_size(measured) <= self.max_total_bytes
+
+                excess = self._total_size(measured) - self.max_total_bytes
+                if excess > 0:
+                    deleted += self._cleanup_legacy_files(directories, ignore_age=True, bytes_to_free=excess)
+                    size_removed, size_dropped = compact_pipeline_spools(
+                        emails_received_dir, emails_sent_dir, self.state,
+                        is_expired=lambda row: self.is_removable(row, ignore_age=True),
+                        on_drop=self._archive, should_stop=under_limit, dead_ratio=0, seal_idle=self.seal_idle
+                    )
+                    removed += size_removed
+                    dropped += size_dropped
+                    if not under_limit():
+                        print("Spool directories are still over CLEANUP_MAX_TOTAL_MB; the remaining records "
+                              "are in flight, in a state outside CLEANUP_STATES, or were written too recently")
+
+            print(f"Cleanup removed {deleted} files and {dropped} spooled records in {removed} segments")
             return True
         except Exception as e:
             print(f"Error cleaning up files: {e}")
@@ -1,35 +1,104 @@
 import os
 import base64
 import json
-import glob
 from email.mime.text import MIMEText
 from gmail_service import get_gmail_service
-from datetime import datetime
+from gmail_batch import BatchFetcher, batch_modify, is_permanent_failure
+from rate_limiter import get_scheduler, http_status_of
+from mailbox_sync import MailboxSync
+from label_cache import LabelRegistry
+from state_store import StateStore
+from spool_log import SegmentedSpool
+from attachment_store import AttachmentStore, ATTACHMENTS_ENABLED
+from mime_parser import extract_body, iter_attachments, get_header, FULL_MESSAGE_FIELDS
+from priority_scheduler import get_priority_scheduler
+
+# Gmail labels whose unread emails are answered
+GMAIL_LABELS = [name.strip() for name in os.getenv('GMAIL_LABELS', 'Beginner,Transfers').split(',') if name.strip()]
+# Runs that retry marking an email as read before giving up on it
+MARK_READ_MAX_ATTEMPTS = int(os.getenv('MARK_READ_MAX_ATTEMPTS', '5'))
 
 class EmailHandler:
-    def __init__(self):
-        self.service = get_gmail_service()
+    def __init__(self, service=None):
+        self.service = service or get_gmail_service()
+        self.scheduler = get_scheduler()
+        self.fetcher = BatchFetcher(self.service)
+        self.sync = MailboxSync(self.service)
+        self.labels = LabelRegistry.for_service(self.service)
+        self.attachments = AttachmentStore(self.service) if ATTACHMENTS_ENABLED else None
+        self.priority = get_priority_scheduler()
         self.emails_dir = 'Emails_Received'
+        # When False, emails are only tracked in the state index and passed on in memory
+        self.durable = True
         os.makedirs(self.emails_dir, exist_ok=True)
+        self.spool = SegmentedSpool.for_directory(self.emails_dir, 'emails')
+        self.mark_read_failed_path = os.path.join('State', 'mark_read_failed.json')
+        self.pending_mark_read = []
         self._load_processed_emails()
+        self._load_mark_read_failures()
 
     def _load_processed_emails(self):
-        """Load list of already processed email IDs."""
-        self.processed_email_ids = set()
-        for file_path in glob.glob(os.path.join(self.emails_dir, '*.json')):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    email_data = json.load(f)
-                    if 'id' in email_data:
-                        self.processed_email_ids.add(email_data['id'])
-            except Exception as e:
-                print(f"Error loading processed email from {file_path}: {e}")
+        """Open the state index of already processed emails."""
+        self.state = StateStore.for_path()
+        self.state.migrate_spools(self.emails_dir)
+
+    def is_processed(self, email_id):
+        """Check whether an email has already been saved."""
+        return self.state.has(email_id)
+
+    def _load_mark_read_failures(self):
+        """Load IDs whose mark-as-read never landed, with their attempt counts, so this run retries them."""
+        self.mark_read_failures = {}
+        if not os.path.exists(self.mark_read_failed_path):
+            return
+        try:
+            with open(self.mark_read_failed_path, 'r', encoding='utf-8') as f:
+                failures = json.load(f)
+            # Older runs saved a plain list of IDs
+            self.mark_read_failures = dict.fromkeys(failures, 1) if isinstance(failures, list) else failures
+        except Exception as e:
+            print(f"Error loading mark-read failures: {e}")
+
+    def mark_as_read(self, message_id):
+        """Queue a message to be marked as read by the next flush."""
+        self.pending_mark_read.append(message_id)
+
+    def flush_mark_as_read(self):
+        """Mark queued messages as read with batchModify, recording any that failed."""
+        attempts = dict(self.mark_read_failures)
+        for message_id in self.pending_mark_read:
+            attempts.setdefault(message_id, 0)
+        self.pending_mark_read = []
+        if not attempts:
+            return 0
+
+        failed = batch_modify(self.service, list(attempts), remove_label_ids=['UNREAD'])
+        marked = len(attempts) - len(failed)
+        print(f"Marked {marked} emails as read")
+
+        failures = {}
+        for message_id, error in failed.items():
+            if is_permanent_failure(error):
+                print(f"Not retrying mark-as-read of {message_id}: {error}")
+            elif attempts[message_id] + 1 >= MARK_READ_MAX_ATTEMPTS:
+                print(f"Giving up marking {message_id} as read after {MARK_READ_MAX_ATTEMPTS} attempts")
+            else:
+                failures[message_id] = attempts[message_id] + 1
+        self.mark_read_failures = failures
+        try:
+            os.makedirs(os.path.dirname(self.mark_read_failed_path), exist_ok=True)
+            with open(self.mark_read_failed_path, 'w', encoding='utf-8') as f:
+                json.dump(failures, f, indent=2)
+            if failures:
+                print(f"Recorded {len(failures)} emails that could not be marked as read")
+        except Exception as e:
+            print(f"Error recording mark-read failures: {e}")
+        return marked
 
     def get_label_ids(self, label_names):
         """Get Gmail label IDs for given label names."""
         try:
-            results = self.service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
+            labels = self.labels.get_all()
             
             label_ids = []
             label_map = {}  # For debugging
@@ -53,116 +122,111 @@ class EmailHandler:
             print(f"Error fetching labels: {e}")
             return []
 
-    def get_unread_emails_by_labels(self, label_names=['Beginner', 'Transfers'], unread_only=True):
-        """Retrieve emails with specific labels."""
+    def get_unread_emails_by_labels(self, label_names=None, unread_only=True):
+        """Retrieve emails with specific labels using a full paginated scan."""
         try:
-            label_ids = self.get_label_ids(label_names)
+            label_ids = self.get_label_ids(label_names or GMAIL_LABELS)
             print(f"\nSearching for emails with label IDs: {label_ids}")
             
             if not label_ids:
                 print("No valid label IDs found.")
                 return []
 
-            # Build the query
-            query = 'is:unread' if unread_only else ''
-            print(f"Using query: {query}")
-            
-            all_messages = []
-            # Search for each label separately and combine results
-            for label_id in label_ids:
-                results = self.service.users().messages().list(
-                    userId='me',
-                    labelIds=[label_id, 'UNREAD'] if unread_only else [label_id],  # Only get unread messages
-                    q=query
-                ).execute()
-                messages = results.get('messages', [])
-                print(f"\nFound {len(messages)} emails with label ID: {label_id}")
-                
-                # Get full message details including thread ID
-                for msg in messages:
-                    full_msg = self.service.users().messages().get(
-                        userId='me',
-                        id=msg['id']
-                    ).execute()
-                    msg['threadId'] = full_msg['threadId']
-                
-                all_messages.extend(messages)
-
-            # Remove duplicates based on message ID
-            unique_messages = {msg['id']: msg for msg in all_messages}.values()
+            # The list response already carries threadId for each message
+            unique_messages = list(self.sync.iter_full(label_ids, unread_only))
             print(f"\nTotal found {len(unique_messages)} unique matching emails")
-            return list(unique_messages)
+            return unique_messages
         except Exception as e:
             print(f"Error fetching emails: {e}")
             return []
 
+    def iter_unread_emails(self, label_names=None, unread_only=True):
+        """Yield new emails with specific labels, returning the history ID to advance to once they are saved."""
+        # Labels with the tightest response-time targets are listed first
+        label_ids = self.get_label_ids(self.priority.order_labels(label_names or GMAIL_LABELS))
+        print(f"\nSearching for emails with label IDs: {label_ids}")
+        if not label_ids:
+            print("No valid label IDs found.")
+            return
+        return (yield from self.sync.iter_messages(label_ids, unread_only))
+
     def get_email_content(self, msg_id, thread_id=None):
         """Retrieve full email content."""
         try:
-            message = self.service.users().messages().get(
+            message = self.scheduler.execute(self.service.users().messages().get(
                 userId='me', 
                 id=msg_id, 
-                format='full'
-            ).execute()
-            
-            # Extract email body
+                format='full',
+                fields=FULL_MESSAGE_FIELDS
+            ))
+            return self.parse_message(message, thread_id)
+        except Exception as e:
+            print(f"Error getting email content: {e}")
+            return None
+
+    def get_email_contents(self, messages):
+        """Retrieve email content for listed messages using batched requests."""
+        thread_ids = {msg['id']: msg.get('threadId') for msg in messages}
+        for msg_id, message in self.fetcher.iter_messages(list(thread_ids), format='full',
+                                                          fields=FULL_MESSAGE_FIELDS):
+            email_content = self.parse_message(message, thread_ids.get(msg_id))
+            if email_content:
+                yield email_content
+
+    def parse_message(self, message, thread_id=None):
+        """Extract email content from a full-format Gmail message."""
+        try:
             payload = message.get('payload', {})
             headers = payload.get('headers', [])
-            parts = payload.get('parts', [])
-            
-            # Get body content
-            if parts:
-                body = parts[0].get('body', {}).get('data', '')
-            else:
-                body = payload.get('body', {}).get('data', '')
-            
-            # Decode base64 encoded body
-            if body:
-                body = base64.urlsafe_b64decode(body.encode('ASCII')).decode('utf-8')
+            body = extract_body(payload)
             
             # Extract email metadata
-            sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-            subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
-            date = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
-            message_id = next((h['value'] for h in headers if h['name'].lower() == 'message-id'), '')
+            sender = get_header(headers, 'From')
+            subject = get_header(headers, 'Subject')
+            date = get_header(headers, 'Date')
+            message_id = get_header(headers, 'Message-ID')
             
             return {
-                'id': msg_id,
+                'id': message['id'],
                 'thread_id': thread_id or message['threadId'],  # Use provided thread ID or get from message
                 'message_id': message_id,  # Add Message-ID
                 'body': body,
                 'sender': sender,
                 'subject': subject,
                 'date': date,
-                'labels': message.get('labelIds', [])
+                'internal_date': int(message.get('internalDate', 0)),
+                'labels': message.get('labelIds', []),
+                'attachments': list(iter_attachments(payload))
             }
         except Exception as e:
-            print(f"Error getting email content: {e}")
+            print(f"Error parsing email content: {e}")
             return None
 
     def save_email_to_file(self, email_content):
-        """Save email content to a file in the Emails_Received directory."""
+        """Append email content to the spool in the Emails_Received directory."""
         try:
             if not email_content:
                 return False
 
             # Check if email has already been processed
-            if email_content['id'] in self.processed_email_ids:
+            if self.is_processed(email_content['id']):
                 print(f"Email {email_content['id']} has already been processed, skipping...")
                 return False
 
-            # Create a filename using timestamp and email ID
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_{email_content['id']}.json"
-            filepath = os.path.join(self.emails_dir, filename)
+            # Download attachments and record their metadata in place of the descriptors
+            if self.attachments:
+                self.attachments.store_all(email_content)
+            else:
+                for attachment in email_content.get('attachments', []):
+                    attachment.pop('data', None)
 
-            # Save email content to JSON file
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(email_content, f, indent=2, ensure_ascii=False)
+            filepath = None
+            if self.durable:
+                filepath = self.spool.append(email_content)
+                print(f"Saved new email {email_content['id']} to {filepath}")
 
-            # Add to processed emails set
-            self.processed_email_ids.add(email_content['id'])
-            print(f"Saved new email to {filepath}")
+            # Record the email in the state index
+            self.state.mark_fetched(email_content['id'], email_content['thread_id'], filepath)
             return True
         except Exception as e:
             print(f"Error saving email: {e}")
@@ -171,29 +235,64 @@ class EmailHandler:
     def process_unread_emails(self):
         """Process all unread emails with specified labels."""
         try:
-            processed_emails = []
-            messages = self.get_unread_emails_by_labels()
-            
-            for message in messages:
-                email_content = self.get_email_content(message['id'], message.get('threadId'))
-                if email_content and self.save_email_to_file(email_content):
-                    # Mark the email as read after processing
-                    try:
-                        self.service.users().messages().modify(
-                            userId='me',
-                            id=message['id'],
-                            body={'removeLabelIds': ['UNREAD']}
-                        ).execute()
-                        print(f"Marked email {message['id']} as read")
-                    except Exception as e:
-                        print(f"Error marking email as read: {e}")
-                    
-                    processed_emails.append(email_content)
-            
-            return processed_emails
+            return list(self.iter_new_emails())
         except Exception as e:
             print(f"Error processing emails: {e}")
             return []
+        finally:
+            # Saved emails are marked read even if a later batch failed
+            self.flush_mark_as_read()
+
+    def iter_new_emails(self):
+        """Fetch and save new emails batch by batch, yielding each one once saved."""
+        for batch in self.iter_new_email_batches():
+            yield from batch
+
+    def iter_new_email_batches(self):
+        """Fetch and save new emails, yielding the saved emails of each fetch batch as a list."""
+        listing = self.iter_unread_emails()
+        finished = False
+        while not finished:
+            chunk, new_history_id, finished = self._take_new(listing, self.fetcher.batch_size)
+            if chunk:
+                print(f"Fetching batch of {len(chunk)} new emails")
+                yield list(self._process_chunk(chunk))
+
+        # Advance only after the last batch is saved, so a crash before then lists the same messages again
+        self.sync.advance(new_history_id)
+
+    def _take_new(self, listing, count):
+        """Take up to `count` messages not yet saved from a listing.
+
+        Returns (messages, history ID, finished); the history ID is only
+        known once the listing is exhausted.
+        """
+        chunk = []
+        while len(chunk) < count:
+            try:
+                message = next(listing)
+            except StopIteration as done:
+                return chunk, done.value, True
+            # Only fetch messages we have not already saved
+            if not self.is_processed(message['id']):
+                chunk.append(message)
+        return chunk, None, False
+
+    def _process_chunk(self, messages):
+        """Fetch, save and queue mark-read for one batch of listed messages."""
+        fetched_ids = set()
+        for email_content in self.get_email_contents(messages):
+            fetched_ids.add(email_content['id'])
+            if self.save_email_to_file(email_content):
+                # Mark the email as read once the whole run has been saved
+                self.mark_as_read(email_content['id'])
+                yield email_content
+
+        # Retry messages that failed to fetch on the next sync, unless they are gone
+        for message in messages:
+            error = self.fetcher.failed.get(message['id'])
+            if message['id'] not in fetched_ids and http_status_of(error) != 404:
+                self.sync.defer(message)
 
     def send_email(self, to, subject, body):
         """Send an email via Gmail API."""
@@ -203,10 +302,10 @@ class EmailHandler:
             message['subject'] = f"Re: {subject}"
             raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
 
-            self.service.users().messages().send(
+            self.scheduler.execute(self.service.users().messages().send(
                 userId='me', 
                 body={'raw': raw_message}
-            ).execute()
+            ))
             print(f"Email sent to {to}")
             return True
         except Exception as e:
@@ -1,121 +1,210 @@
 import os
 import json
 import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
-from gmail_service import get_gmail_service
+from email.utils import make_msgid
+from gmail_service import get_gmail_service, get_shared_gmail_service
+from label_cache import LabelRegistry
+from gmail_batch import batch_modify, is_permanent_failure
+from rate_limiter import get_scheduler
+from state_store import StateStore, GENERATED
+from spool_log import read_record, is_spool_ref
+from priority_scheduler import get_priority_scheduler
 import re
 
+# 'batch' groups label changes into batchModify calls at the end of a send run,
+# 'immediate' sends one modify per message as soon as its response is processed
+LABEL_MODIFY_MODE = os.getenv('LABEL_MODIFY_MODE', 'batch')
+
+# System labels that label commands never remove
+KEEP_SYSTEM_LABELS = {'INBOX'}
+# A response that is only a label command, e.g. from a local rule
+LABEL_ONLY_RE = re.compile(r'^\$([^$]+)\$\s*$')
+# Number of responses sent at once
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '4'))
+# Domain of the Message-ID given to each reply; the ID is how a resumed run finds replies already sent
+MESSAGE_ID_DOMAIN = os.getenv('MESSAGE_ID_DOMAIN', 'automail.local')
+# Flushes a queued label change is tried in before it is dropped
+LABEL_CHANGE_MAX_ATTEMPTS = int(os.getenv('LABEL_CHANGE_MAX_ATTEMPTS', '5'))
+
 class EmailSender:
-    def __init__(self):
-        """Initialize EmailSender."""
-        self.service = get_gmail_service()
+    def __init__(self, service=None, service_factory=None, send_concurrency=None):
+        """Initialize EmailSender.
+
+        Gmail services are not thread-safe, so send workers get their own
+        from service_factory(name). Without a factory, for example when a
+        service is passed in, responses are sent one at a time.
+        """
+        if service_factory is None and service is None:
+            service_factory = get_shared_gmail_service
+        self.service = service or get_gmail_service()
+        self.service_factory = service_factory
+        self.thread_services = threading.local()
+        self.scheduler = get_scheduler()
+        self.priority = get_priority_scheduler()
+        self.label_modify_mode = LABEL_MODIFY_MODE
+        self.label_changes_path = os.path.join('State', 'label_changes.json')
+        self.label_lock = threading.Lock()
+        self._load_label_changes()
+        self.send_concurrency = (send_concurrency or SEND_CONCURRENCY) if service_factory else 1
         self.emails_to_send_dir = 'Emails_To_Send'
         self.sent_dir = os.path.join(self.emails_to_send_dir, 'Sent')
         os.makedirs(self.sent_dir, exist_ok=True)
+        self.state = StateStore.for_path()
+        self.state.migrate_spools(emails_to_send_dir=self.emails_to_send_dir)
+
+    @property
+    def labels(self):
+        """The shared label registry, making its Gmail calls through the calling thread's service."""
+        return LabelRegistry.for_service(self.thread_service())
+
+    def thread_service(self):
+        """Return the Gmail service the calling thread may use."""
+        if self.service_factory is None or threading.current_thread() is threading.main_thread():
+            return self.service
+        service = getattr(self.thread_services, 'service', None)
+        if service is None:
+            service = self.service_factory(threading.current_thread().name)
+            self.thread_services.service = service
+        return service
 
     def get_or_create_label(self, label_name):
         """Get label ID by name or create if it doesn't exist."""
         try:
-            results = self.service.users().labels().list(userId='me').execute()
-            labels = results.get('labels', [])
-            
-            # Check if label exists
-            for label in labels:
-                if label['name'] == label_name:
-                    return label['id']
-            
-            # Create new label if it doesn't exist
-            label_object = {
-                'name': label_name,
-                'labelListVisibility': 'labelShow',
-                'messageListVisibility': 'show'
-            }
-            created_label = self.service.users().labels().create(
-                userId='me',
-                body=label_object
-            ).execute()
-            return created_label['id']
-            
+            return self.labels.get_or_create(label_name)
         except Exception as e:
             print(f"Error getting/creating label: {e}")
             return None
 
-    def apply_label_to_message(self, message_id, label_name):
-        """Apply a label to a message."""
+    def get_all_labels(self):
+        """Get all Gmail labels."""
         try:
-            # Get or create label
-            label_id = self.get_or_create_label(label_name)
-            if not label_id:
-                return False
-            
-            # Modify the message to add the label
-            self.service.users().messages().modify(
+            return self.labels.get_all()
+        except Exception as e:
+            print(f"Error getting labels: {e}")
+            return []
+
+    def get_message_labels(self, message_id):
+        """Fetch the current label IDs of a message."""
+        try:
+            message = self.scheduler.execute(self.thread_service().users().messages().get(
                 userId='me',
                 id=message_id,
-                body={'addLabelIds': [label_id]}
-            ).execute()
-            print(f"Applied label '{label_name}' to message {message_id}")
-            return True
+                format='minimal'
+            ))
+            return message.get('labelIds', [])
         except Exception as e:
-            print(f"Error applying label: {e}")
-            return False
+            print(f"Error getting labels for message {message_id}: {e}")
+            return []
 
-    def get_all_labels(self):
-        """Get all Gmail labels."""
+    def _load_label_changes(self):
+        """Load label changes queued or failed in an earlier run, with their attempt counts."""
+        self.pending_label_changes = {}
+        if not os.path.exists(self.label_changes_path):
+            return
         try:
-            results = self.service.users().labels().list(userId='me').execute()
-            return results.get('labels', [])
+            with open(self.label_changes_path, 'r', encoding='utf-8') as f:
+                for change in json.load(f):
+                    key = (change['label_id'], frozenset(change['remove_label_ids']))
+                    self.pending_label_changes.setdefault(key, {}).update(change['messages'])
         except Exception as e:
-            print(f"Error getting labels: {e}")
-            return []
+            print(f"Error loading label changes: {e}")
 
-    def remove_all_labels_except(self, message_id, keep_label_name):
-        """Remove all labels from a message except the specified one."""
+    def _save_label_changes(self):
+        """Record the queued label changes; called with label_lock held."""
+        changes = [{'label_id': label_id, 'remove_label_ids': sorted(remove_labels), 'messages': messages}
+                   for (label_id, remove_labels), messages in self.pending_label_changes.items()]
         try:
-            # Get current labels
-            message = self.service.users().messages().get(userId='me', id=message_id).execute()
-            current_labels = message.get('labelIds', [])
-            
-            # Get all labels to find the ID of the label to keep
-            all_labels = self.get_all_labels()
-            keep_label_id = next((label['id'] for label in all_labels if label['name'] == keep_label_name), None)
-            
-            # Determine which labels to remove
-            remove_labels = [label_id for label_id in current_labels 
-                           if label_id not in ['INBOX', keep_label_id]]  # Keep INBOX label
-            
-            if remove_labels:
-                self.service.users().messages().modify(
-                    userId='me',
-                    id=message_id,
-                    body={'removeLabelIds': remove_labels}
-                ).execute()
-                print(f"Removed all labels except '{keep_label_name}' from message {message_id}")
-            
-            return True
+            os.makedirs(os.path.dirname(self.label_changes_path), exist_ok=True)
+            with open(self.label_changes_path, 'w', encoding='utf-8') as f:
+                json.dump(changes, f, indent=2)
         except Exception as e:
-            print(f"Error removing labels: {e}")
+            print(f"Error recording label changes: {e}")
+
+    def queue_label_change(self, message_id, label_name, current_labels=None):
+        """Compute the label change for a message and queue or apply it."""
+        label_id = self.get_or_create_label(label_name)
+        if not label_id:
             return False
 
-    def process_label_command(self, response_content, message_id):
-        """Process special label commands in the response."""
+        # Responses saved before labels were recorded need one lookup
+        if current_labels is None:
+            current_labels = self.get_message_labels(message_id)
+
+        remove_labels = frozenset(label for label in current_labels
+                                  if label not in KEEP_SYSTEM_LABELS and label != label_id)
+        key = (label_id, remove_labels)
+
+        attempts = 0
+        if self.label_modify_mode == 'immediate':
+            failed = batch_modify(self.thread_service(), [message_id], [label_id], remove_labels)
+            if not failed:
+                return True
+            if is_permanent_failure(failed[message_id]):
+                print(f"Not retrying label '{label_name}' on {message_id}: {failed[message_id]}")
+                return False
+            # Left for the next flush to retry
+            attempts = 1
+
+        # Saved before the caller marks the email sent, so a crash cannot lose the change
+        with self.label_lock:
+            self.pending_label_changes.setdefault(key, {})[message_id] = attempts
+            self._save_label_changes()
+        print(f"Queued label '{label_name}' for message {message_id}")
+        return True
+
+    def flush_label_changes(self):
+        """Send queued label changes, one batchModify per distinct change."""
+        with self.label_lock:
+            changes, self.pending_label_changes = self.pending_label_changes, {}
+        if not changes:
+            return 0
+        applied = 0
+        retry = {}
+        for key, messages in changes.items():
+            label_id, remove_labels = key
+            failed = batch_modify(self.thread_service(), list(messages), [label_id], remove_labels)
+            applied += len(messages) - len(failed)
+            label_name = self.labels.get_name(label_id) or label_id
+            print(f"Applied label '{label_name}' to {len(messages) - len(failed)} messages")
+            for message_id, error in failed.items():
+                if is_permanent_failure(error):
+                    print(f"Not retrying label '{label_name}' on {message_id}: {error}")
+                elif messages[message_id] + 1 >= LABEL_CHANGE_MAX_ATTEMPTS:
+                    print(f"Giving up labelling {message_id} after {LABEL_CHANGE_MAX_ATTEMPTS} attempts")
+                else:
+                    retry.setdefault(key, {})[message_id] = messages[message_id] + 1
+
+        with self.label_lock:
+            # Changes queued while this flush ran are kept alongside the retries
+            for key, messages in retry.items():
+                self.pending_label_changes.setdefault(key, {}).update(messages)
+            self._save_label_changes()
+        if retry:
+            print(f"Recorded {sum(len(messages) for messages in retry.values())} label changes to retry")
+        return applied
+
+    def process_label_command(self, response_content, message_id, current_labels=None, coalesced=None):
+        """Process special label commands in the response, labelling coalesced messages the same way."""
         # Check for label command pattern: $LabelName$
         match = re.match(r'^\$([^$]+)\$(.*)', response_content, re.DOTALL)
         if match:
             label_name = match.group(1)
             actual_content = match.group(2).strip()
             
-            # Apply the label
-            if self.apply_label_to_message(message_id, label_name):
-                # Remove all other labels except this one
-                self.remove_all_labels_except(message_id, label_name)
+            # Apply the label and remove all others in a single modify
+            self.queue_label_change(message_id, label_name, current_labels)
+            for message in coalesced or []:
+                self.queue_label_change(message['id'], label_name, message.get('labels'))
             
             # Return the content without the label command
             return actual_content if actual_content else None  # Return None if content is empty
         
         return response_content
 
-    def create_email_message(self, response_data):
+    def create_email_message(self, response_data, rfc_message_id=None):
         """Create email message from response data."""
         try:
             # Extract original email info
@@ -124,7 +213,9 @@ class EmailSender:
             # Process the response content for label commands
             response_content = self.process_label_command(
                 response_data['response'],
-                response_data['email_id']
+                response_data['email_id'],
+                original_email.get('labels'),
+                original_email.get('coalesced')
             )
             
             # If response_content is None (empty after label command), don't create message
@@ -136,6 +227,8 @@ class EmailSender:
             message = MIMEText(response_content)
             message['to'] = original_email['sender']
             message['subject'] = f"Re: {original_email['subject']}"
+            if rfc_message_id:
+                message['Message-ID'] = rfc_message_id
             
             # Add threading headers if Message-ID is available
             if 'message_id' in original_email:
@@ -156,58 +249,124 @@ class EmailSender:
             print(f"Error creating email message: {e}")
             return None
 
+    def find_sent_message(self, rfc_message_id):
+        """Return the Gmail ID of a sent message with this Message-ID, or None."""
+        results = self.scheduler.execute(self.thread_service().users().messages().list(
+            userId='me',
+            q=f"in:sent rfc822msgid:{rfc_message_id.strip('<>')}",
+            maxResults=1
+        ))
+        messages = results.get('messages', [])
+        return messages[0]['id'] if messages else None
+
     def send_email(self, message):
         """Send an email message."""
         try:
-            sent_message = self.service.users().messages().send(
+            # Never retried here: a send that failed with a 5xx may still have gone out, so the
+            # begin_send record is left for the next run to check with find_sent_message
+            sent_message = self.scheduler.execute(self.thread_service().users().messages().send(
                 userId='me',
                 body=message
-            ).execute()
+            ), max_retries=0)
             print(f"Email sent successfully. Message ID: {sent_message['id']}")
             return sent_message['id']
         except Exception as e:
             print(f"Error sending email: {e}")
             return None
 
+    def send_response(self, response_data, file_path=None):
+        """Send one generated response; its spool record stays until compaction drops it."""
+        print(f"Processing response to: {response_data['original_email']['sender']}")
+        print(f"Subject: {response_data['original_email']['subject']}\n")
+        print("Response content:")
+        print("-" * 50)
+        print(response_data['response'])
+        print("-" * 50)
+        
+        original_email = response_data['original_email']
+        email_id = response_data['email_id']
+        if LABEL_ONLY_RE.match(response_data['response'] or ''):
+            # Nothing to send; the response is done once its label change is queued
+            self.process_label_command(response_data['response'], email_id,
+                                       original_email.get('labels'), original_email.get('coalesced'))
+            print("Label-only response, no email to send")
+        else:
+            # The attempt is recorded before sending so a crash can never lead to a second copy
+            attempt, resumed = self.state.begin_send(email_id, make_msgid(domain=MESSAGE_ID_DOMAIN))
+            sent_id = attempt['gmail_message_id']
+            if resumed and not sent_id:
+                try:
+                    sent_id = self.find_sent_message(attempt['rfc_message_id'])
+                except Exception as e:
+                    print(f"Error checking whether the reply to {email_id} was already sent: {e}")
+                    return False
+            if sent_id:
+                print(f"Reply to {email_id} was already sent as {sent_id}, not sending again")
+                self.state.complete_send(email_id, sent_id)
+                self.process_label_command(response_data['response'], email_id,
+                                           original_email.get('labels'), original_email.get('coalesced'))
+            else:
+                # Create and send email
+                message = self.create_email_message(response_data, attempt['rfc_message_id'])
+                sent_id = self.send_email(message) if message else None
+                if not sent_id:
+                    print("Failed to send email")
+                    return False
+                self.state.complete_send(email_id, sent_id)
+                print("Successfully sent email")
+
+        sent_path = None
+        if file_path and not is_spool_ref(file_path):
+            # Responses saved as separate files before the spool existed move to the sent folder
+            sent_path = os.path.join(self.sent_dir, os.path.basename(file_path))
+            os.rename(file_path, sent_path)
+            print(f"Moved response to {sent_path}")
+        self.state.mark_sent(email_id, sent_path)
+        for message in original_email.get('coalesced', []):
+            self.state.mark_sent(message['id'])
+        self.priority.record_done(response_data)
+        return True
+
     def process_pending_responses(self):
         """Process all pending responses and send emails."""
         sent_count = 0
-        pending_responses = []
         
-        # Get list of pending responses
-        for file in os.listdir(self.emails_to_send_dir):
-            if file.endswith('.json') and not file.startswith('sent_'):
-                pending_responses.append(file)
+        # Get list of pending responses from the state index
+        pending_responses = self.state.in_state(GENERATED)
         
         print(f"\nFound {len(pending_responses)} pending responses to send\n")
-        
-        for file in pending_responses:
+
+        loaded = []
+        for row in pending_responses:
+            if not row['response_path']:
+                # Left over from a non-durable streaming run that stopped before sending
+                self.state.mark_failed(row['id'], "Response was never written to disk")
+                continue
             try:
-                # Load response data
-                file_path = os.path.join(self.emails_to_send_dir, file)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    response_data = json.load(f)
-                
-                print(f"Processing response to: {response_data['original_email']['sender']}")
-                print(f"Subject: {response_data['original_email']['subject']}\n")
-                print("Response content:")
-                print("-" * 50)
-                print(response_data['response'])
-                print("-" * 50)
-                
-                # Create and send email
-                message = self.create_email_message(response_data)
-                if message and self.send_email(message):
-                    print("Successfully sent email")
-                    # Move to sent folder
-                    sent_path = os.path.join(self.sent_dir, file)
-                    os.rename(file_path, sent_path)
-                    print(f"Moved response to {sent_path}")
-                    sent_count += 1
-                else:
-                    print("Failed to send email")
+                response_data = read_record(row['response_path'])
+                response_data['path'] = row['response_path']
+                loaded.append(response_data)
             except Exception as e:
-                print(f"Error processing response file {file}: {e}")
+                print(f"Error processing response file {row['response_path']}: {e}")
+        # Most urgent first; the executor starts sends in this order
+        pending_responses = self.priority.sort(loaded)
+
+        def send_row(response_data):
+            try:
+                return self.send_response(response_data, response_data['path'])
+            except Exception as e:
+                print(f"Error processing response file {response_data['path']}: {e}")
+                return False
+
+        if self.send_concurrency > 1 and len(pending_responses) > 1:
+            # Warm the shared label cache before several threads use it
+            self.labels.get_all()
+            with ThreadPoolExecutor(max_workers=self.send_concurrency, thread_name_prefix='send') as executor:
+                sent_count = sum(executor.map(send_row, pending_responses))
+        else:
+            sent_count = sum(send_row(row) for row in pending_responses)
+
+        self.flush_label_changes()
         
         print(f"Sent {sent_count} responses")
         return sent_count
@@ -0,0 +1,128 @@
+import os
+from rate_limiter import get_scheduler, is_retryable, http_status_of, GMAIL_METHOD_UNITS
+
+# Gmail accepts up to 100 calls per batch but starts rate limiting well before that
+BATCH_SIZE = int(os.getenv('GMAIL_BATCH_SIZE', '50'))
+BATCH_RETRIES = int(os.getenv('GMAIL_BATCH_RETRIES', '2'))
+# messages.batchModify accepts at most 1000 IDs per call
+MODIFY_CHUNK_SIZE = 1000
+
+
+class BatchFetcher:
+    def __init__(self, service, batch_size=None, max_retries=None):
+        """Initialize a batched message fetcher for a Gmail service."""
+        self.service = service
+        self.batch_size = batch_size or BATCH_SIZE
+        self.max_retries = BATCH_RETRIES if max_retries is None else max_retries
+        self.scheduler = get_scheduler()
+        self.failed = {}
+
+    def iter_messages(self, message_ids, format='full', fields=None):
+        """Yield (message_id, message) pairs, fetching one batch HTTP request at a time.
+
+        `fields` is a partial-response mask that shrinks the responses.
+        """
+        params = {'format': format}
+        if fields:
+            params['fields'] = fields
+        message_ids = list(dict.fromkeys(message_ids))
+        for start in range(0, len(message_ids), self.batch_size):
+            chunk = message_ids[start:start + self.batch_size]
+            for msg_id, message in self._fetch_chunk(chunk, params).items():
+                yield msg_id, message
+
+    def get_messages(self, message_ids, format='full', fields=None):
+        """Fetch messages in batches and return them keyed by message ID."""
+        return dict(self.iter_messages(message_ids, format, fields))
+
+    def _fetch_chunk(self, chunk, params):
+        """Fetch one chunk, retrying items that failed with a transient error."""
+        results = {}
+        pending = list(chunk)
+        for attempt in range(self.max_retries + 1):
+            errors = self._execute_batch(pending, params, results)
+            pending = [msg_id for msg_id, error in errors.items() if is_retryable(error)]
+            for msg_id, error in errors.items():
+                self.failed[msg_id] = error
+            if not pending:
+                break
+            print(f"Retrying {len(pending)} messages after transient batch errors")
+            self.scheduler.backoff(attempt, errors[pending[0]])
+        for msg_id in results:
+            self.failed.pop(msg_id, None)
+        return results
+
+    def _execute_batch(self, message_ids, params, results):
+        """Execute a single batch request, storing responses and returning per-item errors."""
+        errors = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                results[request_id] = response
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for msg_id in message_ids:
+            batch.add(
+                self.service.users().messages().get(userId='me', id=msg_id, **params),
+                request_id=msg_id
+            )
+        try:
+            # The batch is charged for every call it carries; per-item failures are retried by the caller
+            self.scheduler.execute(batch, units=GMAIL_METHOD_UNITS['gmail.users.messages.get'] * len(message_ids))
+        except Exception as e:
+            print(f"Error executing batch request: {e}")
+            for msg_id in message_ids:
+                if msg_id not in results:
+                    errors.setdefault(msg_id, e)
+
+        for msg_id, error in errors.items():
+            print(f"Error fetching message {msg_id}: {error}")
+        return errors
+
+
+def is_permanent_failure(error):
+    """Check whether an error means the call will never succeed, e.g. a deleted message."""
+    status = http_status_of(error)
+    return 400 <= status < 500 and not is_retryable(error)
+
+
+def batch_modify(service, message_ids, add_label_ids=None, remove_label_ids=None,
+                 chunk_size=MODIFY_CHUNK_SIZE, retries=BATCH_RETRIES):
+    """Apply the same label change to many messages, returning {message_id: error} for those that failed.
+
+    One bad ID fails a whole batchModify call, so a chunk that fails
+    permanently is split in halves until the bad IDs are isolated.
+    """
+    body = {}
+    if add_label_ids:
+        body['addLabelIds'] = list(add_label_ids)
+    if remove_label_ids:
+        body['removeLabelIds'] = list(remove_label_ids)
+    if not body or not message_ids:
+        return {}
+
+    scheduler = get_scheduler()
+    failed = {}
+    message_ids = list(dict.fromkeys(message_ids))
+    chunks = [message_ids[start:start + chunk_size] for start in range(0, len(message_ids), chunk_size)]
+    while chunks:
+        chunk = chunks.pop()
+        try:
+            if len(chunk) == 1:
+                scheduler.execute(service.users().messages().modify(userId='me', id=chunk[0], body=body),
+                                  max_retries=retries)
+            else:
+                scheduler.execute(service.users().messages().batchModify(
+                    userId='me',
+                    body=dict(body, ids=chunk)
+                ), max_retries=retries)
+        except Exception as e:
+            if len(chunk) > 1 and is_permanent_failure(e):
+                middle = len(chunk) // 2
+                chunks.extend([chunk[middle:], chunk[:middle]])
+                continue
+            print(f"Error modifying labels on {len(chunk)} messages: {e}")
+            failed.update(dict.fromkeys(chunk, e))
+    return failed
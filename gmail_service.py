@@ -1,11 +1,12 @@
 import os
 import pickle
 import json
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import threading
+from datetime import datetime, timedelta, timezone
 import dotenv
-from google.oauth2.credentials import Credentials
+
+# The Google client libraries take a noticeable part of a second to import,
+# so they are imported inside the functions that need them
 
 # Load environment variables
 dotenv.load_dotenv()
@@ -13,8 +14,26 @@ dotenv.load_dotenv()
 # Gmail API Scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# Long-running processes refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = int(os.getenv('GMAIL_TOKEN_REFRESH_MARGIN', '300'))
+
+# Optional path to a saved Gmail discovery document; the copy bundled with
+# google-api-python-client is used otherwise, so building a service never fetches it
+GMAIL_DISCOVERY_DOC = os.getenv('GMAIL_DISCOVERY_DOC', '')
+
+# Saved OAuth token of the mailbox, and the OAuth client used to obtain one
+GMAIL_TOKEN_PATH = os.getenv('GMAIL_TOKEN_PATH', 'token.pickle')
+GMAIL_CLIENT_SECRETS_PATH = os.getenv('GMAIL_CLIENT_SECRETS_PATH', os.path.join('credentials', 'creds_google.json'))
+# Set to 0 where nobody can complete a browser sign-in, e.g. in mailbox pool workers
+GMAIL_INTERACTIVE_AUTH = os.getenv('GMAIL_INTERACTIVE_AUTH', '1') == '1'
+
+_discovery_document = None
+_shared = {'credentials': None, 'services': {}}
+_shared_lock = threading.Lock()
+
 def get_credentials_from_env():
     """Get credentials from environment variables (for CI/CD)."""
+    from google.oauth2.credentials import Credentials
     try:
         creds_json = os.getenv('GMAIL_CREDENTIALS_JSON')
         if not creds_json:
@@ -26,13 +45,20 @@ def get_credentials_from_env():
         print(f"Error loading credentials from environment: {e}")
         return None
 
-def get_gmail_service():
-    """Authenticate and create Gmail service."""
+def save_credentials(creds):
+    """Save the credentials for the next run."""
+    with open(GMAIL_TOKEN_PATH, 'wb') as token:
+        pickle.dump(creds, token)
+
+def get_credentials():
+    """Load, refresh or obtain Gmail credentials."""
+    from google.auth.transport.requests import Request
+    from google_auth_oauthlib.flow import InstalledAppFlow
     creds = None
     
     # First try to load from token.pickle
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
+    if os.path.exists(GMAIL_TOKEN_PATH):
+        with open(GMAIL_TOKEN_PATH, 'rb') as token:
             creds = pickle.load(token)
     
     # If no valid credentials, try environment variables
@@ -45,7 +71,10 @@ def get_gmail_service():
             
             # If no env credentials, try local file
             if not creds:
-                credentials_path = os.path.join('credentials', 'creds_google.json')
+                if not GMAIL_INTERACTIVE_AUTH:
+                    raise Exception(f"No valid Gmail token at {os.path.abspath(GMAIL_TOKEN_PATH)} "
+                                    "and interactive sign-in is disabled")
+                credentials_path = GMAIL_CLIENT_SECRETS_PATH
                 if not os.path.exists(credentials_path):
                     raise Exception(f"Google credentials not found in environment or at: {credentials_path}")
                 
@@ -53,7 +82,62 @@ def get_gmail_service():
                 creds = flow.run_local_server(port=0)
                 
                 # Save the credentials for the next run
-                with open('token.pickle', 'wb') as token:
-                    pickle.dump(creds, token)
+                save_credentials(creds)
+
+    return creds
+
+def get_discovery_document():
+    """Return the Gmail discovery document as JSON text, read once per process."""
+    global _discovery_document
+    if _discovery_document is None:
+        if GMAIL_DISCOVERY_DOC and os.path.exists(GMAIL_DISCOVERY_DOC):
+            with open(GMAIL_DISCOVERY_DOC, 'r', encoding='utf-8') as f:
+                _discovery_document = f.read()
+        else:
+            from googleapiclient.discovery_cache import get_static_doc
+            _discovery_document = get_static_doc('gmail', 'v1') or ''
+    return _discovery_document
+
+def get_gmail_service(creds=None):
+    """Authenticate and create Gmail service."""
+    from googleapiclient.discovery import build, build_from_document
+    creds = creds or get_credentials()
+    document = get_discovery_document()
+    if document:
+        # Build from the local document instead of looking it up
+        return build_from_document(document, credentials=creds)
+    return build('gmail', 'v1', credentials=creds, static_discovery=True)
+
+def get_shared_gmail_service(name='default'):
+    """Return a Gmail service that lives for the whole process.
+
+    All shared services use one set of credentials. Each name gets its own
+    service, because a service must not be used from two threads at once.
+    """
+    with _shared_lock:
+        if _shared['credentials'] is None:
+            _shared['credentials'] = get_credentials()
+        service = _shared['services'].get(name)
+        if service is None:
+            service = get_gmail_service(_shared['credentials'])
+            _shared['services'][name] = service
+        return service
 
-    return build('gmail', 'v1', credentials=creds)
+def refresh_credentials_if_needed(margin=TOKEN_REFRESH_MARGIN):
+    """Refresh the shared credentials before they expire, so requests never wait on a refresh."""
+    from google.auth.transport.requests import Request
+    with _shared_lock:
+        creds = _shared['credentials']
+        if creds is None or not creds.refresh_token:
+            return False
+        # google-auth stores expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if creds.valid and creds.expiry and creds.expiry - now > timedelta(seconds=margin):
+            return False
+        creds.refresh(Request())
+        try:
+            save_credentials(creds)
+        except Exception as e:
+            print(f"Error saving refreshed credentials: {e}")
+        print("Refreshed Gmail access token")
+        return True
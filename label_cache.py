@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import threading
+from rate_limiter import get_scheduler
+
+LABEL_CACHE_TTL = int(os.getenv('LABEL_CACHE_TTL', '600'))
+# Set to an empty string to keep the cache in memory only
+LABEL_CACHE_PATH = os.getenv('LABEL_CACHE_PATH', os.path.join('State', 'labels.json'))
+
+
+class LabelRegistry:
+    """Process-wide map between Gmail label names and IDs.
+
+    One registry is shared by everything working on a mailbox, but Gmail
+    services must not be shared between threads, so every lookup that
+    may call Gmail takes the caller's service. for_service returns a
+    LabelView that passes it along.
+    """
+
+    _registries = {}
+    _registries_lock = threading.Lock()
+
+    @classmethod
+    def for_service(cls, service, user_id='me'):
+        """Return the shared registry of a mailbox bound to the caller's service, creating it on first use."""
+        with cls._registries_lock:
+            registry = cls._registries.get(user_id)
+            if registry is None:
+                registry = cls()
+                cls._registries[user_id] = registry
+        return LabelView(registry, service)
+
+    @classmethod
+    def shared(cls, user_id='me'):
+        """Return the registry for a mailbox if one has been created, without creating it."""
+        with cls._registries_lock:
+            return cls._registries.get(user_id)
+
+    def __init__(self, ttl=None, cache_path=None):
+        """Initialize the registry, loading a persisted copy if it is still fresh."""
+        self.scheduler = get_scheduler()
+        self.ttl = LABEL_CACHE_TTL if ttl is None else ttl
+        self.cache_path = LABEL_CACHE_PATH if cache_path is None else cache_path
+        self.lock = threading.RLock()
+        self.labels = []
+        self.ids_by_name = {}
+        self.names_by_id = {}
+        self.fetched_at = 0
+        self._load()
+
+    def _load(self):
+        """Load persisted labels from disk."""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._set_labels(data.get('labels', []), data.get('fetched_at', 0))
+        except Exception as e:
+            print(f"Error loading label cache from {self.cache_path}: {e}")
+
+    def _save(self):
+        """Persist labels to disk."""
+        if not self.cache_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'labels': self.labels, 'fetched_at': self.fetched_at}, f, indent=2)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            print(f"Error saving label cache: {e}")
+
+    def _set_labels(self, labels, fetched_at):
+        self.labels = [{'id': label['id'], 'name': label['name'], 'type': label.get('type')}
+                       for label in labels]
+        self.ids_by_name = {label['name']: label['id'] for label in self.labels}
+        self.names_by_id = {label['id']: label['name'] for label in self.labels}
+        self.fetched_at = fetched_at
+
+    def is_stale(self):
+        """Check whether the cached labels are older than the TTL."""
+        return time.time() - self.fetched_at > self.ttl
+
+    def refresh(self, service):
+        """Reload all labels from Gmail."""
+        with self.lock:
+            results = self.scheduler.execute(service.users().labels().list(userId='me'))
+            self._set_labels(results.get('labels', []), time.time())
+            self._save()
+
+    def invalidate(self):
+        """Force the next lookup to reload labels."""
+        with self.lock:
+            self.fetched_at = 0
+
+    def _ensure_fresh(self, service):
+        if self.is_stale():
+            self.refresh(service)
+
+    def get_all(self, service):
+        """Return all labels as dicts with id, name and type."""
+        with self.lock:
+            self._ensure_fresh(service)
+            return list(self.labels)
+
+    def get_id(self, service, label_name):
+        """Return the ID for a label name, or None if it does not exist."""
+        with self.lock:
+            self._ensure_fresh(service)
+            return self.ids_by_name.get(label_name)
+
+    def get_name(self, service, label_id):
+        """Return the name for a label ID, or None if it is unknown."""
+        with self.lock:
+            self._ensure_fresh(service)
+            return self.names_by_id.get(label_id)
+
+    def get_or_create(self, service, label_name):
+        """Return the ID for a label name, creating the label if needed."""
+        with self.lock:
+            label_id = self.get_id(service, label_name)
+            if label_id:
+                return label_id
+
+            # The label may have been created elsewhere since the last refresh
+            self.refresh(service)
+            label_id = self.ids_by_name.get(label_name)
+            if label_id:
+                return label_id
+
+            label_object = {
+                'name': label_name,
+                'labelListVisibility': 'labelShow',
+                'messageListVisibility': 'show'
+            }
+            created_label = self.scheduler.execute(service.users().labels().create(
+                userId='me',
+                body=label_object
+            ))
+            # Drop the cached list so other processes' additions are picked up as well
+            self.invalidate()
+            self.labels.append({'id': created_label['id'], 'name': label_name, 'type': 'user'})
+            self.ids_by_name[label_name] = created_label['id']
+            self.names_by_id[created_label['id']] = label_name
+            self._save()
+            return created_label['id']
+
+
+class LabelView:
+    """A mailbox's label registry bound to the Gmail service of one caller."""
+
+    def __init__(self, registry, service):
+        self.registry = registry
+        self.service = service
+
+    def refresh(self):
+        self.registry.refresh(self.service)
+
+    def invalidate(self):
+        self.registry.invalidate()
+
+    def get_all(self):
+        return self.registry.get_all(self.service)
+
+    def get_id(self, label_name):
+        return self.registry.get_id(self.service, label_name)
+
+    def get_name(self, label_id):
+        return self.registry.get_name(self.service, label_id)
+
+    def get_or_create(self, label_name):
+        return self.registry.get_or_create(self.service, label_name)
@@ -0,0 +1,240 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+from rate_limiter import get_scheduler, estimate_tokens, http_status_of, OPENAI_EXPECTED_COMPLETION_TOKENS
+from state_store import StateStore
+
+# Load environment variables
+load_dotenv()
+AI_BACKEND = os.getenv('AI_BACKEND', 'assistants')
+ASSISTANT_ID = os.getenv('OPENAI_ASSISTANT_ID')
+CHAT_MODEL = os.getenv('OPENAI_CHAT_MODEL', 'gpt-4o-mini')
+SYSTEM_PROMPT = os.getenv('OPENAI_SYSTEM_PROMPT', '')
+SYSTEM_PROMPT_FILE = os.getenv('OPENAI_SYSTEM_PROMPT_FILE', '')
+# Run polling starts fast and backs off while the run is still going
+POLL_INITIAL_INTERVAL = float(os.getenv('AI_POLL_INITIAL_INTERVAL', '0.25'))
+POLL_MAX_INTERVAL = float(os.getenv('AI_POLL_MAX_INTERVAL', '2.0'))
+POLL_BACKOFF = 1.5
+# Follow-ups in a Gmail thread reuse its OpenAI thread unless it has been idle this long
+OPENAI_THREAD_REUSE = os.getenv('OPENAI_THREAD_REUSE', '1') == '1'
+OPENAI_THREAD_TTL = int(os.getenv('OPENAI_THREAD_TTL', str(14 * 24 * 3600)))
+# Seconds between evictions of idle thread mappings, so long-running modes keep the table small
+OPENAI_THREAD_EVICT_INTERVAL = int(os.getenv('OPENAI_THREAD_EVICT_INTERVAL', '3600'))
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def format_email_prompt(email_content):
+    """Build the user message sent to the model for an email."""
+    return (
+        f"From: {email_content['sender']}\n"
+        f"Subject: {email_content['subject']}\n"
+        f"Message: {email_content['body']}"
+    )
+
+
+class LLMBackend:
+    """Turns an email into a reply; AIGenerator only talks to this interface."""
+
+    name = 'base'
+
+    def generate(self, email_content):
+        """Return the reply text for an email, or None."""
+        raise NotImplementedError
+
+
+class AssistantsBackend(LLMBackend):
+    """Thread, message, run and poll against an OpenAI Assistant."""
+
+    name = 'assistants'
+
+    def __init__(self, client, assistant_id=None, state=None, reuse_threads=None):
+        self.client = client
+        self.scheduler = get_scheduler()
+        self.assistant_id = assistant_id or ASSISTANT_ID
+        self.reuse_threads = OPENAI_THREAD_REUSE if reuse_threads is None else reuse_threads
+        self.state = state
+        # One run at a time per OpenAI thread
+        self.thread_locks = {}
+        self.thread_locks_lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.evicted_at = None
+        if self.reuse_threads:
+            self.state = self.state or StateStore.for_path()
+            self.evict_idle_threads()
+
+    def evict_idle_threads(self):
+        """Drop thread mappings idle past OPENAI_THREAD_TTL, at most once per OPENAI_THREAD_EVICT_INTERVAL."""
+        with self.evict_lock:
+            now = time.monotonic()
+            if self.evicted_at is not None and now - self.evicted_at < OPENAI_THREAD_EVICT_INTERVAL:
+                return 0
+            self.evicted_at = now
+        evicted = self.state.evict_openai_threads(OPENAI_THREAD_TTL)
+        if evicted:
+            print(f"Evicted {evicted} idle OpenAI threads")
+        return evicted
+
+    def _thread_lock(self, thread_id):
+        with self.thread_locks_lock:
+            return self.thread_locks.setdefault(thread_id, threading.Lock())
+
+    def generate(self, email_content):
+        if not self.assistant_id:
+            raise Exception("OPENAI_ASSISTANT_ID not found in environment variables")
+
+        gmail_thread_id = email_content.get('thread_id')
+        if not self.reuse_threads or not gmail_thread_id:
+            return self._generate_in_thread(email_content, None)
+        # The daemon and watch mode keep one backend for days
+        self.evict_idle_threads()
+        with self._thread_lock(gmail_thread_id):
+            return self._generate_in_thread(email_content, gmail_thread_id)
+
+    def _generate_in_thread(self, email_content, gmail_thread_id):
+        call = self.scheduler.call_openai
+        prompt = format_email_prompt(email_content)
+
+        # Follow-ups append to the thread that holds the earlier conversation
+        thread_id = self.state.get_openai_thread(gmail_thread_id, OPENAI_THREAD_TTL) if gmail_thread_id else None
+        if thread_id:
+            try:
+                call(self.client.beta.threads.messages.create, thread_id=thread_id, role="user", content=prompt)
+            except Exception as e:
+                if http_status_of(e) != 404:
+                    raise
+                # The thread was deleted on the OpenAI side
+                self.state.forget_openai_thread(gmail_thread_id)
+                thread_id = None
+
+        if not thread_id:
+            # The first message goes in with the thread, saving a round trip
+            thread_id = call(self.client.beta.threads.create, messages=[{"role": "user", "content": prompt}]).id
+            if gmail_thread_id:
+                self.state.set_openai_thread(gmail_thread_id, thread_id)
+
+        # Run the assistant; tokens are charged here since the run does the generation
+        run = call(
+            self.client.beta.threads.runs.create,
+            thread_id=thread_id,
+            assistant_id=self.assistant_id,
+            estimated_tokens=estimate_tokens(prompt) + OPENAI_EXPECTED_COMPLETION_TOKENS
+        )
+
+        # Wait for completion
+        self.wait_for_run(thread_id, run)
+        if gmail_thread_id:
+            self.state.set_openai_thread(gmail_thread_id, thread_id)
+
+        # Get this run's reply; reused threads also hold earlier replies
+        messages = call(self.client.beta.threads.messages.list, thread_id=thread_id, run_id=run.id)
+        for message in messages.data:
+            if message.role == "assistant":
+                return message.content[0].text.value
+        return None
+
+    def wait_for_run(self, thread_id, run):
+        """Poll an assistant run with adaptive backoff until it finishes."""
+        interval = POLL_INITIAL_INTERVAL
+        while run.status in ['queued', 'in_progress', 'cancelling']:
+            time.sleep(interval)
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+            run = self.scheduler.call_openai(
+                self.client.beta.threads.runs.retrieve,
+                thread_id=thread_id,
+                run_id=run.id
+            )
+        if run.status != 'completed':
+            raise Exception(f"Assistant run failed with status: {run.status}")
+        return run
+
+
+class ChatCompletionsBackend(LLMBackend):
+    """Single streaming chat-completions request with a configured system prompt."""
+
+    name = 'chat'
+
+    def __init__(self, client, model=None, system_prompt=None):
+        self.client = client
+        self.scheduler = get_scheduler()
+        self.model = model or CHAT_MODEL
+        self.system_prompt = system_prompt if system_prompt is not None else load_system_prompt()
+
+    def generate(self, email_content):
+        messages = []
+        if self.system_prompt:
+            messages.append({'role': 'system', 'content': self.system_prompt})
+        messages.append({'role': 'user', 'content': format_email_prompt(email_content)})
+
+        prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        stream = self.scheduler.call_openai(
+            self.client.chat.completions.create,
+            model=self.model,
+            messages=messages,
+            stream=True,
+            estimated_tokens=prompt_tokens + OPENAI_EXPECTED_COMPLETION_TOKENS
+        )
+        chunks = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+        return ''.join(chunks) or None
+
+
+class FakeBackend(LLMBackend):
+    """Local backend for tests and dry runs; never touches the network."""
+
+    name = 'fake'
+
+    def __init__(self, reply=None):
+        self.reply = reply
+        self.calls = []
+
+    def generate(self, email_content):
+        self.calls.append(email_content)
+        if callable(self.reply):
+            return self.reply(email_content)
+        if self.reply is not None:
+            return self.reply
+        return f"Thank you for your email about \"{email_content['subject']}\". We will get back to you shortly."
+
+
+def load_system_prompt():
+    """Read the chat system prompt from OPENAI_SYSTEM_PROMPT_FILE or OPENAI_SYSTEM_PROMPT."""
+    if SYSTEM_PROMPT_FILE:
+        with open(SYSTEM_PROMPT_FILE, 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    return SYSTEM_PROMPT
+
+
+def create_openai_client():
+    """Create an OpenAI client from the environment."""
+    # Imported here because the SDK takes most of a second to import
+    import openai
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+    # Retries are handled by the shared call scheduler
+    return openai.OpenAI(max_retries=0)
+
+
+def get_shared_openai_client():
+    """Return one OpenAI client for the whole process, so its connection pool is reused."""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = create_openai_client()
+        return _shared_client
+
+
+def create_backend(name=None, client=None):
+    """Create the backend selected by name or AI_BACKEND."""
+    name = name or AI_BACKEND
+    if name == 'fake':
+        return FakeBackend()
+    client = client or get_shared_openai_client()
+    if name == 'assistants':
+        return AssistantsBackend(client)
+    if name == 'chat':
+        return ChatCompletionsBackend(client)
+    raise ValueError(f"Unknown AI backend: {name}")
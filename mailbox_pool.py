@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from datetime import datetime
+from contextlib import redirect_stdout
+from gmail_service import GMAIL_CLIENT_SECRETS_PATH
+
+# JSON list of mailboxes, see the README
+MAILBOXES_PATH = os.getenv('MAILBOXES_PATH', 'mailboxes.json')
+# Each mailbox keeps its token, state, spools and caches in <MAILBOXES_DIR>/<name> unless it sets "dir"
+MAILBOXES_DIR = os.getenv('MAILBOXES_DIR', 'Accounts')
+MAILBOX_WORKERS = int(os.getenv('MAILBOX_WORKERS', '0')) or os.cpu_count() or 1
+MAILBOX_POLL_INTERVAL = int(os.getenv('MAILBOX_POLL_INTERVAL', os.getenv('DAEMON_POLL_INTERVAL', '60')))
+# A cycle still running after this many seconds is killed so its worker slot is freed
+MAILBOX_CYCLE_TIMEOUT = int(os.getenv('MAILBOX_CYCLE_TIMEOUT', '1800'))
+# Gmail enforces its per-user quota on each mailbox separately
+MAILBOX_GMAIL_UNITS_PER_SECOND = float(os.getenv('GMAIL_QUOTA_UNITS_PER_SECOND', '250'))
+# OpenAI limits belong to the API key every mailbox shares, so they are split between the workers
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = float(os.getenv('OPENAI_TOKENS_PER_MINUTE', '200000'))
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_mailbox_cycle(name, directory, environment, mode):
+    """Run one pipeline cycle for a mailbox in a fresh worker process and return its statistics.
+
+    The process works inside the mailbox directory with the mailbox's
+    environment, so every relative path and setting of the pipeline
+    modules (token.pickle, State/, the spools, rules.json) is the mailbox's own.
+    """
+    if PACKAGE_DIR not in sys.path:
+        sys.path.insert(0, PACKAGE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    os.environ.update(environment)
+    started_at = time.time()
+    result = {'name': name, 'error': None}
+    with open('pipeline.log', 'a', encoding='utf-8') as log, redirect_stdout(log):
+        print(f"\n=== {name} cycle at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===")
+        # Imported only now, so module-level settings are read from this mailbox's environment
+        from pipeline_daemon import PipelineDaemon
+        from state_store import StateStore
+        from priority_scheduler import get_priority_scheduler
+        daemon = PipelineDaemon(mode=mode, push_port=0, gmail_watch=False)
+        try:
+            daemon.run_cycle()
+        except Exception as e:
+            print(f"Error in pipeline cycle: {e}")
+            result['error'] = str(e)
+        daemon.scheduler.report()
+        daemon.priority.report()
+        result.update(api=daemon.scheduler.stats(), states=StateStore.for_path().counts(),
+                      response_times=get_priority_scheduler().stats())
+    result['elapsed'] = time.time() - started_at
+    return result
+
+
+def _cycle_process(connection, name, directory, environment, mode):
+    """Worker process entry point: run one cycle and send its result back."""
+    try:
+        result = run_mailbox_cycle(name, directory, environment, mode)
+    except Exception as e:
+        result = {'name': name, 'error': str(e), 'failed': True}
+    connection.send(result)
+    connection.close()
+
+
+def authorize_mailbox(directory, environment):
+    """Sign in to a mailbox interactively and save its token in the mailbox directory."""
+    if PACKAGE_DIR not in sys.path:
+        sys.path.insert(0, PACKAGE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    os.environ.update(environment, GMAIL_INTERACTIVE_AUTH='1')
+    from gmail_service import get_credentials
+    get_credentials()
+    print(f"Saved Gmail token in {directory}")
+
+
+class Mailbox:
+    """One Gmail account served by the pool, with its own directory, labels and quota."""
+
+    def __init__(self, spec, base_dir=None):
+        self.name = spec['name']
+        self.directory = os.path.abspath(spec.get('dir') or os.path.join(base_dir or MAILBOXES_DIR, self.name))
+        self.labels = spec.get('labels')
+        self.gmail_units_per_second = spec.get('gmail_units_per_second', MAILBOX_GMAIL_UNITS_PER_SECOND)
+        # A mailbox with weight 2 gets twice the worker time of one with weight 1 when they compete
+        self.weight = float(spec.get('weight', 1))
+        self.env = {key: str(value) for key, value in spec.get('env', {}).items()}
+        self.token_path = os.path.join(self.directory, self.env.get('GMAIL_TOKEN_PATH', 'token.pickle'))
+        self.busy_seconds = 0.0
+        self.next_due = 0.0
+        self.running = False
+        self.cycles = 0
+
+    def environment(self, workers):
+        """Return the environment a worker process runs this mailbox's cycle with."""
+        environment = {
+            'GMAIL_QUOTA_UNITS_PER_SECOND': str(self.gmail_units_per_second),
+            'OPENAI_REQUESTS_PER_MINUTE': str(OPENAI_REQUESTS_PER_MINUTE / workers),
+            'OPENAI_TOKENS_PER_MINUTE': str(OPENAI_TOKENS_PER_MINUTE / workers),
+            # The OAuth client is shared; only the token lives in the mailbox directory
+            'GMAIL_CLIENT_SECRETS_PATH': os.path.abspath(GMAIL_CLIENT_SECRETS_PATH),
+            'GMAIL_TOKEN_PATH': 'token.pickle',
+            # Set, even if empty, so load_dotenv cannot hand every mailbox the shared account's credentials
+            'GMAIL_CREDENTIALS_JSON': '',
+            # Nobody can finish a browser sign-in in a worker; a missing token fails the cycle instead
+            'GMAIL_INTERACTIVE_AUTH': '0',
+        }
+        if self.labels:
+            environment['GMAIL_LABELS'] = ','.join(self.labels)
+        environment.update(self.env)
+        return environment
+
+    def has_credentials(self):
+        """Check whether the mailbox has its own token or credentials to run with."""
+        return os.path.exists(self.token_path) or bool(self.env.get('GMAIL_CREDENTIALS_JSON'))
+
+
+class MailboxPool:
+    """Runs the pipeline for several mailboxes across a pool of worker processes.
+
+    Each cycle of a mailbox runs in its own fresh process, so mailboxes
+    never share clients, state or rate limiters. When more mailboxes are
+    due than there are workers, the one that has used the least worker
+    time for its weight goes first, and a mailbox never runs two cycles
+    at once.
+    """
+
+    def __init__(self, mailboxes, workers=None, mode='batch', interval=None, cycle_timeout=None):
+        if not mailboxes:
+            raise ValueError("No mailboxes configured")
+        if mode not in ('batch', 'streaming'):
+            raise ValueError(f"Mailbox cycles run in batch or streaming mode, not {mode}")
+        self.mailboxes = mailboxes
+        self.workers = min(workers or MAILBOX_WORKERS, len(mailboxes))
+        self.mode = mode
+        self.interval = interval or MAILBOX_POLL_INTERVAL
+        self.cycle_timeout = cycle_timeout or MAILBOX_CYCLE_TIMEOUT
+        self.context = multiprocessing.get_context('spawn')
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def from_file(cls, path=None, **kwargs):
+        """Load mailboxes from a JSON file of the form {"mailboxes": [{"name": ...}, ...]}."""
+        path = path or MAILBOXES_PATH
+        with open(path, 'r', encoding='utf-8') as f:
+            specs = json.load(f)
+        mailboxes = [Mailbox(spec) for spec in specs.get('mailboxes', [])]
+        print(f"Loaded {len(mailboxes)} mailboxes from {path}")
+        return cls(mailboxes, **kwargs)
+
+    def stop(self, *args):
+        """Stop once the running cycles finish."""
+        self.stop_event.set()
+
+    def _due(self, now):
+        due = [mailbox for mailbox in self.mailboxes if not mailbox.running and mailbox.next_due <= now]
+        return sorted(due, key=lambda mailbox: (mailbox.busy_seconds / mailbox.weight, mailbox.next_due))
+
+    def authorize(self, name):
+        """Run the interactive Gmail sign-in for one mailbox in the foreground."""
+        mailbox = next((mailbox for mailbox in self.mailboxes if mailbox.name == name), None)
+        if mailbox is None:
+            raise ValueError(f"No mailbox named {name}")
+        process = self.context.Process(target=authorize_mailbox,
+                                       args=(mailbox.directory, mailbox.environment(self.workers)))
+        process.start()
+        process.join()
+        return process.exitcode == 0
+
+    def _start(self, mailbox):
+        """Start a worker process for one cycle of a mailbox."""
+        receiver, sender = self.context.Pipe(duplex=False)
+        # Each cycle starts from a clean interpreter with its mailbox's settings
+        process = self.context.Process(target=_cycle_process, name=f"mailbox-{mailbox.name}",
+                                       args=(sender, mailbox.name, mailbox.directory,
+                                             mailbox.environment(self.workers), self.mode))
+        process.start()
+        sender.close()
+        mailbox.running = True
+        return {'mailbox': mailbox, 'process': process, 'connection': receiver, 'started_at': time.time()}
+
+    def _finish(self, cycle, result, once):
+        mailbox = cycle['mailbox']
+        cycle['connection'].close()
+        mailbox.running = False
+        mailbox.cycles += 1
+        mailbox.next_due = float('inf') if once else time.time() + self.interval
+        mailbox.busy_seconds += result.get('elapsed', time.time() - cycle['started_at'])
+        if result.get('failed'):
+            print(f"Mailbox {mailbox.name}: worker failed: {result['error']}")
+            return
+        states = ', '.join(f"{count} {state}" for state, count in sorted(result['states'].items()))
+        print(f"Mailbox {mailbox.name}: cycle {mailbox.cycles} finished in {result['elapsed']:.1f}s "
+              f"using {result['api']['gmail_units']} Gmail units ({states or 'no emails'})")
+        if result['error']:
+            print(f"Mailbox {mailbox.name}: {result['error']} (see {mailbox.directory}/pipeline.log)")
+
+    def _collect(self, running, once):
+        """Finish cycles whose worker reported or died, and kill those past the timeout."""
+        for cycle in list(running):
+            process, connection = cycle['process'], cycle['connection']
+            result = None
+            if connection.poll():
+                try:
+                    result = connection.recv()
+                except EOFError:
+                    pass
+            if result is None and process.is_alive():
+                if time.time() - cycle['started_at'] < self.cycle_timeout:
+                    continue
+                process.terminate()
+                result = {'error': f"cycle timed out after {self.cycle_timeout}s and was stopped", 'failed': True}
+            process.join()
+            if result is None:
+                result = {'error': f"worker exited with code {process.exitcode}", 'failed': True}
+            running.remove(cycle)
+            self._finish(cycle, result, once)
+
+    def _skip_unauthorized(self, mailbox, once):
+        mailbox.next_due = float('inf') if once else time.time() + self.interval
+        print(f"Mailbox {mailbox.name}: no Gmail token at {mailbox.token_path}; "
+              f"sign in with `python run_pipeline.py --mailboxes --authorize {mailbox.name}`")
+
+    def run(self, once=False):
+        """Run cycles until stopped, or a single cycle of every mailbox when `once` is set."""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+        print(f"Serving {len(self.mailboxes)} mailboxes with {self.workers} worker processes")
+        running = []
+        try:
+            while True:
+                if not self.stop_event.is_set():
+                    for mailbox in self._due(time.time())[:self.workers - len(running)]:
+                        # Without its own token a mailbox would fall back to another account or hang on sign-in
+                        if not mailbox.has_credentials():
+                            self._skip_unauthorized(mailbox, once)
+                            continue
+                        running.append(self._start(mailbox))
+                if not running:
+                    next_due = min(mailbox.next_due for mailbox in self.mailboxes)
+                    if self.stop_event.is_set() or next_due == float('inf'):
+                        break
+                    self.stop_event.wait(max(0, next_due - time.time()))
+                    continue
+                waitables = [cycle['connection'] for cycle in running] + [cycle['process'].sentinel for cycle in running]
+                wait(waitables, timeout=min(self.interval, self.cycle_timeout))
+                self._collect(running, once)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for cycle in running:
+                cycle['process'].join()
+        return self.report()
+
+    def report(self):
+        """Print and return the cycles and worker time of each mailbox."""
+        stats = {mailbox.name: {'cycles': mailbox.cycles, 'busy_seconds': mailbox.busy_seconds}
+                 for mailbox in self.mailboxes}
+        for name, mailbox_stats in stats.items():
+            print(f"Mailbox {name}: {mailbox_stats['cycles']} cycles, "
+                  f"{mailbox_stats['busy_seconds']:.1f}s of worker time")
+        return stats
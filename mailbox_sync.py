@@ -0,0 +1,155 @@
+import os
+import json
+from rate_limiter import get_scheduler, http_status_of
+
+STATE_DIR = 'State'
+SYNC_MODE = os.getenv('GMAIL_SYNC_MODE', 'incremental')
+PAGE_SIZE = int(os.getenv('GMAIL_PAGE_SIZE', '500'))
+
+
+class MailboxSync:
+    def __init__(self, service, state_path=None, mode=None):
+        """Initialize mailbox sync, loading the last stored history ID."""
+        self.service = service
+        self.scheduler = get_scheduler()
+        self.mode = mode or SYNC_MODE
+        self.state_path = state_path or os.path.join(STATE_DIR, 'sync_state.json')
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        self._load_state()
+
+    def _load_state(self):
+        """Load the stored history ID and any messages deferred from the last run."""
+        self.history_id = None
+        self.deferred = {}
+        # Deferred messages handed out by the current listing, and those deferred again since
+        self.handed_out = set()
+        self.redeferred = set()
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self.history_id = state.get('history_id')
+            self.deferred = state.get('deferred', {})
+        except Exception as e:
+            print(f"Error loading sync state from {self.state_path}: {e}")
+
+    def save_state(self):
+        """Persist the history ID and deferred messages."""
+        try:
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'history_id': self.history_id, 'deferred': self.deferred}, f, indent=2)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            print(f"Error saving sync state: {e}")
+
+    def defer(self, message):
+        """Remember a message that could not be processed so the next sync yields it again."""
+        self.deferred[message['id']] = message.get('threadId')
+        self.redeferred.add(message['id'])
+
+    def advance(self, history_id):
+        """Move the stored history ID forward and persist it with the deferred messages.
+
+        Deferred messages the listing handed out are only forgotten here,
+        unless they were deferred again, so a listing that fails part way
+        yields them again next time.
+        """
+        for msg_id in self.handed_out - self.redeferred:
+            self.deferred.pop(msg_id, None)
+        self.handed_out, self.redeferred = set(), set()
+        if history_id:
+            self.history_id = history_id
+        self.save_state()
+
+    def iter_messages(self, label_ids, unread_only=True):
+        """Yield {'id', 'threadId'} for matching messages, incrementally when possible.
+
+        Returns the history ID to resume from. It is not stored here: the
+        caller passes it to advance() once every yielded message is saved.
+        """
+        seen = set()
+        self.handed_out, self.redeferred = set(), set()
+
+        # Messages deferred by the previous run come first
+        for msg_id, thread_id in list(self.deferred.items()):
+            seen.add(msg_id)
+            self.handed_out.add(msg_id)
+            yield {'id': msg_id, 'threadId': thread_id}
+
+        if self.mode == 'incremental' and self.history_id:
+            try:
+                new_history_id = yield from self._iter_history(label_ids, unread_only, seen)
+            except Exception as e:
+                if http_status_of(e) != 404:
+                    raise
+                # History IDs are only valid for about a week
+                print(f"History {self.history_id} has expired, falling back to full sync")
+                new_history_id = yield from self.iter_full(label_ids, unread_only, seen)
+        else:
+            new_history_id = yield from self.iter_full(label_ids, unread_only, seen)
+        return new_history_id
+
+    def _iter_history(self, label_ids, unread_only, seen):
+        """Yield messages added or labelled since the stored history ID."""
+        print(f"Incremental sync from history ID {self.history_id}")
+        wanted = set(label_ids)
+        latest_history_id = self.history_id
+        page_token = None
+        while True:
+            results = self.scheduler.execute(self.service.users().history().list(
+                userId='me',
+                startHistoryId=self.history_id,
+                historyTypes=['messageAdded', 'labelAdded'],
+                maxResults=PAGE_SIZE,
+                pageToken=page_token
+            ))
+            latest_history_id = results.get('historyId', latest_history_id)
+
+            for record in results.get('history', []):
+                changes = record.get('messagesAdded', []) + record.get('labelsAdded', [])
+                for change in changes:
+                    message = change.get('message', {})
+                    labels = set(message.get('labelIds', []))
+                    if message.get('id') in seen or not labels & wanted:
+                        continue
+                    if unread_only and 'UNREAD' not in labels:
+                        continue
+                    seen.add(message['id'])
+                    yield {'id': message['id'], 'threadId': message.get('threadId')}
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return latest_history_id
+
+    def iter_full(self, label_ids, unread_only=True, seen=None):
+        """Yield every matching message, following nextPageToken for each label."""
+        seen = set() if seen is None else seen
+        # Take the history ID before listing so changes made during the scan are picked up next time
+        profile = self.scheduler.execute(self.service.users().getProfile(userId='me'))
+        print("Running full mailbox sync")
+
+        for label_id in label_ids:
+            page_token = None
+            count = 0
+            while True:
+                results = self.scheduler.execute(self.service.users().messages().list(
+                    userId='me',
+                    labelIds=[label_id, 'UNREAD'] if unread_only else [label_id],
+                    maxResults=PAGE_SIZE,
+                    pageToken=page_token
+                ))
+                for msg in results.get('messages', []):
+                    count += 1
+                    if msg['id'] in seen:
+                        continue
+                    seen.add(msg['id'])
+                    yield msg
+
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+            print(f"\nFound {count} emails with label ID: {label_id}")
+
+        return profile.get('historyId')
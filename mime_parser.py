@@ -0,0 +1,136 @@
+import os
+import re
+import base64
+from html.parser import HTMLParser
+
+# Bodies are cut to this many characters; nothing past it is decoded
+BODY_MAX_CHARS = int(os.getenv('EMAIL_BODY_MAX_CHARS', '100000'))
+
+# Only the parts of a message the pipeline reads
+FULL_MESSAGE_FIELDS = 'id,threadId,labelIds,internalDate,payload(mimeType,filename,headers,body,parts)'
+
+CHARSET_RE = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.IGNORECASE)
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'table', 'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+
+def get_header(headers, name):
+    """Return the value of a header by case-insensitive name, or ''."""
+    name = name.lower()
+    return next((h['value'] for h in headers if h['name'].lower() == name), '')
+
+
+def _charset_of(part):
+    match = CHARSET_RE.search(get_header(part.get('headers', []), 'Content-Type'))
+    return match.group(1).strip().lower() if match else 'utf-8'
+
+
+def _is_attachment(part):
+    if part.get('filename'):
+        return True
+    disposition = get_header(part.get('headers', []), 'Content-Disposition')
+    return disposition.lower().startswith('attachment')
+
+
+def decode_part(part, max_chars=None):
+    """Decode a part's base64url body in its declared charset, decoding no more than needed."""
+    max_chars = max_chars or BODY_MAX_CHARS
+    data = part.get('body', {}).get('data', '')
+    if not data:
+        return ''
+    # Four bytes per character covers any UTF-8 text; base64 groups are four characters long
+    max_encoded = (max_chars * 4 * 4 // 3 + 3) // 4 * 4
+    raw = base64.urlsafe_b64decode(data[:max_encoded] + '=' * (-len(data[:max_encoded]) % 4))
+    charset = _charset_of(part)
+    try:
+        text = raw.decode(charset, errors='replace')
+    except LookupError:
+        text = raw.decode('utf-8', errors='replace')
+    return text[:max_chars]
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+
+def html_to_text(html):
+    """Convert HTML to plain text, keeping paragraph breaks."""
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    text = ''.join(extractor.chunks)
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def iter_parts(payload):
+    """Yield every part of a payload tree, depth first in document order."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get('parts', [])))
+
+
+def iter_attachments(payload):
+    """Yield a descriptor for each attachment part: filename, mime_type, size and attachment_id.
+
+    Small attachments Gmail returns inline also carry their base64url `data`.
+    """
+    for part in iter_parts(payload):
+        if part.get('parts') or not _is_attachment(part):
+            continue
+        body = part.get('body', {})
+        attachment = {
+            'filename': part.get('filename', ''),
+            'mime_type': part.get('mimeType', ''),
+            'size': body.get('size', 0),
+            'attachment_id': body.get('attachmentId'),
+        }
+        if body.get('data'):
+            attachment['data'] = body['data']
+        yield attachment
+
+
+def extract_body(payload, max_chars=None):
+    """Return the best plain-text body of a message payload.
+
+    The first inline text/plain part wins; otherwise the first inline
+    text/html part is converted to text.
+    """
+    html_part = None
+    for part in iter_parts(payload):
+        mime_type = part.get('mimeType', '').lower()
+        if _is_attachment(part):
+            continue
+        if mime_type == 'text/plain' and part.get('body', {}).get('data'):
+            return decode_part(part, max_chars)
+        if mime_type == 'text/html' and html_part is None and part.get('body', {}).get('data'):
+            html_part = part
+
+    if html_part is not None:
+        return html_to_text(decode_part(html_part, max_chars))[:max_chars or BODY_MAX_CHARS]
+    # Single-part messages without a declared text type
+    if not payload.get('parts') and payload.get('body', {}).get('data'):
+        return decode_part(payload, max_chars)
+    return ''
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import base64
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gmail_service import get_shared_gmail_service, refresh_credentials_if_needed
+from email_handler import EmailHandler, GMAIL_LABELS
+from ai_generator import AIGenerator
+from email_sender import EmailSender
+from streaming_pipeline import StreamingPipeline
+from rate_limiter import get_scheduler
+from priority_scheduler import get_priority_scheduler
+from cleanup_util import CleanupUtil
+from spool_watcher import WatchedPipeline, SPOOL_WATCH_SETTLE_SECONDS
+
+DAEMON_POLL_INTERVAL = int(os.getenv('DAEMON_POLL_INTERVAL', '60'))
+# Port for Pub/Sub push notifications; 0 disables the listener
+DAEMON_PUSH_PORT = int(os.getenv('DAEMON_PUSH_PORT', '0'))
+DAEMON_PUSH_HOST = os.getenv('DAEMON_PUSH_HOST', '127.0.0.1')
+# When set, the daemon asks Gmail to publish mailbox changes to this Pub/Sub topic
+GMAIL_PUBSUB_TOPIC = os.getenv('GMAIL_PUBSUB_TOPIC', '')
+# Gmail watches expire after seven days; renew well before that
+WATCH_RENEW_INTERVAL = 24 * 3600
+
+
+class PushListener:
+    """Receives Pub/Sub push notifications and wakes the daemon.
+
+    Real Pub/Sub push subscriptions POST an envelope whose message data is
+    {"emailAddress": ..., "historyId": ...}. For local use any POST works,
+    e.g. `curl -X POST http://127.0.0.1:8085/`, which stands in for Pub/Sub.
+    """
+
+    def __init__(self, on_notify, host=None, port=None):
+        self.on_notify = on_notify
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                listener.handle_payload(self.rfile.read(length))
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host or DAEMON_PUSH_HOST, port or DAEMON_PUSH_PORT), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="push-listener", daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def handle_payload(self, payload):
+        """Decode a push envelope, tolerating empty or non-Pub/Sub bodies."""
+        notification = {}
+        try:
+            envelope = json.loads(payload or b'{}')
+            data = envelope.get('message', {}).get('data')
+            if data:
+                notification = json.loads(base64.b64decode(data))
+        except Exception as e:
+            print(f"Ignoring malformed push notification: {e}")
+        self.on_notify(notification)
+
+    def start(self):
+        self.thread.start()
+        print(f"Listening for push notifications on port {self.port}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class PipelineDaemon:
+    """Runs the pipeline repeatedly with one set of authenticated clients."""
+
+    def __init__(self, mode='batch', interval=None, push_port=None, gmail_watch=True):
+        self.mode = mode
+        # Short-lived daemons, such as mailbox pool cycles, have nobody listening for pushes
+        self.gmail_watch = gmail_watch
+        self.interval = interval or DAEMON_POLL_INTERVAL
+        service = get_shared_gmail_service()
+        self.handler = EmailHandler(service)
+        self.generator = AIGenerator()
+        # Streaming and watch modes send from other threads, which need their own Gmail services
+        self.sender = EmailSender(get_shared_gmail_service('send') if mode in ('streaming', 'watch') else service,
+                                  service_factory=get_shared_gmail_service)
+        # In watch mode cycles only fetch; generation and sending follow the spools
+        self.watched = WatchedPipeline(self.generator, self.sender) if mode == 'watch' else None
+        self.scheduler = get_scheduler()
+        self.priority = get_priority_scheduler()
+        # Watch workers append to the spools while cleanup runs
+        self.cleanup = CleanupUtil(seal_idle=SPOOL_WATCH_SETTLE_SECONDS if mode == 'watch' else None)
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.watch_renewed_at = 0
+        push_port = DAEMON_PUSH_PORT if push_port is None else push_port
+        self.listener = PushListener(self.notify, port=push_port) if push_port else None
+
+    def notify(self, notification=None):
+        """Wake the daemon for an immediate cycle."""
+        history_id = (notification or {}).get('historyId')
+        print(f"Push notification received{f' (history {history_id})' if history_id else ''}")
+        self.wake_event.set()
+
+    def stop(self, *args):
+        """Stop after the current cycle."""
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def renew_watch(self):
+        """Register or renew the Gmail push watch when a Pub/Sub topic is configured."""
+        if not self.gmail_watch or not GMAIL_PUBSUB_TOPIC or time.time() - self.watch_renewed_at < WATCH_RENEW_INTERVAL:
+            return
+        try:
+            label_ids = self.handler.get_label_ids(GMAIL_LABELS)
+            self.scheduler.execute(self.handler.service.users().watch(
+                userId='me',
+                body={'topicName': GMAIL_PUBSUB_TOPIC, 'labelIds': label_ids, 'labelFilterBehavior': 'include'}
+            ))
+            self.watch_renewed_at = time.time()
+            print(f"Gmail push notifications go to {GMAIL_PUBSUB_TOPIC}")
+        except Exception as e:
+            print(f"Error registering Gmail watch: {e}")
+
+    def run_cycle(self):
+        """Fetch, generate and send once using the long-lived clients."""
+        refresh_credentials_if_needed()
+        self.renew_watch()
+        if self.mode == 'streaming':
+            StreamingPipeline(self.handler, self.generator, self.sender).run()
+        elif self.mode == 'watch':
+            self.handler.process_unread_emails()
+        else:
+            self.handler.process_unread_emails()
+            self.generator.process_pending_emails()
+            self.sender.process_pending_responses()
+        self.cleanup.cleanup_processed_files(self.handler.emails_dir, self.generator.emails_to_send_dir)
+
+    def run_forever(self):
+        """Run cycles until stopped, waking early on push notifications."""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+        if self.listener:
+            self.listener.start()
+        if self.watched:
+            self.watched.start()
+        print(f"Daemon started in {self.mode} mode, polling every {self.interval}s")
+        try:
+            while not self.stop_event.is_set():
+                started_at = time.time()
+                try:
+                    self.run_cycle()
+                except Exception as e:
+                    print(f"Error in pipeline cycle: {e}")
+                print(f"Cycle finished in {time.time() - started_at:.1f}s")
+                self.scheduler.report()
+                self.priority.report()
+                self.wake_event.wait(self.interval)
+                self.wake_event.clear()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.listener:
+                self.listener.stop()
+            if self.watched:
+                self.watched.stop()
+            print("Daemon stopped")
@@ -0,0 +1,197 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+from email.utils import parseaddr
+from label_cache import LabelRegistry
+from thread_coalescer import email_timestamp
+
+# Response-time targets in seconds per label name, most urgent label first
+PRIORITY_LABEL_TARGETS = os.getenv('PRIORITY_LABEL_TARGETS', 'Transfers=3600,Beginner=86400')
+# Target for email with none of the labels above
+PRIORITY_DEFAULT_TARGET = float(os.getenv('PRIORITY_DEFAULT_TARGET', '86400'))
+# Comma-separated addresses or @domains whose email is due within PRIORITY_SENDER_TARGET
+PRIORITY_SENDERS = os.getenv('PRIORITY_SENDERS', '')
+PRIORITY_SENDER_TARGET = float(os.getenv('PRIORITY_SENDER_TARGET', '900'))
+# Response times kept per label for the percentile report
+PRIORITY_HISTORY_SIZE = int(os.getenv('PRIORITY_HISTORY_SIZE', '1000'))
+
+OTHER_LABEL = 'other'
+# Key that sorts after every item, for the sentinels that stop workers
+LAST = (float('inf'), float('inf'))
+
+
+def parse_targets(spec):
+    """Parse 'Label=seconds,...' into a list of (label, seconds), keeping the order."""
+    targets = []
+    for entry in spec.split(','):
+        if '=' not in entry:
+            continue
+        label, seconds = entry.split('=', 1)
+        targets.append((label.strip(), float(seconds)))
+    return targets
+
+
+def format_duration(seconds):
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}h"
+    if seconds >= 60:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds:.0f}s"
+
+
+class PriorityScheduler:
+    """Orders the work of every stage by deadline and tracks response times against per-label targets.
+
+    An email's deadline is when it was received plus the tightest target
+    of its labels, or PRIORITY_SENDER_TARGET for allow-listed senders.
+    Ordering by deadline lets urgent labels overtake a backlog while old
+    email of any label still moves up as it ages. Ties go to the label
+    listed first.
+    """
+
+    def __init__(self, label_targets=None, default_target=None, senders=None, sender_target=None):
+        self.label_targets = parse_targets(PRIORITY_LABEL_TARGETS) if label_targets is None else list(label_targets)
+        self.ranks = {label: rank for rank, (label, _) in enumerate(self.label_targets)}
+        self.targets = dict(self.label_targets)
+        self.default_target = PRIORITY_DEFAULT_TARGET if default_target is None else default_target
+        senders = PRIORITY_SENDERS.split(',') if senders is None else senders
+        self.senders = {sender.strip().lower() for sender in senders if sender.strip()}
+        self.sender_target = PRIORITY_SENDER_TARGET if sender_target is None else sender_target
+        self.lock = threading.Lock()
+        self.response_times = {}
+        self.overdue = {}
+
+    def order_labels(self, label_names):
+        """Return label names with the most urgent first, so they are listed and fetched first."""
+        return sorted(label_names, key=lambda name: self.ranks.get(name, len(self.ranks)))
+
+    def _label_names(self, label_ids):
+        # Emails carry label IDs; configured labels may be given by name or by ID
+        registry = LabelRegistry.shared()
+        names = registry.names_by_id if registry else {}
+        return [names.get(label_id, label_id) for label_id in label_ids]
+
+    def is_priority_sender(self, sender):
+        address = parseaddr(sender or '')[1].lower()
+        return bool(address) and (address in self.senders or f"@{address.rpartition('@')[2]}" in self.senders)
+
+    def classify(self, item):
+        """Return (label, target seconds, rank) for an email or a response to one."""
+        email = item.get('original_email', item)
+        labels = [name for name in self._label_names(email.get('labels', [])) if name in self.targets]
+        label = min(labels, key=self.ranks.get) if labels else OTHER_LABEL
+        target = self.targets.get(label, self.default_target)
+        rank = self.ranks.get(label, len(self.ranks))
+        if self.is_priority_sender(email.get('sender')):
+            target, rank = min(target, self.sender_target), -1
+        return label, target, rank
+
+    def received_at(self, item):
+        """Return when the email behind an item was received, or now if that is unknown."""
+        return email_timestamp(item.get('original_email', item)) or time.time()
+
+    def key(self, item):
+        """Return the sort key of an email or response: its deadline, then its label rank."""
+        _, target, rank = self.classify(item)
+        return (self.received_at(item) + target, rank)
+
+    def sort(self, items):
+        """Return items in the order they should be worked on."""
+        return sorted(items, key=self.key)
+
+    def queue(self, maxsize=0):
+        return PriorityQueue(self, maxsize)
+
+    def record_done(self, item, finished_at=None):
+        """Record how long an email took from arrival to reply."""
+        label, target, _ = self.classify(item)
+        elapsed = (finished_at or time.time()) - self.received_at(item)
+        with self.lock:
+            self.response_times.setdefault(label, deque(maxlen=PRIORITY_HISTORY_SIZE)).append(elapsed)
+            if elapsed > target:
+                self.overdue[label] = self.overdue.get(label, 0) + 1
+
+    def stats(self):
+        """Return count, p95 and target per label for the replies recorded so far."""
+        with self.lock:
+            times = {label: sorted(values) for label, values in self.response_times.items()}
+            overdue = dict(self.overdue)
+        stats = {}
+        for label, values in times.items():
+            stats[label] = {
+                'count': len(values),
+                'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+                'target': self.targets.get(label, self.default_target),
+                'overdue': overdue.get(label, 0),
+            }
+        return stats
+
+    def report(self):
+        """Print how far each label's 95th-percentile response time is from its target."""
+        stats = self.stats()
+        for label in sorted(stats, key=lambda name: self.ranks.get(name, len(self.ranks))):
+            label_stats = stats[label]
+            print(f"Response time for {label}: p95 {format_duration(label_stats['p95'])} against a "
+                  f"{format_duration(label_stats['target'])} target "
+                  f"({label_stats['p95'] / label_stats['target']:.0%}), "
+                  f"{label_stats['overdue']} of {label_stats['count']} replies late")
+        return stats
+
+
+class PriorityQueue:
+    """Thread-safe bounded heap that hands out the most urgent item first.
+
+    It has the put/get interface of queue.Queue, so stages can swap it in;
+    a full queue blocks put, which keeps the backpressure between stages.
+    """
+
+    def __init__(self, scheduler, maxsize=0):
+        self.scheduler = scheduler
+        self.maxsize = maxsize
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def put(self, item, key=None):
+        """Add an item, ordered by `key` or by the scheduler's key for it."""
+        key = self.scheduler.key(item) if key is None else key
+        with self.condition:
+            while self.maxsize and len(self.heap) >= self.maxsize:
+                self.condition.wait()
+            heapq.heappush(self.heap, (key, next(self.counter), item))
+            self.condition.notify_all()
+
+    def put_last(self, item):
+        """Add an item that comes after everything else, such as a stop sentinel."""
+        self.put(item, LAST)
+
+    def get(self):
+        with self.condition:
+            while not self.heap:
+                self.condition.wait()
+            item = heapq.heappop(self.heap)[2]
+            self.condition.notify_all()
+            return item
+
+    def qsize(self):
+        with self.condition:
+            return len(self.heap)
+
+    def empty(self):
+        return not self.qsize()
+
+
+_priority_scheduler = None
+_priority_scheduler_lock = threading.Lock()
+
+
+def get_priority_scheduler():
+    """Return the process-wide priority scheduler."""
+    global _priority_scheduler
+    with _priority_scheduler_lock:
+        if _priority_scheduler is None:
+            _priority_scheduler = PriorityScheduler()
+        return _priority_scheduler
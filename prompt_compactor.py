@@ -0,0 +1,140 @@
+import os
+import re
+import threading
+from rate_limiter import estimate_tokens
+from response_cache import find_signature
+from thread_coalescer import join_bodies
+
+PROMPT_COMPACTION_ENABLED = os.getenv('PROMPT_COMPACTION_ENABLED', '1') == '1'
+# Maximum tokens of email body sent to the model
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '1500'))
+# tiktoken encoding used for counting when tiktoken is installed
+PROMPT_TOKENIZER_ENCODING = os.getenv('PROMPT_TOKENIZER_ENCODING', 'o200k_base')
+TRUNCATION_MARKER = '\n[...truncated]'
+
+# Lines that start the quoted copy of an earlier message
+REPLY_HEADER_RE = re.compile(
+    r'^\s*(on\b.{0,200}\bwrote:|-{2,}\s*original message\s*-{2,}|_{10,})\s*$',
+    re.IGNORECASE
+)
+FORWARD_HEADER_RE = re.compile(r'^\s*-{2,}\s*forwarded message\s*-{2,}\s*$', re.IGNORECASE)
+SIGNATURE_DELIMITER_RE = re.compile(r'^--\s*$')
+DISCLAIMER_RE = re.compile(
+    r'^\s*(sent from my \w+|confidentiality notice|disclaimer|this (e-?mail|message) and any attachments)',
+    re.IGNORECASE
+)
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """Return the tiktoken encoding, or None when tiktoken is not installed."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER_ENCODING)
+        except Exception as e:
+            print(f"tiktoken unavailable ({e}); prompt token counts are estimates")
+            _encoding = None
+        _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Count tokens with tiktoken if available, otherwise estimate them."""
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text or '', disallowed_special=()))
+
+
+def truncate_to_tokens(text, budget):
+    """Cut text to at most `budget` tokens, marking the cut."""
+    if count_tokens(text) <= budget:
+        return text
+    encoding = _get_encoding()
+    if encoding is None:
+        text = text[:budget * 4]
+    else:
+        text = encoding.decode(encoding.encode(text, disallowed_special=())[:budget])
+    return text.rstrip() + TRUNCATION_MARKER
+
+
+def strip_quoted(body):
+    """Drop quoted replies and, when the sender wrote something above it, forwarded history."""
+    kept = []
+    for line in body.splitlines():
+        if REPLY_HEADER_RE.match(line):
+            break
+        # A forward with nothing written above it is the message itself
+        if FORWARD_HEADER_RE.match(line) and any(l.strip() for l in kept):
+            break
+        if line.lstrip().startswith('>'):
+            continue
+        kept.append(line)
+    return '\n'.join(kept)
+
+
+def strip_signature(body):
+    """Drop the signature, sign-off and mail-client disclaimers from the end of a body."""
+    lines = body.rstrip().splitlines()
+    for index, line in enumerate(lines):
+        if SIGNATURE_DELIMITER_RE.match(line) or (index and DISCLAIMER_RE.match(line)):
+            lines = lines[:index]
+            break
+    index = find_signature(lines)
+    if index is not None:
+        lines = lines[:index]
+    return '\n'.join(lines)
+
+
+def collapse_whitespace(text):
+    """Collapse runs of spaces and blank lines."""
+    text = re.sub(r'[ \t\f\v\xa0]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+class PromptCompactor:
+    """Shrinks email bodies before generation and keeps token savings statistics."""
+
+    def __init__(self, budget=None):
+        self.budget = budget or PROMPT_TOKEN_BUDGET
+        self.lock = threading.Lock()
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.emails = 0
+
+    def strip_text(self, body):
+        """Return the body without quoted history, signature and extra whitespace."""
+        text = collapse_whitespace(strip_signature(strip_quoted(body or '')))
+        # Keep the original if stripping removed everything
+        return text or collapse_whitespace(body or '')
+
+    def compact_text(self, body):
+        """Return the compacted body text."""
+        return truncate_to_tokens(self.strip_text(body), self.budget)
+
+    def compact(self, email_content):
+        """Return a copy of an email with its body compacted, reporting the token counts."""
+        body = email_content.get('body') or ''
+        if email_content.get('messages'):
+            # Coalesced emails are stripped message by message, then trimmed as a whole
+            stripped = [dict(message, body=self.strip_text(message['body'])) for message in email_content['messages']]
+            compacted = truncate_to_tokens(join_bodies(stripped), self.budget)
+        else:
+            compacted = self.compact_text(body)
+        before, after = count_tokens(body), count_tokens(compacted)
+        with self.lock:
+            self.tokens_before += before
+            self.tokens_after += after
+            self.emails += 1
+        print(f"Prompt for email {email_content['id']}: {before} -> {after} tokens")
+        return dict(email_content, body=compacted)
+
+    def stats(self):
+        """Return total tokens before and after compaction."""
+        with self.lock:
+            return {'emails': self.emails, 'tokens_before': self.tokens_before, 'tokens_after': self.tokens_after}
@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import threading
+
+# Gmail allows 250 quota units per user per second
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv('GMAIL_QUOTA_UNITS_PER_SECOND', '250'))
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = float(os.getenv('OPENAI_TOKENS_PER_MINUTE', '200000'))
+# Completion tokens reserved per generation on top of the estimated prompt size
+OPENAI_EXPECTED_COMPLETION_TOKENS = int(os.getenv('OPENAI_EXPECTED_COMPLETION_TOKENS', '500'))
+API_MAX_RETRIES = int(os.getenv('API_MAX_RETRIES', '5'))
+RETRY_BASE_DELAY = float(os.getenv('API_RETRY_BASE_DELAY', '1.0'))
+RETRY_MAX_DELAY = float(os.getenv('API_RETRY_MAX_DELAY', '60.0'))
+
+# Quota units charged per Gmail method; anything unlisted costs DEFAULT_GMAIL_UNITS
+GMAIL_METHOD_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.labels.list': 1,
+    'gmail.users.labels.get': 1,
+    'gmail.users.labels.create': 5,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.modify': 5,
+    'gmail.users.messages.attachments.get': 5,
+    'gmail.users.messages.batchModify': 50,
+    'gmail.users.messages.send': 100,
+    'gmail.users.threads.get': 10,
+    'gmail.users.watch': 100,
+}
+DEFAULT_GMAIL_UNITS = 5
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Thread-safe token bucket that reserves tokens up front and sleeps off any deficit."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.waits = 0
+        self.acquired = 0
+
+    def acquire(self, amount=1):
+        """Take tokens, blocking until the bucket can cover them; returns seconds waited."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.acquired += amount
+            if wait:
+                self.waited += wait
+                self.waits += 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def http_status_of(error):
+    """Return the HTTP status of a Gmail or OpenAI error, or 0."""
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'resp', None), 'status', 0)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return 0
+
+
+def retry_after_of(error):
+    """Return the Retry-After delay in seconds carried by an error, if any."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if headers is None:
+        # httplib2 responses are dicts with lower-cased header names
+        headers = getattr(error, 'resp', None)
+    try:
+        value = headers.get('retry-after') if headers is not None else None
+        return float(value) if value is not None else None
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def is_retryable(error):
+    """Check whether an API error is worth retrying."""
+    status = http_status_of(error)
+    if status in RETRYABLE_STATUSES:
+        return True
+    # Gmail reports per-user rate limiting as 403 rateLimitExceeded
+    if status == 403 and b'ratelimitexceeded' in (getattr(error, 'content', b'') or b'').lower():
+        return True
+    # Network failures from the OpenAI SDK carry no status
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError')
+
+
+class CallScheduler:
+    """Shared rate limiting and retry policy for every Gmail and OpenAI call."""
+
+    def __init__(self, gmail_units_per_second=None, openai_rpm=None, openai_tpm=None, max_retries=None):
+        gmail_rate = gmail_units_per_second or GMAIL_QUOTA_UNITS_PER_SECOND
+        self.gmail_bucket = TokenBucket(gmail_rate)
+        self.openai_requests = TokenBucket((openai_rpm or OPENAI_REQUESTS_PER_MINUTE) / 60.0,
+                                           openai_rpm or OPENAI_REQUESTS_PER_MINUTE)
+        self.openai_tokens = TokenBucket((openai_tpm or OPENAI_TOKENS_PER_MINUTE) / 60.0,
+                                         openai_tpm or OPENAI_TOKENS_PER_MINUTE)
+        self.max_retries = API_MAX_RETRIES if max_retries is None else max_retries
+        self.stats_lock = threading.Lock()
+        self.retries = 0
+        self.backoff_waited = 0.0
+
+    def backoff(self, attempt, error):
+        """Sleep before a retry, honouring Retry-After, otherwise full-jitter exponential backoff."""
+        delay = retry_after_of(error)
+        if delay is None:
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+        with self.stats_lock:
+            self.retries += 1
+            self.backoff_waited += delay
+        print(f"Retrying after {delay:.1f}s (attempt {attempt + 1}): {error}")
+        time.sleep(delay)
+
+    def _call(self, acquire, fn, max_retries):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        for attempt in range(max_retries + 1):
+            acquire()
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= max_retries or not is_retryable(e):
+                    raise
+                self.backoff(attempt, e)
+
+    def gmail_units(self, request):
+        """Return the quota cost of a Gmail request."""
+        return GMAIL_METHOD_UNITS.get(getattr(request, 'methodId', None), DEFAULT_GMAIL_UNITS)
+
+    def execute(self, request, units=None, max_retries=None):
+        """Execute a Gmail request (or batch) within the per-user quota, retrying transient errors."""
+        units = self.gmail_units(request) if units is None else units
+        return self._call(lambda: self.gmail_bucket.acquire(units), request.execute, max_retries)
+
+    def call_openai(self, fn, *args, estimated_tokens=0, max_retries=None, **kwargs):
+        """Call an OpenAI SDK method within the request and token limits, retrying transient errors."""
+        def acquire():
+            self.openai_requests.acquire(1)
+            if estimated_tokens:
+                self.openai_tokens.acquire(estimated_tokens)
+        return self._call(acquire, lambda: fn(*args, **kwargs), max_retries)
+
+    def stats(self):
+        """Return how much calls have waited on each limit and on retries."""
+        return {
+            'gmail_units': self.gmail_bucket.acquired,
+            'gmail_wait_seconds': self.gmail_bucket.waited,
+            'openai_requests': self.openai_requests.acquired,
+            'openai_request_wait_seconds': self.openai_requests.waited,
+            'openai_tokens': self.openai_tokens.acquired,
+            'openai_token_wait_seconds': self.openai_tokens.waited,
+            'retries': self.retries,
+            'retry_wait_seconds': self.backoff_waited,
+        }
+
+    def report(self):
+        """Print a one-line summary of rate limiting and retries."""
+        stats = self.stats()
+        print(f"API usage: {stats['gmail_units']} Gmail units (waited {stats['gmail_wait_seconds']:.1f}s), "
+              f"{stats['openai_requests']} OpenAI requests (waited {stats['openai_request_wait_seconds']:.1f}s), "
+              f"{stats['openai_tokens']} OpenAI tokens (waited {stats['openai_token_wait_seconds']:.1f}s), "
+              f"{stats['retries']} retries (waited {stats['retry_wait_seconds']:.1f}s)")
+        return stats
+
+
+def estimate_tokens(text):
+    """Rough token count for rate limiting: about four characters per token."""
+    return len(text or '') // 4 + 1
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide call scheduler."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = CallScheduler()
+        return _scheduler
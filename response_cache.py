@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))
+# 'label' keeps separate answers per Gmail label, 'global' shares them across labels
+RESPONSE_CACHE_SCOPE = os.getenv('RESPONSE_CACHE_SCOPE', 'label')
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', os.path.join('State', 'response_cache.json'))
+# Emails with less text than this after normalization are too generic to reuse an answer for
+MIN_NORMALIZED_LENGTH = 20
+
+SUBJECT_PREFIX_RE = re.compile(r'^\s*((re|fw|fwd|aw)\s*:\s*)+', re.IGNORECASE)
+GREETING_RE = re.compile(r'^\s*(hi|hello|hey|dear|good (morning|afternoon|evening)|greetings)\b[^\n]*\n', re.IGNORECASE)
+SIGNATURE_RE = re.compile(
+    r'^\s*(--|(thanks|thank you|many thanks|best|best regards|kind regards|regards|sincerely|cheers)\b.{0,30})\s*$',
+    re.IGNORECASE
+)
+# Signatures are only looked for in the last few lines of the body
+SIGNATURE_SEARCH_LINES = 6
+# A sign-off may only be followed by this many short lines, such as a name and a student ID
+SIGNATURE_NAME_LINES = 3
+NAME_LINE_RE = re.compile(r'^\s*[^\s?!:;]*(\s+[^\s?!:;]+){0,4}\s*$')
+NON_WORD_RE = re.compile(r'[^\w]+')
+
+# System labels carry no meaning for which answer applies
+SYSTEM_LABELS = {'INBOX', 'UNREAD', 'IMPORTANT', 'STARRED', 'SENT', 'DRAFT', 'SPAM', 'TRASH'}
+
+
+def find_signature(lines):
+    """Return the index of the line where a trailing sign-off starts, or None.
+
+    A sign-off only counts after the first line and when nothing but a
+    few short name-like lines follow it, so an email opening with
+    "Thanks for the quick reply" keeps the question after it.
+    """
+    for index in range(max(len(lines) - SIGNATURE_SEARCH_LINES, 1), len(lines)):
+        if not SIGNATURE_RE.match(lines[index]):
+            continue
+        if lines[index].strip().startswith('--'):
+            return index
+        following = [line for line in lines[index + 1:] if line.strip()]
+        if len(following) <= SIGNATURE_NAME_LINES and all(NAME_LINE_RE.match(line) for line in following):
+            return index
+    return None
+
+
+def normalize_email_text(subject, body):
+    """Reduce subject and body to the words that decide the answer."""
+    subject = SUBJECT_PREFIX_RE.sub('', subject or '')
+    body = GREETING_RE.sub('', (body or '').strip() + '\n', count=1)
+    lines = body.splitlines()
+    index = find_signature(lines)
+    if index is not None:
+        lines = lines[:index]
+    body = '\n'.join(lines)
+    text = f"{subject} {body}".lower()
+    return NON_WORD_RE.sub(' ', text).strip()
+
+
+class ResponseCache:
+    """LRU/TTL cache of generated responses keyed on normalized email content."""
+
+    def __init__(self, max_entries=None, ttl=None, scope=None, cache_path=None):
+        self.max_entries = max_entries or RESPONSE_CACHE_MAX_ENTRIES
+        self.ttl = RESPONSE_CACHE_TTL if ttl is None else ttl
+        self.scope = scope or RESPONSE_CACHE_SCOPE
+        self.cache_path = RESPONSE_CACHE_PATH if cache_path is None else cache_path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        """Load unexpired entries from disk."""
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            now = time.time()
+            for key, entry in entries:
+                if now - entry['created_at'] <= self.ttl:
+                    self.entries[key] = entry
+        except Exception as e:
+            print(f"Error loading response cache from {self.cache_path}: {e}")
+
+    def save(self):
+        """Persist entries to disk in LRU order."""
+        if not self.cache_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            with self.lock:
+                entries = list(self.entries.items())
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            print(f"Error saving response cache: {e}")
+
+    def make_key(self, email_content):
+        """Return the cache key for an email, or None if it should not be cached."""
+        text = normalize_email_text(email_content.get('subject'), email_content.get('body'))
+        if len(text) < MIN_NORMALIZED_LENGTH:
+            return None
+        scope = ''
+        if self.scope == 'label':
+            labels = [label for label in email_content.get('labels', [])
+                      if label not in SYSTEM_LABELS and not label.startswith('CATEGORY_')]
+            scope = ','.join(sorted(labels))
+        return hashlib.sha256(f"{scope}\n{text}".encode('utf-8')).hexdigest()
+
+    def get(self, email_content):
+        """Return a cached response for an email, or None."""
+        key = self.make_key(email_content)
+        with self.lock:
+            entry = self.entries.get(key) if key else None
+            if entry and time.time() - entry['created_at'] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['response']
+
+    def put(self, email_content, response_content):
+        """Store a response, evicting the least recently used entries beyond the size limit."""
+        key = self.make_key(email_content)
+        if not key:
+            return
+        with self.lock:
+            self.entries[key] = {'response': response_content, 'created_at': time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Return hit/miss counters."""
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self.entries)
+        }
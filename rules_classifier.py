@@ -0,0 +1,115 @@
+import os
+import re
+import json
+import threading
+from collections import Counter
+
+# JSON rules file; when it does not exist every email goes to the model
+EMAIL_RULES_PATH = os.getenv('EMAIL_RULES_PATH', 'rules.json')
+RULE_FIELDS = ('sender', 'subject', 'body')
+
+
+class _Defaults(dict):
+    def __missing__(self, key):
+        return ''
+
+
+def _compile_patterns(patterns, is_regex):
+    """Join a field's patterns into one alternation; keywords match as whole words across any spacing."""
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    alternatives = patterns if is_regex else [r'\b' + re.escape(pattern).replace(r'\ ', r'\s+') + r'\b'
+                                              for pattern in patterns]
+    return '|'.join(f'(?:{alternative})' for alternative in alternatives)
+
+
+class Rule:
+    """One rule: every listed field must match one of its patterns."""
+
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.label = spec.get('label')
+        self.reply = spec.get('reply')
+        if not self.label and not self.reply:
+            raise ValueError(f"Rule {self.name} has neither a label nor a reply")
+        self.sources = {field: _compile_patterns(patterns, spec.get('regex', False))
+                        for field, patterns in spec.get('match', {}).items()}
+        unknown = set(self.sources) - set(RULE_FIELDS)
+        if unknown or not self.sources:
+            raise ValueError(f"Rule {self.name} must match on {', '.join(RULE_FIELDS)}")
+        self.patterns = {field: re.compile(source, re.IGNORECASE) for field, source in self.sources.items()}
+
+    def matches(self, fields):
+        return all(pattern.search(fields[field]) for field, pattern in self.patterns.items())
+
+    def response(self, email_content):
+        """Build the response text in the same form the model produces."""
+        reply = self.reply.format_map(_Defaults(email_content)) if self.reply else ''
+        return f"${self.label}${reply}" if self.label else reply
+
+
+class RulesClassifier:
+    """Answers emails matching a local rule without calling the model.
+
+    Rules are tried in file order. Each field is first checked against one
+    regex combining every rule's patterns for it, so most emails are
+    rejected with a single search per field.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.prefilters = {}
+        for field in RULE_FIELDS:
+            sources = [rule.sources[field] for rule in rules if field in rule.sources]
+            if sources:
+                self.prefilters[field] = re.compile('|'.join(f'(?:{source})' for source in sources), re.IGNORECASE)
+        self.lock = threading.Lock()
+        self.hits = Counter()
+        self.evaluated = 0
+
+    @classmethod
+    def from_file(cls, path=None):
+        """Load rules from a JSON file, returning None if the file does not exist."""
+        path = path or EMAIL_RULES_PATH
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            specs = json.load(f)
+        rules = [Rule(spec) for spec in specs.get('rules', [])]
+        print(f"Loaded {len(rules)} email rules from {path}")
+        return cls(rules)
+
+    def classify(self, email_content):
+        """Return (rule, response text) for the first matching rule, or None."""
+        fields = {field: email_content.get(field) or '' for field in RULE_FIELDS}
+        matched_fields = {field for field, prefilter in self.prefilters.items() if prefilter.search(fields[field])}
+        rule = None
+        if matched_fields:
+            rule = next((rule for rule in self.rules
+                         if set(rule.patterns) <= matched_fields and rule.matches(fields)), None)
+        with self.lock:
+            self.evaluated += 1
+            if rule:
+                self.hits[rule.name] += 1
+        if rule is None:
+            return None
+        print(f"Email {email_content['id']} matched rule '{rule.name}'")
+        return rule, rule.response(email_content)
+
+    def stats(self):
+        """Return the number of emails evaluated and the hits per rule."""
+        with self.lock:
+            return {'evaluated': self.evaluated, 'hits': dict(self.hits)}
+
+    def report(self):
+        """Print the hit rate of each rule."""
+        stats = self.stats()
+        if not stats['evaluated']:
+            return stats
+        total_hits = sum(stats['hits'].values())
+        print(f"Rules answered {total_hits} of {stats['evaluated']} emails "
+              f"({total_hits / stats['evaluated']:.0%})")
+        for rule in self.rules:
+            hits = stats['hits'].get(rule.name, 0)
+            print(f"  {rule.name}: {hits} hits ({hits / stats['evaluated']:.0%})")
+        return stats
@@ -2,11 +2,17 @@ from email_handler import EmailHandler
 from ai_generator import AIGenerator
 from email_sender import EmailSender
 from cleanup_util import CleanupUtil
+from streaming_pipeline import StreamingPipeline
+from pipeline_daemon import PipelineDaemon
+from mailbox_pool import MailboxPool
+from rate_limiter import get_scheduler
+from priority_scheduler import get_priority_scheduler
+import argparse
+import os
 import time
 
-def main():
-    print("\n=== Starting Email Processing Pipeline ===\n")
-    
+def run_batch():
+    """Run fetch, generate and send as consecutive phases."""
     # Step 1: Fetch new emails
     print("Step 1: Fetching new emails...")
     handler = EmailHandler()
@@ -24,12 +30,59 @@ def main():
     sender = EmailSender()
     num_sent = sender.process_pending_responses()
     print(f"Sent {num_sent} responses\n")
+
+def run_streaming():
+    """Run fetch, generate and send as overlapping stages."""
+    print("Running fetch, generate and send as a streaming pipeline...")
+    pipeline = StreamingPipeline(EmailHandler(), AIGenerator(), EmailSender())
+    pipeline.run()
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the email processing pipeline.")
+    parser.add_argument('--mode', choices=['batch', 'streaming', 'watch'],
+                        default=os.getenv('PIPELINE_MODE', 'batch'),
+                        help="batch runs the stages one after another; streaming overlaps them; "
+                             "watch generates and sends as soon as records reach the spools (always a daemon)")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running, reusing authenticated clients between cycles")
+    parser.add_argument('--interval', type=int, default=None,
+                        help="seconds between daemon cycles (default DAEMON_POLL_INTERVAL)")
+    parser.add_argument('--mailboxes', nargs='?', const='', default=None, metavar='PATH',
+                        help="serve every mailbox in PATH (default MAILBOXES_PATH) across worker processes")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes for --mailboxes (default MAILBOX_WORKERS, or one per core)")
+    parser.add_argument('--authorize', metavar='NAME', default=None,
+                        help="with --mailboxes, sign in to mailbox NAME and save its token, then exit")
+    args = parser.parse_args()
+
+    if args.mailboxes is not None:
+        pool = MailboxPool.from_file(args.mailboxes or None, workers=args.workers,
+                                     mode=args.mode, interval=args.interval)
+        if args.authorize:
+            pool.authorize(args.authorize)
+        else:
+            pool.run(once=not args.daemon)
+        return
+
+    if args.daemon or args.mode == 'watch':
+        PipelineDaemon(mode=args.mode, interval=args.interval).run_forever()
+        return
+
+    print("\n=== Starting Email Processing Pipeline ===\n")
+
+    if args.mode == 'streaming':
+        run_streaming()
+    else:
+        run_batch()
+    get_scheduler().report()
+    get_priority_scheduler().report()
     
     # Step 4: Cleanup
     print("Step 4: Cleaning up...")
     cleanup = CleanupUtil()
     
-    # Delete processed emails and responses
+    # Delete processed emails and responses under the retention policy
     cleanup.cleanup_processed_files('Emails_Received', 'Emails_To_Send')
     
     # Remove test files
@@ -0,0 +1,244 @@
+import os
+import re
+import json
+import mmap
+import time
+import threading
+from state_store import StateStore, SENT, IN_FLIGHT_STATES
+
+# Segments are sealed and a new one started once they reach this size
+SPOOL_SEGMENT_MAX_BYTES = int(os.getenv('SPOOL_SEGMENT_MAX_BYTES', str(16 * 1024 * 1024)))
+# Sealed segments with at least this share of sent records are rewritten during compaction
+SPOOL_COMPACT_DEAD_RATIO = float(os.getenv('SPOOL_COMPACT_DEAD_RATIO', '0.5'))
+
+# A record reference is "<segment path>#<offset>:<length>"
+REF_RE = re.compile(r'^(?P<path>.+\.jsonl)#(?P<offset>\d+):(?P<length>\d+)$')
+
+_maps = {}
+_maps_lock = threading.Lock()
+
+
+def is_spool_ref(ref):
+    """Check whether a stored path is a spool record reference rather than a JSON file."""
+    return bool(ref and REF_RE.match(ref))
+
+
+def _read_segment(path, offset, length):
+    """Return bytes of a segment through a cached read-only mmap, remapping it once it has grown.
+
+    The slice is taken under the lock, because a remap or compaction
+    closes the old map.
+    """
+    with _maps_lock:
+        mapped = _maps.get(path)
+        if mapped is None or len(mapped) < offset + length:
+            if mapped is not None:
+                mapped.close()
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _maps[path] = mapped
+        return mapped[offset:offset + length]
+
+
+def _forget_segment(path):
+    with _maps_lock:
+        mapped = _maps.pop(path, None)
+        if mapped is not None:
+            mapped.close()
+
+
+def read_record(ref):
+    """Load a record from a spool reference, or from a legacy per-email JSON file."""
+    match = REF_RE.match(ref)
+    if not match:
+        with open(ref, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    offset, length = int(match['offset']), int(match['length'])
+    return json.loads(_read_segment(match['path'], offset, length))
+
+
+def iter_segment(path):
+    """Yield (offset, length, record) for every complete record in a segment."""
+    if not os.path.getsize(path):
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        offset = 0
+        while offset < len(mapped):
+            end = mapped.find(b'\n', offset)
+            if end < 0:
+                break
+            try:
+                yield offset, end - offset, json.loads(mapped[offset:end])
+            except ValueError:
+                print(f"Skipping unreadable record at {path}#{offset}")
+            offset = end + 1
+
+
+class SegmentedSpool:
+    """Append-only JSONL log split into numbered segments.
+
+    Each record is one line; its reference (segment, offset, length) is kept
+    in the state index, so readers map the segment and read the record
+    without scanning.
+    """
+
+    _spools = {}
+    _spools_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, directory, name, key='id'):
+        """Return the shared spool for a directory, opening it on first use."""
+        with cls._spools_lock:
+            spool = cls._spools.get((directory, name))
+            if spool is None:
+                spool = cls(directory, name, key)
+                cls._spools[(directory, name)] = spool
+            return spool
+
+    def __init__(self, directory, name, key='id', segment_max_bytes=None):
+        self.directory = directory
+        self.name = name
+        self.key = key
+        self.segment_max_bytes = segment_max_bytes or SPOOL_SEGMENT_MAX_BYTES
+        self.lock = threading.Lock()
+        self.file = None
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self._open_segment(self._sequence_of(segments[-1]) if segments else 1)
+
+    def _segment_path(self, sequence):
+        return os.path.join(self.directory, f"{self.name}-{sequence:06d}.jsonl")
+
+    def _sequence_of(self, path):
+        return int(os.path.basename(path)[len(self.name) + 1:-len('.jsonl')])
+
+    def segments(self):
+        """Return the paths of all segments, oldest first."""
+        pattern = re.compile(rf'^{re.escape(self.name)}-\d{{6}}\.jsonl$')
+        with os.scandir(self.directory) as it:
+            return sorted(entry.path for entry in it if pattern.match(entry.name))
+
+    def _open_segment(self, sequence):
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        self.active_path = self._segment_path(sequence)
+        self.file = open(self.active_path, 'ab')
+        # Drop a record left half-written by a crash
+        size = self.file.tell()
+        if size:
+            with open(self.active_path, 'rb') as f:
+                f.seek(max(size - 1, 0))
+                if f.read(1) != b'\n':
+                    f.seek(0)
+                    data = f.read()
+                    self.file.truncate(data.rfind(b'\n') + 1)
+                    self.file.seek(0, os.SEEK_END)
+
+    def append(self, record):
+        """Append a record and return its reference."""
+        data = json.dumps(record, ensure_ascii=False).encode('utf-8')
+        with self.lock:
+            if self.file.tell() >= self.segment_max_bytes:
+                self._open_segment(self._sequence_of(self.active_path) + 1)
+            offset = self.file.tell()
+            self.file.write(data + b'\n')
+            self.file.flush()
+            return f"{self.active_path}#{offset}:{len(data)}"
+
+    def seal(self, idle_seconds=0):
+        """Start a new segment so the active one can be compacted.
+
+        Nothing happens if the active segment is empty or was written to
+        less than `idle_seconds` ago. Appends hold the lock, so every
+        record in a sealed segment was written before the check. Returns
+        whether the segment was sealed.
+        """
+        with self.lock:
+            if not self.file.tell() or time.time() - os.path.getmtime(self.active_path) < idle_seconds:
+                return False
+            self._open_segment(self._sequence_of(self.active_path) + 1)
+            return True
+
+    def _split(self, path, is_live):
+        """Return the live and dead records of a segment."""
+        live, dead = [], []
+        for offset, length, record in iter_segment(path):
+            (live if is_live(record[self.key], f"{path}#{offset}:{length}") else dead).append(record)
+        return live, dead
+
+    def compact(self, is_live, relocate, on_drop=None, should_stop=None, dead_ratio=None, seal_idle=None):
+        """Drop records that are no longer needed from sealed segments, oldest first.
+
+        `is_live(record_id, ref)` decides what is kept; older copies of a
+        record that was written again are dropped by it as well. Segments
+        with no live records are deleted; segments where at least
+        `dead_ratio` of the records are dead have their live records
+        appended to the active segment, reported through
+        `relocate(record_id, new_ref)`, and are then deleted. Dropped
+        records are passed to `on_drop`, and `should_stop()` is checked
+        before each segment. When `seal_idle` is given, the active segment
+        is sealed first if it would be compacted and has been idle that
+        many seconds; otherwise nothing leaves a segment until it fills.
+        Returns (segments removed, records dropped).
+        """
+        dead_ratio = SPOOL_COMPACT_DEAD_RATIO if dead_ratio is None else dead_ratio
+
+        def worth_compacting(live, dead):
+            return bool(dead) and (not live or len(dead) / (len(live) + len(dead)) >= dead_ratio)
+
+        if seal_idle is not None and worth_compacting(*self._split(self.active_path, is_live)):
+            self.seal(seal_idle)
+        removed = dropped = 0
+        for path in self.segments():
+            if should_stop and should_stop():
+                break
+            if path == self.active_path:
+                continue
+            live, dead = self._split(path, is_live)
+            if not worth_compacting(live, dead):
+                continue
+            for record in live:
+                relocate(record[self.key], self.append(record))
+            if on_drop:
+                on_drop(dead)
+            _forget_segment(path)
+            os.remove(path)
+            removed += 1
+            dropped += len(dead)
+        return removed, dropped
+
+def compact_pipeline_spools(emails_dir='Emails_Received', responses_dir='Emails_To_Send', state=None,
+                            is_expired=None, on_drop=None, should_stop=None, dead_ratio=None, seal_idle=None):
+    """Compact the email and response spools.
+
+    By default records of emails whose reply was sent are dropped;
+    `is_expired(row)` replaces that test with a retention policy. Emails
+    still in the pipeline are never dropped, whatever the policy says.
+    `seal_idle` lets the active segments be compacted too, see
+    SegmentedSpool.compact.
+    """
+    state = state or StateStore.for_path()
+    is_expired = is_expired or (lambda row: row['state'] == SENT)
+
+    def is_live(column):
+        def check(email_id, ref):
+            row = state.get(email_id)
+            if row is None or row[column] != ref:
+                return False
+            return row['state'] in IN_FLIGHT_STATES or not is_expired(row)
+        return check
+
+    emails = SegmentedSpool.for_directory(emails_dir, 'emails')
+    responses = SegmentedSpool.for_directory(responses_dir, 'responses', key='email_id')
+    email_result = emails.compact(is_live('email_path'),
+                                  lambda email_id, ref: state.relocate(email_id, email_path=ref),
+                                  on_drop, should_stop, dead_ratio, seal_idle)
+    response_result = responses.compact(is_live('response_path'),
+                                        lambda email_id, ref: state.relocate(email_id, response_path=ref),
+                                        on_drop, should_stop, dead_ratio, seal_idle)
+    removed, dropped = email_result[0] + response_result[0], email_result[1] + response_result[1]
+    if removed:
+        print(f"Spool compaction removed {removed} segments and {dropped} records")
+    return removed, dropped
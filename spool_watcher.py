@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from state_store import StateStore, FETCHED, GENERATED, IN_FLIGHT_STATES
+from spool_log import read_record
+from thread_coalescer import coalesce_emails, COALESCE_ENABLED
+from priority_scheduler import get_priority_scheduler
+
+# auto uses inotify where the platform has it and polls everywhere else
+SPOOL_WATCH_BACKEND = os.getenv('SPOOL_WATCH_BACKEND', 'auto')
+# Seconds between polls, and between retries of records whose state is not recorded yet
+SPOOL_WATCH_POLL_INTERVAL = float(os.getenv('SPOOL_WATCH_POLL_INTERVAL', '0.5'))
+# Records whose state never catches up within this many seconds are left for the next startup
+SPOOL_WATCH_SETTLE_SECONDS = float(os.getenv('SPOOL_WATCH_SETTLE_SECONDS', '30'))
+WATCH_SEND_WORKERS = int(os.getenv('WATCH_SEND_WORKERS', os.getenv('SEND_CONCURRENCY', '4')))
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Tells a worker to stop
+_DONE = object()
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes; raises OSError where inotify is unavailable."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available on this platform")
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add_watch(self, directory, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+        self.watches[wd] = directory
+
+    def read_events(self, timeout):
+        """Wait up to `timeout` seconds and return [(directory, name, mask)] for pending events."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((self.watches.get(wd), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SpoolWatcher:
+    """Follows spool segments as they are appended and hands each new record to a callback.
+
+    Only the bytes written since the last read are parsed, so new records
+    are seen within milliseconds under inotify (or one poll interval
+    otherwise) without rereading the spool. Records already on disk when
+    watching starts are not reported; they are loaded from the state index.
+    """
+
+    def __init__(self, backend=None, poll_interval=None):
+        self.backend = backend or SPOOL_WATCH_BACKEND
+        self.poll_interval = poll_interval or SPOOL_WATCH_POLL_INTERVAL
+        self.spools = {}
+        self.offsets = {}
+        self.inotify = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add(self, directory, name, on_records):
+        """Watch a spool; `on_records` receives a list of (ref, record) per read."""
+        os.makedirs(directory, exist_ok=True)
+        self.spools[directory] = (name, on_records)
+        for path in self._segments(directory):
+            self.offsets[path] = os.path.getsize(path)
+
+    def _segments(self, directory):
+        name = self.spools[directory][0]
+        with os.scandir(directory) as it:
+            return sorted(entry.path for entry in it
+                          if entry.name.startswith(f"{name}-") and entry.name.endswith('.jsonl'))
+
+    def _read_new(self, path):
+        """Return (ref, record) for records completed in a segment since the last read."""
+        offset = self.offsets.get(path, 0)
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            # Removed by compaction
+            self.offsets.pop(path, None)
+            return []
+        # A record still being written is picked up by the next event
+        end = data.rfind(b'\n') + 1
+        records = []
+        position = 0
+        while position < end:
+            line_end = data.index(b'\n', position)
+            try:
+                records.append((f"{path}#{offset + position}:{line_end - position}",
+                                json.loads(data[position:line_end])))
+            except ValueError:
+                print(f"Skipping unreadable record at {path}#{offset + position}")
+            position = line_end + 1
+        self.offsets[path] = offset + end
+        return records
+
+    def _scan(self, directory, names=None):
+        """Read new records from the changed segments of one spool."""
+        spool_name, on_records = self.spools[directory]
+        paths = self._segments(directory) if names is None else sorted(
+            os.path.join(directory, name) for name in names
+            if name.startswith(f"{spool_name}-") and name.endswith('.jsonl'))
+        records = []
+        for path in paths:
+            records.extend(self._read_new(path))
+        if records:
+            try:
+                on_records(records)
+            except Exception as e:
+                print(f"Error handling new records in {directory}: {e}")
+
+    def _open_inotify(self):
+        if self.backend == 'poll':
+            return None
+        try:
+            inotify = Inotify()
+            for directory in self.spools:
+                inotify.add_watch(directory)
+            return inotify
+        except OSError as e:
+            if self.backend == 'inotify':
+                raise
+            print(f"inotify unavailable ({e}), polling spools every {self.poll_interval}s")
+            return None
+
+    def _open(self):
+        self.inotify = self._open_inotify()
+        print(f"Watching spools with {'inotify' if self.inotify else 'polling'}")
+
+    def run(self, on_tick=None):
+        """Watch until stopped, calling `on_tick` at least once per poll interval."""
+        if self.inotify is None:
+            self._open()
+        try:
+            while not self.stop_event.is_set():
+                if self.inotify:
+                    changed = {}
+                    for directory, name, mask in self.inotify.read_events(self.poll_interval):
+                        if mask & IN_Q_OVERFLOW:
+                            # Events were lost; read every segment
+                            changed = {directory: None for directory in self.spools}
+                            break
+                        if directory in self.spools and changed.get(directory, set()) is not None:
+                            changed.setdefault(directory, set()).add(name)
+                    for directory, names in changed.items():
+                        self._scan(directory, names)
+                else:
+                    self.stop_event.wait(self.poll_interval)
+                    for directory in self.spools:
+                        self._scan(directory)
+                if on_tick:
+                    on_tick()
+        finally:
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+
+    def start(self, on_tick=None):
+        # Watches are in place before start returns, so no write after it goes unnoticed
+        self._open()
+        self.thread = threading.Thread(target=self.run, args=(on_tick,), name="spool-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+
+class WatchedPipeline:
+    """Generates and sends as soon as fetched emails and responses reach their spools.
+
+    New email records go straight to the generate workers, whose responses
+    land in the response spool and go straight to the send workers. Any
+    process may do the fetching, e.g. the daemon's poll or push cycles.
+    """
+
+    def __init__(self, generator, sender, generate_workers=None, send_workers=None, watcher=None):
+        self.generator = generator
+        self.sender = sender
+        # Sized from AI_MAX_CONCURRENCY, the one limit on model requests
+        self.generate_workers = generate_workers or generator.max_concurrency
+        # Send workers need their own Gmail services, which only a sender with a service factory can provide
+        self.send_workers = send_workers or (WATCH_SEND_WORKERS if sender.service_factory else 1)
+        self.state = StateStore.for_path()
+        self.watcher = watcher or SpoolWatcher()
+        self.watcher.add(generator.emails_received_dir, 'emails', self._on_emails)
+        self.watcher.add(generator.emails_to_send_dir, 'responses', self._on_responses)
+        self.priority = get_priority_scheduler()
+        self.generate_queue = self.priority.queue()
+        self.send_queue = self.priority.queue()
+        # Records seen before their state was recorded, retried on each tick
+        self.unsettled = []
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.counts = {'generated': 0, 'sent': 0, 'failed': 0}
+
+    def _readiness(self, kind, ref, record):
+        """Return 'ready', 'wait' or 'drop' for a record just appended to a spool."""
+        if kind == 'email':
+            row = self.state.get(record['id'])
+            ready = row is not None and row['state'] == FETCHED and row['email_path'] == ref
+        else:
+            row = self.state.get(record['email_id'])
+            ready = row is not None and row['state'] == GENERATED and row['response_path'] == ref
+        if ready:
+            return 'ready'
+        # The writer records the state just after appending, so an in-flight row may still catch up
+        return 'wait' if row is None or row['state'] in IN_FLIGHT_STATES else 'drop'
+
+    def _dispatch(self, kind, records, deadline):
+        ready = []
+        with self.lock:
+            for ref, record in records:
+                key = (kind, record['id'] if kind == 'email' else record['email_id'])
+                if key in self.queued:
+                    continue
+                readiness = self._readiness(kind, ref, record)
+                if readiness == 'ready':
+                    self.queued.add(key)
+                    ready.append((ref, record))
+                elif readiness == 'wait' and time.time() < deadline:
+                    self.unsettled.append((kind, ref, record, deadline))
+        if kind == 'email':
+            emails = [record for _, record in ready]
+            if COALESCE_ENABLED and len(emails) > 1:
+                emails = coalesce_emails(emails)
+            for email_content in emails:
+                self.generate_queue.put(email_content)
+        else:
+            for ref, response_data in ready:
+                response_data['path'] = ref
+                self.send_queue.put(response_data)
+
+    def _on_emails(self, records):
+        self._dispatch('email', records, time.time() + SPOOL_WATCH_SETTLE_SECONDS)
+
+    def _on_responses(self, records):
+        self._dispatch('response', records, time.time() + SPOOL_WATCH_SETTLE_SECONDS)
+
+    def _retry_unsettled(self):
+        with self.lock:
+            unsettled, self.unsettled = self.unsettled, []
+        for kind, ref, record, deadline in unsettled:
+            self._dispatch(kind, [(ref, record)], deadline)
+
+    def _done(self, keys, outcome):
+        with self.lock:
+            self.queued.difference_update(keys)
+            self.counts[outcome] += 1
+
+    def _generate_worker(self):
+        while True:
+            email_content = self.generate_queue.get()
+            if email_content is _DONE:
+                break
+            # The response reaches the send workers through the response spool
+            response_data = self.generator.generate(email_content)
+            # A coalesced email also answers the earlier messages merged into it
+            keys = [('email', email['id']) for email in email_content.get('coalesced', []) + [email_content]]
+            self._done(keys, 'generated' if response_data else 'failed')
+
+    def _send_worker(self):
+        while True:
+            response_data = self.send_queue.get()
+            if response_data is _DONE:
+                break
+            try:
+                sent = self.sender.send_response(response_data, response_data.get('path'))
+            except Exception as e:
+                print(f"Error sending response to {response_data['email_id']}: {e}")
+                sent = False
+            self._done([('response', response_data['email_id'])], 'sent' if sent else 'failed')
+            # Label changes are batched across whatever was sent before the queue ran dry
+            if self.send_queue.empty():
+                self.sender.flush_label_changes()
+
+    def _queue_leftovers(self):
+        """Queue work left in the state index before watching started."""
+        self._dispatch('email', [(row['email_path'], record) for row, record in self._load(FETCHED, 'email_path')],
+                       time.time())
+        self._dispatch('response', [(row['response_path'], record)
+                                    for row, record in self._load(GENERATED, 'response_path')], time.time())
+
+    def _load(self, state, column):
+        loaded = []
+        for row in self.state.in_state(state):
+            if not row[column]:
+                continue
+            try:
+                loaded.append((row, read_record(row[column])))
+            except Exception as e:
+                print(f"Error loading {row[column]}: {e}")
+        return loaded
+
+    def start(self):
+        """Start the workers and the watcher, then queue leftover work."""
+        self.generator.durable = True
+        self.sender.labels.get_all()
+        self.workers = ([threading.Thread(target=self._generate_worker, name=f"generate-{i}", daemon=True)
+                         for i in range(self.generate_workers)] +
+                        [threading.Thread(target=self._send_worker, name=f"send-{i}", daemon=True)
+                         for i in range(self.send_workers)])
+        for worker in self.workers:
+            worker.start()
+        # Offsets are taken before the leftovers are read, so nothing written in between is missed
+        self.watcher.start(on_tick=self._retry_unsettled)
+        self._queue_leftovers()
+
+    def stop(self):
+        """Stop watching and let the workers finish what they have queued."""
+        self.watcher.stop()
+        for _ in range(self.generate_workers):
+            self.generate_queue.put_last(_DONE)
+        for _ in range(self.send_workers):
+            self.send_queue.put_last(_DONE)
+        for worker in self.workers:
+            worker.join()
+        self.sender.flush_label_changes()
+        if self.generator.cache:
+            self.generator.cache.save()
+        self.report()
+        self.priority.report()
+
+    def report(self):
+        """Print and return the work done since the pipeline started."""
+        with self.lock:
+            counts = dict(self.counts)
+        print(f"Watched pipeline: generated {counts['generated']}, sent {counts['sent']}, "
+              f"failed {counts['failed']}")
+        return counts
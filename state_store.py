@@ -0,0 +1,229 @@
+import os
+import time
+import sqlite3
+import threading
+
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join('State', 'state.db'))
+
+# Lifecycle of an email through the pipeline
+FETCHED = 'fetched'
+GENERATED = 'generated'
+SENT = 'sent'
+FAILED = 'failed'
+# Answered by the reply to a later message in the same thread
+COALESCED = 'coalesced'
+# Emails whose records are still needed by a later stage
+IN_FLIGHT_STATES = {FETCHED, GENERATED, COALESCED}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    state TEXT NOT NULL,
+    email_path TEXT,
+    response_path TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS emails_state ON emails (state, created_at);
+CREATE TABLE IF NOT EXISTS openai_threads (
+    thread_id TEXT PRIMARY KEY,
+    openai_thread_id TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sends (
+    email_id TEXT PRIMARY KEY,
+    rfc_message_id TEXT NOT NULL,
+    gmail_message_id TEXT,
+    started_at REAL NOT NULL,
+    completed_at REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class StateStore:
+    """SQLite index of every email's lifecycle state, shared by all pipeline stages."""
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, db_path=None):
+        """Return the shared store for a database path, opening it on first use."""
+        db_path = db_path or STATE_DB_PATH
+        with cls._stores_lock:
+            store = cls._stores.get(db_path)
+            if store is None:
+                store = cls(db_path)
+                cls._stores[db_path] = store
+            return store
+
+    def __init__(self, db_path=None):
+        """Open the database in WAL mode and create the schema."""
+        self.db_path = db_path or STATE_DB_PATH
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def get(self, email_id):
+        """Return the row for an email, or None."""
+        rows = self._execute('SELECT * FROM emails WHERE id = ?', (email_id,))
+        return rows[0] if rows else None
+
+    def get_state(self, email_id):
+        """Return the lifecycle state of an email, or None if it is unknown."""
+        row = self.get(email_id)
+        return row['state'] if row else None
+
+    def has(self, email_id):
+        """Check whether an email has been fetched before."""
+        return bool(self._execute('SELECT 1 FROM emails WHERE id = ?', (email_id,)))
+
+    def mark_fetched(self, email_id, thread_id, email_path):
+        """Record a newly saved email."""
+        now = time.time()
+        self._execute(
+            'INSERT INTO emails (id, thread_id, state, email_path, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET thread_id = excluded.thread_id, state = excluded.state, '
+            'email_path = excluded.email_path, error = NULL, updated_at = excluded.updated_at',
+            (email_id, thread_id, FETCHED, email_path, now, now)
+        )
+
+    def mark_generated(self, email_id, response_path):
+        """Record that a response has been generated for an email."""
+        self._update(email_id, GENERATED, response_path=response_path)
+
+    def mark_sent(self, email_id, response_path=None):
+        """Record that the response to an email has been sent."""
+        self._update(email_id, SENT, response_path=response_path)
+
+    def mark_coalesced(self, email_id):
+        """Record that an email will be answered by the reply to a later message in its thread."""
+        self._update(email_id, COALESCED)
+
+    def mark_failed(self, email_id, error):
+        """Record that an email could not be processed."""
+        self._update(email_id, FAILED, error=str(error))
+
+    def _update(self, email_id, state, response_path=None, error=None):
+        now = time.time()
+        self._execute(
+            'INSERT INTO emails (id, state, response_path, error, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET state = excluded.state, '
+            'response_path = COALESCE(excluded.response_path, emails.response_path), '
+            'error = excluded.error, updated_at = excluded.updated_at',
+            (email_id, state, response_path, error, now, now)
+        )
+
+    def relocate(self, email_id, email_path=None, response_path=None):
+        """Point an email's stored record or response at a new location."""
+        self._execute(
+            'UPDATE emails SET email_path = COALESCE(?, email_path), '
+            'response_path = COALESCE(?, response_path) WHERE id = ?',
+            (email_path, response_path, email_id)
+        )
+
+    def in_state(self, state):
+        """Return all rows in a lifecycle state, oldest first."""
+        return self._execute('SELECT * FROM emails WHERE state = ? ORDER BY created_at', (state,))
+
+    def counts(self):
+        """Return the number of emails in each state."""
+        return dict(self._execute('SELECT state, COUNT(*) FROM emails GROUP BY state'))
+
+    def begin_send(self, email_id, rfc_message_id):
+        """Record a send attempt before it is made.
+
+        Returns (row, resumed); when an earlier attempt exists its row and
+        Message-ID are returned unchanged and resumed is True.
+        """
+        with self.lock:
+            inserted = self.conn.execute(
+                'INSERT OR IGNORE INTO sends (email_id, rfc_message_id, started_at) VALUES (?, ?, ?)',
+                (email_id, rfc_message_id, time.time())
+            ).rowcount
+            row = self.conn.execute('SELECT * FROM sends WHERE email_id = ?', (email_id,)).fetchone()
+        return row, not inserted
+
+    def complete_send(self, email_id, gmail_message_id):
+        """Record that the reply to an email reached Gmail."""
+        self._execute(
+            'UPDATE sends SET gmail_message_id = ?, completed_at = ? WHERE email_id = ?',
+            (gmail_message_id, time.time(), email_id)
+        )
+
+    def get_openai_thread(self, thread_id, max_age):
+        """Return the OpenAI thread used for a Gmail thread, or None if unknown or unused for max_age seconds."""
+        rows = self._execute(
+            'SELECT openai_thread_id FROM openai_threads WHERE thread_id = ? AND last_used >= ?',
+            (thread_id, time.time() - max_age)
+        )
+        return rows[0]['openai_thread_id'] if rows else None
+
+    def set_openai_thread(self, thread_id, openai_thread_id):
+        """Record (or refresh) the OpenAI thread used for a Gmail thread."""
+        self._execute(
+            'INSERT INTO openai_threads (thread_id, openai_thread_id, last_used) VALUES (?, ?, ?) '
+            'ON CONFLICT(thread_id) DO UPDATE SET openai_thread_id = excluded.openai_thread_id, '
+            'last_used = excluded.last_used',
+            (thread_id, openai_thread_id, time.time())
+        )
+
+    def forget_openai_thread(self, thread_id):
+        """Drop the OpenAI thread mapping for a Gmail thread."""
+        self._execute('DELETE FROM openai_threads WHERE thread_id = ?', (thread_id,))
+
+    def evict_openai_threads(self, max_age):
+        """Drop mappings unused for max_age seconds and return how many were dropped."""
+        with self.lock:
+            return self.conn.execute('DELETE FROM openai_threads WHERE last_used < ?',
+                                     (time.time() - max_age,)).rowcount
+
+    def migrate_spools(self, emails_received_dir='Emails_Received', emails_to_send_dir='Emails_To_Send'):
+        """Import existing JSON spool directories once, so old history is not reprocessed."""
+        if self._execute("SELECT 1 FROM meta WHERE key = 'spools_migrated'"):
+            return 0
+
+        sent_dir = os.path.join(emails_to_send_dir, 'Sent')
+        entries = []
+        # Later stages override earlier ones for the same email
+        for directory, state in ((emails_received_dir, FETCHED), (emails_to_send_dir, GENERATED), (sent_dir, SENT)):
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith('.json'):
+                        email_id = entry.name.split('_')[-1].replace('.json', '')
+                        entries.append((email_id, state, entry.path, entry.stat().st_mtime))
+
+        with self.lock:
+            self.conn.execute('BEGIN')
+            for email_id, state, path, mtime in entries:
+                path_column = 'email_path' if state == FETCHED else 'response_path'
+                self.conn.execute(
+                    f'INSERT INTO emails (id, state, {path_column}, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?) '
+                    f'ON CONFLICT(id) DO UPDATE SET state = excluded.state, {path_column} = excluded.{path_column}',
+                    (email_id, state, path, mtime, mtime)
+                )
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('spools_migrated', ?)", (str(time.time()),))
+            self.conn.execute('COMMIT')
+
+        if entries:
+            print(f"Migrated {len(entries)} spool files into {self.db_path}")
+        return len(entries)
@@ -0,0 +1,175 @@
+import os
+import time
+import threading
+from state_store import GENERATED
+from spool_log import read_record
+from thread_coalescer import coalesce_emails, COALESCE_ENABLED
+from priority_scheduler import get_priority_scheduler
+
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '20'))
+PIPELINE_SEND_WORKERS = int(os.getenv('PIPELINE_SEND_WORKERS', os.getenv('SEND_CONCURRENCY', '4')))
+# Set to 0 to pass emails between stages in memory only
+PIPELINE_DURABLE = os.getenv('PIPELINE_DURABLE', '1') == '1'
+
+# Tells a worker its input stage has finished
+_DONE = object()
+
+
+class StreamingPipeline:
+    """Runs fetch, generate and send as overlapping stages joined by bounded queues."""
+
+    def __init__(self, handler, generator, sender, generate_workers=None, send_workers=None,
+                 queue_size=None, durable=None):
+        self.handler = handler
+        self.generator = generator
+        self.sender = sender
+        # Sized from AI_MAX_CONCURRENCY, the one limit on model requests
+        self.generate_workers = generate_workers or generator.max_concurrency
+        # Send workers need their own Gmail services, which only a sender with a service factory can provide
+        self.send_workers = send_workers or (PIPELINE_SEND_WORKERS if sender.service_factory else 1)
+        queue_size = queue_size or PIPELINE_QUEUE_SIZE
+        self.durable = PIPELINE_DURABLE if durable is None else durable
+        for stage in (handler, generator):
+            stage.durable = self.durable
+
+        # Full queues block the stage upstream, which is the backpressure; each hands out its most urgent item first
+        self.priority = get_priority_scheduler()
+        self.generate_queue = self.priority.queue(maxsize=queue_size)
+        self.send_queue = self.priority.queue(maxsize=queue_size)
+        self.stats_lock = threading.Lock()
+        self.started_at = None
+        self.enqueued_at = {}
+        self.latencies = []
+        self.first_reply_at = None
+        self.counts = {'fetched': 0, 'generated': 0, 'sent': 0, 'failed': 0}
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.counts[key] += 1
+
+    def _fetch_stage(self):
+        """Feed leftover and newly fetched emails into the generate queue."""
+        try:
+            # Work left on disk by an earlier run goes first
+            for email_content in self._coalesce(self.generator.get_unprocessed_emails()):
+                self._enqueue_email(email_content)
+            for batch in self.handler.iter_new_email_batches():
+                for _ in batch:
+                    self._count('fetched')
+                # Bursts in one thread are only merged within a fetch batch
+                for email_content in self._coalesce(batch):
+                    self._enqueue_email(email_content)
+        except Exception as e:
+            print(f"Error in fetch stage: {e}")
+        finally:
+            self.handler.flush_mark_as_read()
+            for _ in range(self.generate_workers):
+                self.generate_queue.put_last(_DONE)
+
+    def _coalesce(self, emails):
+        return coalesce_emails(emails) if COALESCE_ENABLED and len(emails) > 1 else emails
+
+    def _enqueue_email(self, email_content):
+        with self.stats_lock:
+            self.enqueued_at.setdefault(email_content['id'], time.time())
+        self.generate_queue.put(email_content)
+
+    def _generate_stage(self):
+        """Generate responses and pass them to the send queue."""
+        while True:
+            email_content = self.generate_queue.get()
+            if email_content is _DONE:
+                break
+            response_data = self.generator.generate(email_content)
+            if response_data:
+                self._count('generated')
+                self.send_queue.put(response_data)
+            else:
+                self._count('failed')
+
+    def _send_stage(self):
+        """Send generated responses as soon as they arrive."""
+        while True:
+            response_data = self.send_queue.get()
+            if response_data is _DONE:
+                break
+            try:
+                sent = self.sender.send_response(response_data, response_data.get('path'))
+            except Exception as e:
+                print(f"Error sending response to {response_data['email_id']}: {e}")
+                sent = False
+            if not sent:
+                self._count('failed')
+                continue
+
+            now = time.time()
+            with self.stats_lock:
+                self.counts['sent'] += 1
+                if self.first_reply_at is None:
+                    self.first_reply_at = now
+                enqueued_at = self.enqueued_at.pop(response_data['email_id'], None)
+                if enqueued_at is not None:
+                    self.latencies.append(now - enqueued_at)
+
+    def _queue_leftover_responses(self):
+        """Queue responses generated by an earlier run that were never sent."""
+        for row in self.sender.state.in_state(GENERATED):
+            if not row['response_path']:
+                continue
+            try:
+                response_data = read_record(row['response_path'])
+                response_data['path'] = row['response_path']
+                self.send_queue.put(response_data)
+            except Exception as e:
+                print(f"Error loading response from {row['response_path']}: {e}")
+
+    def run(self):
+        """Run all stages to completion and return pipeline statistics."""
+        self.started_at = time.time()
+        # Warm the shared label cache before several threads start using it
+        self.sender.labels.get_all()
+
+        senders = [threading.Thread(target=self._send_stage, name=f"send-{i}", daemon=True)
+                   for i in range(self.send_workers)]
+        generators = [threading.Thread(target=self._generate_stage, name=f"generate-{i}", daemon=True)
+                      for i in range(self.generate_workers)]
+        fetcher = threading.Thread(target=self._fetch_stage, name="fetch", daemon=True)
+        for thread in senders + generators:
+            thread.start()
+        self._queue_leftover_responses()
+        fetcher.start()
+
+        fetcher.join()
+        for thread in generators:
+            thread.join()
+        for _ in senders:
+            self.send_queue.put_last(_DONE)
+        for thread in senders:
+            thread.join()
+
+        self.sender.flush_label_changes()
+        if self.generator.cache:
+            self.generator.cache.save()
+        if self.generator.rules:
+            self.generator.rules.report()
+        self.priority.report()
+        return self.report()
+
+    def report(self):
+        """Print and return throughput and latency statistics."""
+        elapsed = time.time() - self.started_at
+        stats = dict(self.counts, elapsed=elapsed)
+        if self.first_reply_at is not None:
+            stats['time_to_first_reply'] = self.first_reply_at - self.started_at
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            stats['latency_avg'] = sum(latencies) / len(latencies)
+            stats['latency_p95'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+        print(f"\nStreaming pipeline: fetched {stats['fetched']}, generated {stats['generated']}, "
+              f"sent {stats['sent']}, failed {stats['failed']} in {elapsed:.1f}s")
+        if 'time_to_first_reply' in stats:
+            print(f"Time to first reply: {stats['time_to_first_reply']:.1f}s")
+        if 'latency_avg' in stats:
+            print(f"Per-email latency: avg {stats['latency_avg']:.1f}s, p95 {stats['latency_p95']:.1f}s")
+        return stats
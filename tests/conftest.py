@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spool_log
+from spool_log import SegmentedSpool
+from state_store import StateStore
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory with fresh process-wide state and spools, as the pipeline does in its folder."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(StateStore, '_stores', {})
+    monkeypatch.setattr(SegmentedSpool, '_spools', {})
+    monkeypatch.setattr(spool_log, '_maps', {})
+    return tmp_path
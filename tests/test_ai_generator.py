@@ -0,0 +1,91 @@
+import threading
+import time
+from ai_generator import AIGenerator
+from llm_backends import FakeBackend
+from response_cache import ResponseCache
+from spool_log import SegmentedSpool, read_record
+from state_store import StateStore, FETCHED, GENERATED, FAILED, COALESCED
+
+
+def received_email(email_id, body='When is the transfer application deadline this year?', **fields):
+    return dict({'id': email_id, 'thread_id': f't-{email_id}', 'sender': 'student@example.com',
+                 'subject': 'Transfer deadline', 'body': body, 'labels': ['Transfers'],
+                 'internal_date': '1000000000'}, **fields)
+
+
+def test_emails_never_written_to_disk_are_marked_failed(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    spool = SegmentedSpool(str(tmp_path), 'emails')
+    ref = spool.append({'id': 'saved', 'body': 'question'})
+    state.mark_fetched('saved', 't1', ref)
+    # Non-durable streaming runs record the state without the record
+    state.mark_fetched('lost', 't2', None)
+
+    generator = AIGenerator.__new__(AIGenerator)
+    generator.state = state
+    assert [email['id'] for email in generator.get_unprocessed_emails()] == ['saved']
+    assert state.get('lost')['state'] == FAILED
+    assert state.get('saved')['state'] == FETCHED
+
+
+def test_generated_response_is_spooled_and_recorded(workdir):
+    backend = FakeBackend('The deadline is March 1.')
+    generator = AIGenerator(max_concurrency=1, backend=backend, cache=False, compactor=False)
+    generator.state.mark_fetched('m1', 't-m1', None)
+
+    response_data = generator.generate(received_email('m1'))
+    assert response_data['response'] == 'The deadline is March 1.'
+    assert len(backend.calls) == 1
+    row = generator.state.get('m1')
+    assert row['state'] == GENERATED
+    assert read_record(row['response_path'])['original_email']['subject'] == 'Transfer deadline'
+
+
+def test_repeated_question_is_answered_from_the_cache(workdir):
+    backend = FakeBackend(lambda email_content: f"Answer to {email_content['id']}")
+    generator = AIGenerator(max_concurrency=1, backend=backend, cache=ResponseCache(cache_path=''),
+                            compactor=False)
+    first = generator.generate(received_email('m1'))
+    second = generator.generate(received_email('m2'))
+    assert first['response'] == second['response'] == 'Answer to m1'
+    assert len(backend.calls) == 1
+
+
+def test_failed_generation_leaves_the_email_fetched(workdir):
+    generator = AIGenerator(max_concurrency=1, backend=FakeBackend(lambda email_content: None),
+                            cache=False, compactor=False)
+    generator.state.mark_fetched('m1', 't-m1', None)
+    assert generator.generate(received_email('m1')) is None
+    assert generator.state.get_state('m1') == FETCHED
+
+
+def test_coalesced_messages_are_answered_by_one_reply(workdir):
+    generator = AIGenerator(max_concurrency=1, backend=FakeBackend('Both answered.'), cache=False, compactor=False)
+    generator.generate(received_email('m2', coalesced=[{'id': 'm1', 'labels': ['Transfers']}]))
+    assert generator.state.get_state('m2') == GENERATED
+    assert generator.state.get_state('m1') == COALESCED
+
+
+def test_model_requests_never_exceed_the_concurrency_limit(workdir):
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+
+    def answer(email_content):
+        with lock:
+            in_flight.append(email_content['id'])
+            peak.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.remove(email_content['id'])
+        return 'Answered.'
+
+    generator = AIGenerator(max_concurrency=2, backend=FakeBackend(answer), cache=False, compactor=False)
+    # Callers from separate pools, e.g. watch workers and a batch run, share the limit
+    threads = [threading.Thread(target=generator.generate, args=(received_email(f'm{index}'),))
+               for index in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(peak) == 6 and max(peak) == 2
@@ -0,0 +1,25 @@
+import base64
+from attachment_store import AttachmentStore, STORED, SKIPPED
+
+
+def encoded(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def test_same_file_is_stored_once(tmp_path):
+    store = AttachmentStore(service=None, root=str(tmp_path), max_bytes=1024)
+    form = {'filename': 'form.pdf', 'mime_type': 'application/pdf', 'size': 11, 'data': encoded(b'hello world')}
+    first = store.download('m1', dict(form))
+    second = store.download('m2', dict(form, filename='copy.pdf'))
+    assert first['status'] == second['status'] == STORED
+    assert first['path'] == second['path']
+    assert store.stats['duplicates'] == 1
+    with open(first['path'], 'rb') as f:
+        assert f.read() == b'hello world'
+
+
+def test_attachment_over_the_limit_is_skipped(tmp_path):
+    store = AttachmentStore(service=None, root=str(tmp_path), max_bytes=10)
+    record = store.download('m1', {'filename': 'video.mp4', 'size': 11, 'attachment_id': 'a1'})
+    assert record['status'] == SKIPPED
+    assert record['attachment_id'] == 'a1'
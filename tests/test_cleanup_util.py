@@ -0,0 +1,102 @@
+import os
+import time
+from cleanup_util import CleanupUtil
+from spool_log import SegmentedSpool, iter_segment, read_record
+from state_store import StateStore, FETCHED, GENERATED, SENT, FAILED
+
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_sent_folder_is_measured_once(workdir):
+    state = StateStore.for_path()
+    for index in range(4):
+        state.mark_fetched(f'm{index}', 't1', None)
+        state.mark_sent(f'm{index}')
+        write_file(os.path.join('Emails_To_Send', 'Sent', f'response_m{index}.json'), 1000)
+    # 4000 bytes against a 3000-byte cap: one file has to go, not all of them
+    cleanup = CleanupUtil(max_age_days=30, max_total_mb=3000 / 1024 / 1024, state=state)
+    assert cleanup._total_size(['Emails_Received', 'Emails_To_Send']) == 4000
+    cleanup.cleanup_processed_files('Emails_Received', 'Emails_To_Send')
+    assert len(os.listdir(os.path.join('Emails_To_Send', 'Sent'))) == 3
+
+
+def spool_emails(state, count, body_size=100, state_name=SENT, days_ago=0):
+    """Spool emails and their responses, then move them to a state as of `days_ago` days."""
+    emails = SegmentedSpool.for_directory('Emails_Received', 'emails')
+    responses = SegmentedSpool.for_directory('Emails_To_Send', 'responses', key='email_id')
+    ids = [f'{state_name}-{days_ago}-{index}' for index in range(count)]
+    for email_id in ids:
+        state.mark_fetched(email_id, 't1', emails.append({'id': email_id, 'body': 'x' * body_size}))
+        if state_name != FETCHED:
+            state.mark_generated(email_id, responses.append({'email_id': email_id, 'response': 'y' * body_size}))
+        if state_name == SENT:
+            state.mark_sent(email_id)
+        elif state_name == FAILED:
+            state.mark_failed(email_id, 'model timed out')
+        state._execute('UPDATE emails SET updated_at = ? WHERE id = ?', (time.time() - days_ago * 86400, email_id))
+    return ids
+
+
+def readable(state, email_id):
+    row = state.get(email_id)
+    return read_record(row['email_path'])['id'] == email_id
+
+
+def test_records_past_the_age_limit_are_removed(workdir):
+    state = StateStore.for_path()
+    old = spool_emails(state, 3, days_ago=10)
+    recent = spool_emails(state, 3, days_ago=1)
+    CleanupUtil(max_age_days=7, state=state).cleanup_processed_files('Emails_Received', 'Emails_To_Send')
+    assert all(readable(state, email_id) for email_id in recent)
+    remaining = [record['id'] for path in SegmentedSpool.for_directory('Emails_Received', 'emails').segments()
+                 for _, _, record in iter_segment(path)]
+    assert sorted(remaining) == sorted(recent)
+    assert not set(old) & set(remaining)
+
+
+def test_only_configured_states_are_removed(workdir):
+    state = StateStore.for_path()
+    sent = spool_emails(state, 2, state_name=SENT)
+    failed = spool_emails(state, 2, state_name=FAILED)
+    CleanupUtil(max_age_days=0, states={SENT}, state=state).cleanup_processed_files('Emails_Received',
+                                                                                      'Emails_To_Send')
+    assert all(readable(state, email_id) for email_id in failed)
+    remaining = {record['id'] for path in SegmentedSpool.for_directory('Emails_Received', 'emails').segments()
+                 for _, _, record in iter_segment(path)}
+    assert remaining == set(failed) and not remaining & set(sent)
+
+
+def test_size_cap_removes_sent_records_from_the_active_segment(workdir):
+    state = StateStore.for_path()
+    spool_emails(state, 100, body_size=2500)
+    cleanup = CleanupUtil(max_age_days=30, max_total_mb=0.1, state=state)
+    assert cleanup._total_size(['Emails_Received', 'Emails_To_Send']) > 0.4 * 1024 * 1024
+    cleanup.cleanup_processed_files('Emails_Received', 'Emails_To_Send')
+    assert cleanup._total_size(['Emails_Received', 'Emails_To_Send']) <= 0.1 * 1024 * 1024
+
+
+def test_in_flight_records_are_never_removed(workdir):
+    state = StateStore.for_path()
+    spool_emails(state, 20, body_size=2500, days_ago=10)
+    waiting = spool_emails(state, 3, state_name=FETCHED, days_ago=10)
+    generated = spool_emails(state, 3, state_name=GENERATED, days_ago=10)
+    cleanup = CleanupUtil(max_age_days=0, states={SENT, FAILED, FETCHED, GENERATED}, max_total_mb=0.001,
+                          state=state)
+    cleanup.cleanup_processed_files('Emails_Received', 'Emails_To_Send')
+    assert all(readable(state, email_id) for email_id in waiting + generated)
+    for email_id in generated:
+        assert read_record(state.get(email_id)['response_path'])['email_id'] == email_id
+    assert state.counts()[SENT] == 20
+
+
+def test_recently_written_segment_is_left_alone(workdir):
+    state = StateStore.for_path()
+    spool_emails(state, 3)
+    CleanupUtil(max_age_days=0, seal_idle=60, state=state).cleanup_processed_files('Emails_Received',
+                                                                                     'Emails_To_Send')
+    spool = SegmentedSpool.for_directory('Emails_Received', 'emails')
+    assert len(list(iter_segment(spool.active_path))) == 3
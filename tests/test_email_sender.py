@@ -0,0 +1,232 @@
+import base64
+import json
+import email
+import pytest
+import email_sender
+from email_sender import EmailSender
+from label_cache import LabelRegistry
+from rate_limiter import get_scheduler
+from state_store import GENERATED, SENT
+
+
+class FakeRequest:
+    def __init__(self, response=None, error=None):
+        self.response = response
+        self.error = error
+
+    def execute(self):
+        if self.error:
+            raise self.error
+        return self.response
+
+
+class FakeError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.resp = type('Response', (), {'status': status})()
+
+
+class FakeGmail:
+    """Knows one label and records label changes and sends.
+
+    Label changes to messages listed in `failing` fail with the given
+    status. A send fails with `send_error` when it is set, but like a
+    real 5xx it may still have been delivered: everything sent can be
+    found by its Message-ID.
+    """
+
+    def __init__(self):
+        self.failing = {}
+        self.modified = []
+        self.sent = []
+        self.sent_by_rfc_id = {}
+        self.send_error = None
+        self.searches = 0
+
+    def users(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, q=None, maxResults=None):
+        if q is None:
+            return FakeRequest({'labels': [{'id': 'L1', 'name': 'Beginner', 'type': 'user'}]})
+        self.searches += 1
+        rfc_id = q.split('rfc822msgid:')[1]
+        found = [{'id': self.sent_by_rfc_id[rfc_id]}] if rfc_id in self.sent_by_rfc_id else []
+        return FakeRequest({'messages': found})
+
+    def send(self, userId, body):
+        return SendRequest(self, email.message_from_bytes(base64.urlsafe_b64decode(body['raw'])))
+
+    def modify(self, userId, id, body):
+        if id in self.failing:
+            return FakeRequest(error=FakeError(self.failing[id]))
+        self.modified.append(id)
+        return FakeRequest({})
+
+    def batchModify(self, userId, body):
+        failing = [self.failing[message_id] for message_id in body['ids'] if message_id in self.failing]
+        if failing:
+            return FakeRequest(error=FakeError(failing[0]))
+        self.modified.extend(body['ids'])
+        return FakeRequest({})
+
+
+class SendRequest:
+    """Delivers its message every time it is executed."""
+
+    def __init__(self, service, message):
+        self.service = service
+        self.message = message
+
+    def execute(self):
+        gmail_id = f"g{len(self.service.sent) + 1}"
+        self.service.sent.append(self.message)
+        self.service.sent_by_rfc_id[self.message['Message-ID'].strip('<>')] = gmail_id
+        if self.service.send_error:
+            raise self.service.send_error
+        return {'id': gmail_id}
+
+
+@pytest.fixture
+def sender_dir(workdir, monkeypatch):
+    monkeypatch.setattr(LabelRegistry, '_registries', {})
+    monkeypatch.setattr(get_scheduler(), 'backoff', lambda attempt, error: None)
+    return workdir
+
+
+def saved_changes():
+    with open('State/label_changes.json', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_queued_label_change_survives_a_restart(sender_dir):
+    service = FakeGmail()
+    assert EmailSender(service=service).queue_label_change('m1', 'Beginner', ['INBOX', 'UNREAD'])
+    assert saved_changes() == [{'label_id': 'L1', 'remove_label_ids': ['UNREAD'], 'messages': {'m1': 0}}]
+
+    # A new process picks the change up and applies it on its first flush
+    assert EmailSender(service=service).flush_label_changes() == 1
+    assert service.modified == ['m1']
+    assert saved_changes() == []
+
+
+def test_failed_label_change_is_retried_by_the_next_flush(sender_dir):
+    service = FakeGmail()
+    service.failing = {'m1': 500}
+    sender = EmailSender(service=service)
+    sender.queue_label_change('m1', 'Beginner', ['INBOX'])
+    sender.queue_label_change('m2', 'Beginner', ['INBOX'])
+    assert sender.flush_label_changes() == 0
+    assert saved_changes()[0]['messages'] == {'m1': 1, 'm2': 1}
+
+    service.failing = {}
+    assert EmailSender(service=service).flush_label_changes() == 2
+    assert sorted(service.modified) == ['m1', 'm2']
+    assert saved_changes() == []
+
+
+def test_label_change_is_dropped_after_a_permanent_failure_or_too_many_attempts(sender_dir, monkeypatch):
+    monkeypatch.setattr(email_sender, 'LABEL_CHANGE_MAX_ATTEMPTS', 2)
+    service = FakeGmail()
+    service.failing = {'deleted': 404, 'flaky': 503}
+    sender = EmailSender(service=service)
+    sender.queue_label_change('deleted', 'Beginner', [])
+    sender.queue_label_change('flaky', 'Beginner', [])
+    sender.flush_label_changes()
+    assert saved_changes()[0]['messages'] == {'flaky': 1}
+    sender.flush_label_changes()
+    assert saved_changes() == []
+
+
+def test_immediate_mode_queues_a_change_that_failed(sender_dir):
+    service = FakeGmail()
+    service.failing = {'m1': 500}
+    sender = EmailSender(service=service)
+    sender.label_modify_mode = 'immediate'
+    assert sender.queue_label_change('m1', 'Beginner', [])
+    assert saved_changes()[0]['messages'] == {'m1': 1}
+
+    service.failing = {}
+    assert sender.flush_label_changes() == 1
+    assert service.modified == ['m1']
+
+
+def generated_response(sender, email_id='m1', response='The deadline is March 1.'):
+    sender.state.mark_fetched(email_id, 't1', None)
+    sender.state.mark_generated(email_id, None)
+    return {'email_id': email_id, 'thread_id': 't1', 'response': response,
+            'original_email': {'sender': 'student@example.com', 'subject': 'Transfer deadline',
+                               'message_id': '<question@example.com>', 'labels': ['INBOX']}}
+
+
+def send_record(sender, email_id):
+    return sender.state._execute('SELECT * FROM sends WHERE email_id = ?', (email_id,))[0]
+
+
+def test_new_reply_is_sent_with_its_recorded_message_id(sender_dir):
+    service = FakeGmail()
+    sender = EmailSender(service=service)
+    assert sender.send_response(generated_response(sender))
+
+    [message] = service.sent
+    assert message['In-Reply-To'] == '<question@example.com>'
+    record = send_record(sender, 'm1')
+    assert message['Message-ID'] == record['rfc_message_id']
+    assert record['gmail_message_id'] == 'g1'
+    assert sender.state.get_state('m1') == SENT
+    # Nothing was recorded for this email, so there was nothing to look for
+    assert service.searches == 0
+
+
+def test_resumed_reply_that_reached_gmail_is_not_sent_again(sender_dir):
+    service = FakeGmail()
+    sender = EmailSender(service=service)
+    response_data = generated_response(sender, response='$Beginner$The deadline is March 1.')
+    # An earlier run recorded the attempt and crashed after Gmail accepted the reply
+    sender.state.begin_send('m1', '<earlier@automail.local>')
+    service.sent_by_rfc_id['earlier@automail.local'] = 'g-earlier'
+
+    assert sender.send_response(response_data)
+    assert service.sent == [] and service.searches == 1
+    assert send_record(sender, 'm1')['gmail_message_id'] == 'g-earlier'
+    assert sender.state.get_state('m1') == SENT
+    # The label command is still carried out
+    assert list(sender.pending_label_changes.values()) == [{'m1': 0}]
+
+
+def test_resumed_reply_that_never_reached_gmail_is_sent_with_the_same_message_id(sender_dir):
+    service = FakeGmail()
+    sender = EmailSender(service=service)
+    response_data = generated_response(sender)
+    sender.state.begin_send('m1', '<earlier@automail.local>')
+
+    assert sender.send_response(response_data)
+    assert service.searches == 1
+    assert [message['Message-ID'] for message in service.sent] == ['<earlier@automail.local>']
+    assert sender.state.get_state('m1') == SENT
+
+
+def test_failed_send_is_not_retried_and_the_next_run_finds_it(sender_dir):
+    service = FakeGmail()
+    service.send_error = FakeError(503)
+    sender = EmailSender(service=service)
+    response_data = generated_response(sender)
+
+    assert not sender.send_response(response_data)
+    # A 5xx is retryable, but a retried send could deliver a second copy
+    assert len(service.sent) == 1
+    assert send_record(sender, 'm1')['gmail_message_id'] is None
+    assert sender.state.get_state('m1') == GENERATED
+
+    # The reply went out despite the error, so the next run only records it
+    service.send_error = None
+    assert EmailSender(service=service).send_response(response_data)
+    assert len(service.sent) == 1
+    assert send_record(sender, 'm1')['gmail_message_id'] == 'g1'
+    assert sender.state.get_state('m1') == SENT
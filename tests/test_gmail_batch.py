@@ -0,0 +1,84 @@
+import json
+from email_handler import EmailHandler, MARK_READ_MAX_ATTEMPTS
+from gmail_batch import batch_modify
+from rate_limiter import get_scheduler
+
+
+class FakeError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.resp = type('Response', (), {'status': status})()
+
+
+class FakeRequest:
+    def __init__(self, service, ids):
+        self.service = service
+        self.ids = ids
+        self.methodId = 'gmail.users.messages.batchModify'
+
+    def execute(self):
+        self.service.calls.append(list(self.ids))
+        for message_id in self.ids:
+            if message_id in self.service.errors:
+                raise FakeError(self.service.errors[message_id])
+        return {}
+
+
+class FakeService:
+    """Answers modify and batchModify, failing any call that includes an ID in `errors`."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.calls = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def modify(self, userId, id, body):
+        return FakeRequest(self, [id])
+
+    def batchModify(self, userId, body):
+        return FakeRequest(self, body['ids'])
+
+
+def test_bad_id_is_isolated_from_its_chunk():
+    service = FakeService({'m3': 404})
+    failed = batch_modify(service, [f'm{i}' for i in range(8)], remove_label_ids=['UNREAD'], retries=0)
+    assert list(failed) == ['m3']
+    succeeded = {message_id for call in service.calls for message_id in call if 'm3' not in call}
+    assert succeeded == {f'm{i}' for i in range(8)} - {'m3'}
+
+
+def test_transient_failure_keeps_the_whole_chunk():
+    service = FakeService({'m1': 503})
+    failed = batch_modify(service, ['m0', 'm1', 'm2'], remove_label_ids=['UNREAD'], retries=0)
+    assert sorted(failed) == ['m0', 'm1', 'm2']
+    assert len(service.calls) == 1
+
+
+def make_handler(tmp_path, service):
+    handler = EmailHandler.__new__(EmailHandler)
+    handler.service = service
+    handler.mark_read_failed_path = str(tmp_path / 'mark_read_failed.json')
+    handler.pending_mark_read = []
+    handler._load_mark_read_failures()
+    return handler
+
+
+def test_mark_read_drops_permanent_failures_and_caps_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_scheduler(), 'backoff', lambda attempt, error: None)
+    service = FakeService({'gone': 404, 'busy': 503})
+    handler = make_handler(tmp_path, service)
+    for message_id in ('ok', 'gone', 'busy'):
+        handler.mark_as_read(message_id)
+    assert handler.flush_mark_as_read() == 1
+    with open(handler.mark_read_failed_path, encoding='utf-8') as f:
+        assert json.load(f) == {'busy': 1}
+
+    handler = make_handler(tmp_path, service)
+    for _ in range(MARK_READ_MAX_ATTEMPTS - 1):
+        handler.flush_mark_as_read()
+    assert handler.mark_read_failures == {}
@@ -0,0 +1,43 @@
+from label_cache import LabelRegistry
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeService:
+    """Answers labels().list and counts the calls made through it."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def users(self):
+        return self
+
+    def labels(self):
+        return self
+
+    def list(self, userId):
+        self.calls += 1
+        return FakeRequest({'labels': [{'id': 'L1', 'name': 'Beginner', 'type': 'user'}]})
+
+
+def test_views_share_labels_but_keep_their_own_service(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(LabelRegistry, '_registries', {})
+    first, second = FakeService(), FakeService()
+    first_view = LabelRegistry.for_service(first, user_id='test')
+    second_view = LabelRegistry.for_service(second, user_id='test')
+
+    assert first_view.registry is second_view.registry
+    assert first_view.service is first and second_view.service is second
+
+    assert second_view.get_id('Beginner') == 'L1'
+    assert (first.calls, second.calls) == (0, 1)
+    # The labels loaded through the second service are cached for the first
+    assert first_view.get_name('L1') == 'Beginner'
+    assert first.calls == 0
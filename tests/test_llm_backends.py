@@ -0,0 +1,56 @@
+import time
+from types import SimpleNamespace
+from llm_backends import AssistantsBackend, OPENAI_THREAD_EVICT_INTERVAL, OPENAI_THREAD_TTL
+from state_store import StateStore
+
+
+class FakeThreads:
+    """The parts of client.beta.threads the assistants backend uses; every run completes at once."""
+
+    def __init__(self):
+        self.created = 0
+        self.messages = SimpleNamespace(create=self.add_message, list=self.list_messages)
+        self.runs = SimpleNamespace(create=self.run, retrieve=self.run)
+
+    def create(self, messages):
+        self.created += 1
+        return SimpleNamespace(id=f'thread-{self.created}')
+
+    def add_message(self, thread_id, role, content):
+        return SimpleNamespace(id='message')
+
+    def run(self, thread_id, assistant_id=None, run_id=None):
+        return SimpleNamespace(id='run', status='completed')
+
+    def list_messages(self, thread_id, run_id):
+        text = SimpleNamespace(value=f'Reply in {thread_id}')
+        return SimpleNamespace(data=[SimpleNamespace(role='assistant', content=[SimpleNamespace(text=text)])])
+
+
+def email(thread_id):
+    return {'id': f'm-{thread_id}', 'thread_id': thread_id, 'sender': 'student@example.com',
+            'subject': 'Transfer deadline', 'body': 'When is it?'}
+
+
+def mappings(state):
+    return {row['thread_id'] for row in state._execute('SELECT thread_id FROM openai_threads')}
+
+
+def test_idle_threads_are_evicted_while_the_backend_runs(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    threads = FakeThreads()
+    backend = AssistantsBackend(SimpleNamespace(beta=SimpleNamespace(threads=threads)), 'asst', state,
+                                reuse_threads=True)
+    assert backend.generate(email('g1')) == 'Reply in thread-1'
+    assert backend.generate(email('g1')) == 'Reply in thread-1'
+
+    # A mapping that went idle after the backend started
+    state.set_openai_thread('g-old', 'thread-old')
+    state._execute('UPDATE openai_threads SET last_used = ? WHERE thread_id = ?',
+                   (time.time() - OPENAI_THREAD_TTL - 1, 'g-old'))
+    backend.generate(email('g2'))
+    assert mappings(state) == {'g1', 'g2', 'g-old'}
+
+    backend.evicted_at -= OPENAI_THREAD_EVICT_INTERVAL
+    backend.generate(email('g1'))
+    assert mappings(state) == {'g1', 'g2'}
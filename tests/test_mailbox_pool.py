@@ -0,0 +1,35 @@
+from mailbox_pool import Mailbox, MailboxPool
+
+
+def test_worker_environment_never_uses_shared_credentials(tmp_path):
+    mailbox = Mailbox({'name': 'admissions', 'labels': ['Transfers']}, base_dir=str(tmp_path))
+    environment = mailbox.environment(workers=2)
+    assert environment['GMAIL_CREDENTIALS_JSON'] == ''
+    assert environment['GMAIL_INTERACTIVE_AUTH'] == '0'
+    assert environment['GMAIL_TOKEN_PATH'] == 'token.pickle'
+    assert environment['GMAIL_LABELS'] == 'Transfers'
+
+
+def test_mailbox_credentials_come_from_its_own_token_or_env(tmp_path):
+    mailbox = Mailbox({'name': 'admissions'}, base_dir=str(tmp_path))
+    assert not mailbox.has_credentials()
+    (tmp_path / 'admissions').mkdir()
+    (tmp_path / 'admissions' / 'token.pickle').write_bytes(b'')
+    assert mailbox.has_credentials()
+    assert Mailbox({'name': 'other', 'env': {'GMAIL_CREDENTIALS_JSON': '{}'}},
+                   base_dir=str(tmp_path)).has_credentials()
+
+
+def test_mailbox_without_token_is_skipped(tmp_path):
+    pool = MailboxPool([Mailbox({'name': 'admissions'}, base_dir=str(tmp_path))], workers=1)
+    stats = pool.run(once=True)
+    assert stats['admissions']['cycles'] == 0
+
+
+def test_least_served_mailbox_goes_first(tmp_path):
+    busy = Mailbox({'name': 'busy'}, base_dir=str(tmp_path))
+    idle = Mailbox({'name': 'idle'}, base_dir=str(tmp_path))
+    heavy = Mailbox({'name': 'heavy', 'weight': 4}, base_dir=str(tmp_path))
+    busy.busy_seconds, idle.busy_seconds, heavy.busy_seconds = 10, 5, 12
+    pool = MailboxPool([busy, idle, heavy], workers=1)
+    assert [mailbox.name for mailbox in pool._due(now=1)] == ['heavy', 'idle', 'busy']
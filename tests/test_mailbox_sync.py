@@ -0,0 +1,120 @@
+import json
+import pytest
+from rate_limiter import get_scheduler
+from mailbox_sync import MailboxSync
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeService:
+    """Lists two unread messages and reports history ID 42."""
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest({'historyId': '42'})
+
+    def list(self, **kwargs):
+        return FakeRequest({'messages': [{'id': 'm1', 'threadId': 't1'}, {'id': 'm2', 'threadId': 't2'}]})
+
+
+def test_history_id_is_only_stored_when_the_caller_advances(tmp_path):
+    state_path = tmp_path / 'sync_state.json'
+    sync = MailboxSync(FakeService(), state_path=str(state_path), mode='full')
+    listing = sync.iter_messages(['L1'])
+    assert [message['id'] for message in listing] == ['m1', 'm2']
+    assert sync.history_id is None
+    assert not state_path.exists()
+
+    sync.advance('42')
+    with open(state_path, encoding='utf-8') as f:
+        assert json.load(f)['history_id'] == '42'
+
+
+def test_listing_returns_the_new_history_id(tmp_path):
+    sync = MailboxSync(FakeService(), state_path=str(tmp_path / 'sync_state.json'), mode='full')
+    listing = sync.iter_messages(['L1'])
+    messages = []
+    while True:
+        try:
+            messages.append(next(listing))
+        except StopIteration as done:
+            assert done.value == '42'
+            break
+    assert len(messages) == 2
+
+
+class HistoryError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.resp = type('Response', (), {'status': status})()
+
+
+class FlakyHistoryService:
+    """Answers history.list with no changes, or fails with a 500 while `failing` is set."""
+
+    def __init__(self):
+        self.failing = True
+
+    def users(self):
+        return self
+
+    def history(self):
+        return self
+
+    def list(self, **kwargs):
+        if self.failing:
+            raise HistoryError(500)
+        return FakeRequest({'historyId': '50'})
+
+
+def drain(listing):
+    messages = []
+    while True:
+        try:
+            messages.append(next(listing)['id'])
+        except StopIteration as done:
+            return messages, done.value
+
+
+def test_deferred_message_survives_a_failed_listing(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_scheduler(), 'backoff', lambda attempt, error: None)
+    state_path = tmp_path / 'sync_state.json'
+    state_path.write_text(json.dumps({'history_id': '40', 'deferred': {'A': 'tA'}}))
+    service = FlakyHistoryService()
+    sync = MailboxSync(service, state_path=str(state_path), mode='incremental')
+
+    listing = sync.iter_messages(['L1'])
+    assert next(listing)['id'] == 'A'
+    with pytest.raises(HistoryError):
+        next(listing)
+
+    # The next cycle in the same process still yields it
+    service.failing = False
+    assert drain(sync.iter_messages(['L1'])) == (['A'], '50')
+    sync.advance('50')
+    with open(state_path, encoding='utf-8') as f:
+        assert json.load(f) == {'history_id': '50', 'deferred': {}}
+
+
+def test_message_deferred_again_is_kept(tmp_path):
+    state_path = tmp_path / 'sync_state.json'
+    state_path.write_text(json.dumps({'history_id': '40', 'deferred': {'A': 'tA'}}))
+    service = FlakyHistoryService()
+    service.failing = False
+    sync = MailboxSync(service, state_path=str(state_path), mode='incremental')
+    for message in sync.iter_messages(['L1']):
+        sync.defer(message)
+    sync.advance('50')
+    with open(state_path, encoding='utf-8') as f:
+        assert json.load(f)['deferred'] == {'A': 'tA'}
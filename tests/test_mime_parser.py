@@ -0,0 +1,89 @@
+import base64
+from mime_parser import extract_body, iter_attachments, decode_part, html_to_text
+
+
+def part(mime_type, text=None, charset='utf-8', filename='', disposition=None, parts=None):
+    """Build a Gmail API payload part, encoding `text` the way Gmail does."""
+    headers = [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}]
+    if disposition:
+        headers.append({'name': 'Content-Disposition', 'value': disposition})
+    body = {}
+    if text is not None:
+        raw = text.encode(charset)
+        body = {'data': base64.urlsafe_b64encode(raw).decode().rstrip('='), 'size': len(raw)}
+    result = {'mimeType': mime_type, 'filename': filename, 'headers': headers, 'body': body}
+    if parts is not None:
+        result['parts'] = parts
+    return result
+
+
+def test_plain_text_is_found_in_nested_multiparts():
+    payload = part('multipart/mixed', parts=[
+        part('multipart/alternative', parts=[
+            part('text/plain', 'When is the deadline?'),
+            part('text/html', '<p>When is the <b>deadline</b>?</p>'),
+        ]),
+        part('application/pdf', 'pdf bytes', filename='transcript.pdf'),
+    ])
+    assert extract_body(payload) == 'When is the deadline?'
+
+
+def test_body_is_decoded_in_its_declared_charset():
+    payload = part('text/plain', 'Je suis inscrite en première année à Besançon', charset='iso-8859-1')
+    assert extract_body(payload) == 'Je suis inscrite en première année à Besançon'
+
+
+def test_unknown_charset_falls_back_to_utf8():
+    unknown = part('text/plain', 'café')
+    unknown['headers'] = [{'name': 'Content-Type', 'value': 'text/plain; charset=x-unknown'}]
+    assert decode_part(unknown) == 'café'
+
+
+def test_html_is_converted_when_there_is_no_plain_text():
+    payload = part('multipart/alternative', parts=[
+        part('text/html', '<html><head><style>p {color: red}</style></head>'
+                          '<body><p>First&nbsp;paragraph</p><div>Second <i>one</i></div>'
+                          '<script>track()</script></body></html>'),
+    ])
+    assert extract_body(payload) == 'First\xa0paragraph\n\nSecond one'
+
+
+def test_html_to_text_keeps_paragraph_breaks():
+    assert html_to_text('<p>One</p>\n\n\n<p>Two<br>Three</p>') == 'One\n\nTwo\nThree'
+
+
+def test_attachments_are_never_taken_as_the_body():
+    payload = part('multipart/mixed', parts=[
+        part('text/plain', 'forwarded notes', filename='notes.txt'),
+        part('text/plain', 'inline notes', disposition='attachment; filename="other.txt"'),
+        part('text/html', '<p>The real question</p>'),
+    ])
+    assert extract_body(payload) == 'The real question'
+    assert [attachment['filename'] for attachment in iter_attachments(payload)] == ['notes.txt', '']
+
+
+def test_attachment_descriptors_carry_ids_and_inline_data():
+    stored = part('application/pdf', filename='transcript.pdf')
+    stored['body'] = {'attachmentId': 'A1', 'size': 52000}
+    inline = part('image/png', 'png', filename='logo.png')
+    payload = part('multipart/mixed', parts=[part('text/plain', 'See attached'), stored, inline])
+    assert list(iter_attachments(payload)) == [
+        {'filename': 'transcript.pdf', 'mime_type': 'application/pdf', 'size': 52000, 'attachment_id': 'A1'},
+        {'filename': 'logo.png', 'mime_type': 'image/png', 'size': 3, 'attachment_id': None,
+         'data': inline['body']['data']},
+    ]
+
+
+def test_body_is_cut_at_max_chars():
+    assert extract_body(part('text/plain', 'é' * 5000), max_chars=10) == 'é' * 10
+    # HTML is cut before its markup is stripped, so the text comes out a little shorter
+    html = part('text/html', '<p>' + 'word ' * 1000 + '</p>')
+    body = extract_body(html, max_chars=50)
+    assert body.startswith('word word') and len(body) <= 50
+
+
+def test_single_part_message_without_a_text_type():
+    payload = {'mimeType': 'application/octet-stream', 'headers': [], 'body': {
+        'data': base64.urlsafe_b64encode(b'plain words').decode()}}
+    assert extract_body(payload) == 'plain words'
+    assert extract_body({'mimeType': 'multipart/mixed', 'headers': [], 'parts': []}) == ''
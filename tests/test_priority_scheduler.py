@@ -0,0 +1,70 @@
+import threading
+from priority_scheduler import PriorityScheduler, PriorityQueue
+
+DONE = object()
+HOUR = 3600
+
+
+def make_scheduler():
+    return PriorityScheduler(label_targets=[('Transfers', HOUR), ('Beginner', 24 * HOUR)],
+                             default_target=48 * HOUR, senders=['dean@example.edu'], sender_target=60)
+
+
+def email(email_id, labels, received, sender='student@example.com'):
+    return {'id': email_id, 'labels': labels, 'internal_date': str(int(received * 1000)), 'sender': sender}
+
+
+def test_earliest_deadline_comes_first():
+    scheduler = make_scheduler()
+    now = 1000000
+    emails = [
+        email('new-beginner', ['Beginner'], now),
+        email('new-transfer', ['Transfers'], now),
+        # Received a day ago, so it is due now, ahead of a transfer that just arrived
+        email('old-beginner', ['Beginner'], now - 24 * HOUR),
+        email('dean', [], now, sender='Dean <dean@example.edu>'),
+        email('unlabelled', [], now),
+    ]
+    assert [item['id'] for item in scheduler.sort(emails)] == [
+        'old-beginner', 'dean', 'new-transfer', 'new-beginner', 'unlabelled']
+
+
+def test_responses_are_ordered_by_their_original_email():
+    scheduler = make_scheduler()
+    response = {'email_id': 'm1', 'original_email': email('m1', ['Transfers'], 1000000)}
+    assert scheduler.key(response) == scheduler.key(email('m1', ['Transfers'], 1000000))
+
+
+def test_stop_markers_come_after_all_work():
+    queue = PriorityQueue(make_scheduler())
+    queue.put(email('beginner', ['Beginner'], 1000000))
+    queue.put_last(DONE)
+    # Work queued after a stop marker still comes out before it
+    queue.put(email('transfer', ['Transfers'], 1000000))
+    queue.put(email('older-transfer', ['Transfers'], 999000))
+    queue.put_last(DONE)
+    items = [queue.get() for _ in range(5)]
+    assert [item['id'] for item in items[:3]] == ['older-transfer', 'transfer', 'beginner']
+    assert items[3:] == [DONE, DONE]
+    assert queue.empty()
+
+
+def test_equal_keys_keep_their_order():
+    queue = PriorityQueue(make_scheduler())
+    for index in range(5):
+        queue.put({'id': index}, key=(0, 0))
+    assert [queue.get()['id'] for _ in range(5)] == [0, 1, 2, 3, 4]
+
+
+def test_full_queue_blocks_until_an_item_is_taken():
+    queue = PriorityQueue(make_scheduler(), maxsize=1)
+    queue.put({'id': 'first'}, key=(0, 0))
+    second = threading.Thread(target=queue.put, args=({'id': 'second'},), kwargs={'key': (1, 0)})
+    second.start()
+    second.join(0.1)
+    assert second.is_alive() and queue.qsize() == 1
+
+    assert queue.get()['id'] == 'first'
+    second.join(1)
+    assert not second.is_alive()
+    assert queue.get()['id'] == 'second'
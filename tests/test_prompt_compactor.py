@@ -0,0 +1,24 @@
+from prompt_compactor import PromptCompactor, strip_signature
+
+
+def test_opening_thanks_keeps_the_question():
+    body = "Hi,\nThanks for the quick reply.\nCan I still transfer my credits after the deadline?"
+    assert 'transfer my credits' in strip_signature(body)
+
+
+def test_trailing_sign_off_and_name_are_dropped():
+    body = "Hello,\nCan I transfer 30 credits?\n\nBest regards,\nJane Doe\nStudent 12345"
+    assert strip_signature(body) == "Hello,\nCan I transfer 30 credits?\n"
+
+
+def test_signature_delimiter_drops_everything_after_it():
+    body = "Can I transfer 30 credits?\n--\nJane Doe\nOffice of Something, 1 Main Street"
+    assert strip_signature(body) == "Can I transfer 30 credits?"
+
+
+def test_compact_keeps_question_of_short_email():
+    compactor = PromptCompactor(budget=100)
+    email = {'id': '1', 'subject': 'Transfer', 'body': "Hi,\nThanks for the help!\nWhat documents do I need?"}
+    compacted = compactor.compact(email)
+    assert 'What documents do I need?' in compacted['body']
+    assert email['body'].startswith('Hi,')
@@ -0,0 +1,118 @@
+import pytest
+import rate_limiter
+from rate_limiter import CallScheduler, TokenBucket, is_retryable, retry_after_of
+
+
+class FakeError(Exception):
+    def __init__(self, status, content=b'', retry_after=None):
+        super().__init__(f"HTTP {status}")
+        # Like an httplib2 response: a dict of lower-cased headers with a status
+        self.resp = type('Response', (dict,), {'status': status})()
+        if retry_after is not None:
+            self.resp['retry-after'] = retry_after
+        self.content = content
+
+
+class FlakyRequest:
+    """Fails with each of `errors` in turn, then succeeds."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace the clock and sleep with a fake that records sleeps and advances time by them."""
+    class Clock:
+        def __init__(self):
+            self.now = 1000.0
+            self.sleeps = []
+
+        def sleep(self, seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+    fake = Clock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', lambda: fake.now)
+    monkeypatch.setattr(rate_limiter.time, 'sleep', fake.sleep)
+    return fake
+
+
+def test_rate_limits_and_server_errors_are_retried(clock):
+    scheduler = CallScheduler(gmail_units_per_second=1000, max_retries=3)
+    request = FlakyRequest(FakeError(429), FakeError(503), FakeError(500))
+    assert scheduler.execute(request) == 'ok'
+    assert request.calls == 4
+    assert scheduler.retries == 3
+
+
+def test_retries_stop_at_the_limit(clock):
+    scheduler = CallScheduler(gmail_units_per_second=1000, max_retries=2)
+    request = FlakyRequest(*[FakeError(502)] * 5)
+    with pytest.raises(FakeError):
+        scheduler.execute(request)
+    assert request.calls == 3
+
+
+@pytest.mark.parametrize('error', [FakeError(400), FakeError(403), FakeError(404)])
+def test_client_errors_are_not_retried(clock, error):
+    scheduler = CallScheduler(gmail_units_per_second=1000, max_retries=3)
+    request = FlakyRequest(error)
+    with pytest.raises(FakeError):
+        scheduler.execute(request)
+    assert request.calls == 1 and scheduler.retries == 0
+
+
+def test_retryable_errors():
+    assert all(is_retryable(FakeError(status)) for status in (429, 500, 502, 503, 504))
+    assert not any(is_retryable(FakeError(status)) for status in (400, 401, 403, 404, 409))
+    # Gmail's per-user rate limit comes as a 403
+    assert is_retryable(FakeError(403, content=b'{"reason": "rateLimitExceeded"}'))
+    assert not is_retryable(ValueError('not an API error'))
+
+
+def test_retry_after_is_read_from_either_kind_of_response():
+    assert retry_after_of(FakeError(429, retry_after='7')) == 7.0
+    openai_error = Exception('rate limited')
+    openai_error.response = type('Response', (), {'headers': {'retry-after': '2.5'}})()
+    assert retry_after_of(openai_error) == 2.5
+    assert retry_after_of(FakeError(429)) is None
+    assert retry_after_of(FakeError(429, retry_after='Wed, 21 Oct 2026 07:28:00 GMT')) is None
+
+
+def test_backoff_honours_retry_after(clock):
+    scheduler = CallScheduler()
+    scheduler.backoff(4, FakeError(429, retry_after='7'))
+    assert clock.sleeps == [7.0]
+    assert scheduler.backoff_waited == 7.0
+
+
+def test_backoff_without_retry_after_stays_under_the_exponential_cap(clock):
+    scheduler = CallScheduler()
+    for attempt in range(3):
+        scheduler.backoff(attempt, FakeError(503))
+    assert all(0 <= delay <= rate_limiter.RETRY_BASE_DELAY * 2 ** attempt
+               for attempt, delay in enumerate(clock.sleeps))
+
+
+def test_token_bucket_waits_off_a_deficit_and_refills(clock):
+    bucket = TokenBucket(rate=10, capacity=10)
+    assert bucket.acquire(10) == 0
+    # Five tokens short at ten a second
+    assert bucket.acquire(5) == pytest.approx(0.5)
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    clock.now += 1
+    assert bucket.acquire(10) == 0
+
+    # Refilling stops at capacity however long the bucket sat idle
+    clock.now += 100
+    assert bucket.acquire(11) == pytest.approx(0.1)
+    assert bucket.waits == 2 and bucket.acquired == 36
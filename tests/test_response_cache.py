@@ -0,0 +1,34 @@
+from response_cache import ResponseCache, normalize_email_text
+
+
+def make_email(body, subject='Transfer credits'):
+    return {'id': '1', 'subject': subject, 'body': body, 'labels': ['L1']}
+
+
+def test_opening_thanks_keeps_the_question():
+    first = normalize_email_text('Transfer credits', "Hi,\nThanks for the quick reply\n"
+                                 "Can I transfer 30 credits from community college?")
+    second = normalize_email_text('Transfer credits', "Hi,\nThanks for the quick reply\n"
+                                  "What is the deadline for the fall application?")
+    assert 'community college' in first
+    assert first != second
+
+
+def test_different_bodies_give_different_keys():
+    cache = ResponseCache(cache_path='')
+    first = cache.make_key(make_email("Thank you, one more thing.\nCan I transfer credits from abroad?"))
+    second = cache.make_key(make_email("Thank you, one more thing.\nWhen does the spring term start?"))
+    assert first and second
+    assert first != second
+
+
+def test_trailing_sign_off_is_dropped():
+    signed = normalize_email_text('Transfer credits', "Hello,\nCan I transfer 30 credits?\n\n"
+                                  "Thanks,\nJane Doe\nID 12345")
+    unsigned = normalize_email_text('Transfer credits', "Hello,\nCan I transfer 30 credits?")
+    assert signed == unsigned
+
+
+def test_sign_off_followed_by_a_question_is_kept():
+    text = normalize_email_text('Form', "Hello,\nI filled in the form.\nThanks,\nwhere do I send it?")
+    assert 'where do i send it' in text
@@ -0,0 +1,95 @@
+import json
+import pytest
+from ai_generator import AIGenerator
+from llm_backends import FakeBackend
+from rules_classifier import Rule, RulesClassifier
+
+RULES = [
+    {'name': 'unsubscribe', 'match': {'subject': ['unsubscribe', 'remove me']}, 'label': 'Unsubscribe'},
+    {'name': 'transcript', 'match': {'subject': 'transcript', 'body': ['official transcript']},
+     'label': 'Transcripts', 'reply': 'Hi {name}, official transcripts are ordered from the registrar.'},
+    {'name': 'out-of-office', 'match': {'sender': r'^(noreply|no-reply)@'}, 'regex': True,
+     'reply': 'Automatic reply to {sender} about "{subject}"'},
+]
+
+
+def email(email_id='m1', sender='student@example.com', subject='', body='', **fields):
+    return dict({'id': email_id, 'thread_id': f't-{email_id}', 'sender': sender, 'subject': subject,
+                 'body': body}, **fields)
+
+
+def make_classifier():
+    return RulesClassifier([Rule(spec) for spec in RULES])
+
+
+def test_every_field_of_a_rule_has_to_match():
+    classifier = make_classifier()
+    assert classifier.classify(email(subject='Transcript request', body='I need an official transcript'))[0].name \
+        == 'transcript'
+    # The subject matches but the body does not
+    assert classifier.classify(email(subject='Transcript request', body='Can you check my grades?')) is None
+
+
+def test_first_matching_rule_wins():
+    classifier = make_classifier()
+    rule, _ = classifier.classify(email(sender='noreply@example.com', subject='Please unsubscribe me'))
+    assert rule.name == 'unsubscribe'
+
+
+def test_keywords_match_whole_words_across_any_spacing():
+    classifier = make_classifier()
+    assert classifier.classify(email(subject='Please REMOVE\n   me from this list'))
+    assert classifier.classify(email(subject='Unsubscribed last week, still getting mail')) is None
+    assert classifier.classify(email(subject='remove meeting')) is None
+
+
+def test_regex_rules_are_not_escaped():
+    classifier = make_classifier()
+    assert classifier.classify(email(sender='no-reply@example.com'))[0].name == 'out-of-office'
+    assert classifier.classify(email(sender='student.noreply@example.com')) is None
+
+
+def test_label_only_and_template_responses():
+    classifier = make_classifier()
+    assert classifier.classify(email(subject='unsubscribe'))[1] == '$Unsubscribe$'
+    # Fields the email does not have are left blank
+    assert classifier.classify(email(subject='transcript', body='official transcript'))[1] == \
+        '$Transcripts$Hi , official transcripts are ordered from the registrar.'
+    assert classifier.classify(email(sender='noreply@example.com', subject='Away'))[1] == \
+        'Automatic reply to noreply@example.com about "Away"'
+
+
+@pytest.mark.parametrize('spec', [
+    {'name': 'no-action', 'match': {'subject': 'x'}},
+    {'name': 'no-match', 'label': 'L'},
+    {'name': 'bad-field', 'match': {'cc': 'x'}, 'label': 'L'},
+])
+def test_invalid_rules_are_rejected(spec):
+    with pytest.raises(ValueError):
+        Rule(spec)
+
+
+def test_rules_file_is_optional(tmp_path):
+    assert RulesClassifier.from_file(str(tmp_path / 'missing.json')) is None
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'rules': RULES}))
+    assert [rule.name for rule in RulesClassifier.from_file(str(path)).rules] == [
+        'unsubscribe', 'transcript', 'out-of-office']
+
+
+def test_hits_are_counted_per_rule():
+    classifier = make_classifier()
+    for subject in ['unsubscribe', 'remove me', 'When is the deadline?']:
+        classifier.classify(email(subject=subject))
+    classifier.classify(email(sender='noreply@example.com'))
+    assert classifier.stats() == {'evaluated': 4, 'hits': {'unsubscribe': 2, 'out-of-office': 1}}
+
+
+def test_only_unmatched_emails_reach_the_model(workdir):
+    backend = FakeBackend('The deadline is March 1.')
+    generator = AIGenerator(max_concurrency=1, backend=backend, cache=False, compactor=False,
+                            rules=make_classifier())
+    assert generator.generate_response(email('m1', subject='unsubscribe')) == '$Unsubscribe$'
+    assert backend.calls == []
+    assert generator.generate_response(email('m2', subject='Transfer deadline')) == 'The deadline is March 1.'
+    assert len(backend.calls) == 1
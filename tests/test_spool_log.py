@@ -0,0 +1,80 @@
+import os
+import mmap
+import threading
+import spool_log
+from spool_log import SegmentedSpool, compact_pipeline_spools, iter_segment, read_record
+from state_store import StateStore
+
+
+def test_records_read_back_from_their_reference(tmp_path):
+    spool = SegmentedSpool(str(tmp_path), 'emails')
+    refs = [spool.append({'id': f'm{i}', 'body': f'Grüße {i}'}) for i in range(3)]
+    assert [read_record(ref)['body'] for ref in refs] == ['Grüße 0', 'Grüße 1', 'Grüße 2']
+
+
+def test_full_segment_rolls_over(tmp_path):
+    spool = SegmentedSpool(str(tmp_path), 'emails', segment_max_bytes=64)
+    refs = [spool.append({'id': f'm{i}', 'body': 'x' * 40}) for i in range(4)]
+    assert len(spool.segments()) == 4
+    assert [read_record(ref)['id'] for ref in refs] == ['m0', 'm1', 'm2', 'm3']
+
+
+def test_half_written_record_is_dropped_on_reopen(tmp_path):
+    spool = SegmentedSpool(str(tmp_path), 'emails')
+    ref = spool.append({'id': 'm1'})
+    spool.file.write(b'{"id": "m2", "bo')
+    spool.file.close()
+
+    spool = SegmentedSpool(str(tmp_path), 'emails')
+    assert [record['id'] for _, _, record in iter_segment(spool.active_path)] == ['m1']
+    next_ref = spool.append({'id': 'm3'})
+    assert read_record(ref)['id'] == 'm1'
+    assert read_record(next_ref)['id'] == 'm3'
+
+
+class ForgettingMap:
+    """Wraps a segment map so another thread forgets the segment, closing the map, just before a slice."""
+
+    def __init__(self, mapped, path):
+        self.mapped = mapped
+        self.path = path
+
+    def __len__(self):
+        return len(self.mapped)
+
+    def __getitem__(self, index):
+        forget = threading.Thread(target=spool_log._forget_segment, args=(self.path,))
+        forget.start()
+        forget.join(0.2)
+        return self.mapped[index]
+
+    def close(self):
+        self.mapped.close()
+
+
+def test_record_is_read_before_its_map_can_be_closed(tmp_path, monkeypatch):
+    spool = SegmentedSpool(str(tmp_path), 'emails')
+    ref = spool.append({'id': 'm1'})
+    real_mmap = mmap.mmap
+    monkeypatch.setattr(mmap, 'mmap', lambda *args, **kwargs: ForgettingMap(real_mmap(*args, **kwargs),
+                                                                            spool.active_path))
+    assert read_record(ref)['id'] == 'm1'
+
+
+def test_compaction_drops_sent_emails_and_moves_the_rest(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    emails_dir, responses_dir = str(tmp_path / 'emails'), str(tmp_path / 'responses')
+    spool = SegmentedSpool.for_directory(emails_dir, 'emails')
+    SegmentedSpool.for_directory(responses_dir, 'responses', key='email_id')
+    for email_id in ('sent', 'pending'):
+        state.mark_fetched(email_id, 't1', spool.append({'id': email_id, 'body': 'question'}))
+    state.mark_sent('sent')
+    old_segment = spool.active_path
+    # Only sealed segments are compacted
+    spool._open_segment(2)
+
+    compact_pipeline_spools(emails_dir, responses_dir, state=state, dead_ratio=0.5)
+    assert not os.path.exists(old_segment)
+    moved = state.get('pending')['email_path']
+    assert moved.startswith(spool.active_path)
+    assert read_record(moved)['id'] == 'pending'
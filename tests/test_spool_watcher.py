@@ -0,0 +1,34 @@
+from spool_watcher import WatchedPipeline, _DONE
+
+
+class FakeGenerator:
+    emails_received_dir = 'Emails_Received'
+    emails_to_send_dir = 'Emails_To_Send'
+
+    def generate(self, email_content):
+        return {'email_id': email_content['id']}
+
+
+class FakeSender:
+    service_factory = None
+
+
+class FakeWatcher:
+    def add(self, directory, name, on_records):
+        pass
+
+
+def test_coalesced_emails_are_released_when_generated(workdir):
+    pipeline = WatchedPipeline(FakeGenerator(), FakeSender(), 1, 1, FakeWatcher())
+    pipeline._readiness = lambda kind, ref, record: 'ready'
+    records = [(f'emails-000001.jsonl#{i}:1', {'id': f'm{i}', 'thread_id': 't1', 'internal_date': str(1000000 + i),
+                                               'labels': [], 'sender': 'a@example.com', 'subject': 'Hi',
+                                               'body': 'question'})
+               for i in range(3)]
+    pipeline._dispatch('email', records, 0)
+    assert pipeline.generate_queue.qsize() == 1
+
+    pipeline.generate_queue.put_last(_DONE)
+    pipeline._generate_worker()
+    assert pipeline.queued == set()
+    assert pipeline.counts['generated'] == 1
@@ -0,0 +1,59 @@
+from state_store import StateStore, FETCHED, GENERATED, SENT, FAILED, COALESCED, IN_FLIGHT_STATES
+
+
+def test_email_moves_through_the_pipeline(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    state.mark_fetched('m1', 't1', 'emails-000001.jsonl#0:10')
+    assert state.has('m1') and state.get_state('m1') == FETCHED
+
+    state.mark_generated('m1', 'responses-000001.jsonl#0:20')
+    assert state.get_state('m1') == GENERATED
+    assert [row['id'] for row in state.in_state(GENERATED)] == ['m1']
+
+    # Marking an email sent keeps the response reference unless a new one is given
+    state.mark_sent('m1')
+    row = state.get('m1')
+    assert row['state'] == SENT
+    assert row['email_path'] == 'emails-000001.jsonl#0:10'
+    assert row['response_path'] == 'responses-000001.jsonl#0:20'
+    assert state.counts() == {SENT: 1}
+
+
+def test_refetching_a_failed_email_clears_its_error(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    state.mark_fetched('m1', 't1', 'emails-000001.jsonl#0:10')
+    state.mark_failed('m1', 'model timed out')
+    assert state.get('m1')['error'] == 'model timed out'
+    state.mark_fetched('m1', 't1', 'emails-000002.jsonl#0:10')
+    row = state.get('m1')
+    assert (row['state'], row['error'], row['email_path']) == (FETCHED, None, 'emails-000002.jsonl#0:10')
+
+
+def test_coalesced_emails_stay_in_flight(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    state.mark_fetched('m1', 't1', 'emails-000001.jsonl#0:10')
+    state.mark_coalesced('m1')
+    assert state.get_state('m1') == COALESCED
+    assert COALESCED in IN_FLIGHT_STATES and FAILED not in IN_FLIGHT_STATES
+
+
+def test_relocate_only_moves_the_given_reference(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    state.mark_fetched('m1', 't1', 'emails-000001.jsonl#0:10')
+    state.mark_generated('m1', 'responses-000001.jsonl#0:20')
+    state.relocate('m1', email_path='emails-000003.jsonl#0:10')
+    row = state.get('m1')
+    assert (row['email_path'], row['response_path']) == ('emails-000003.jsonl#0:10', 'responses-000001.jsonl#0:20')
+
+
+def test_resumed_send_keeps_the_first_message_id(tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'))
+    attempt, resumed = state.begin_send('m1', '<first@automail.local>')
+    assert not resumed and attempt['gmail_message_id'] is None
+
+    attempt, resumed = state.begin_send('m1', '<second@automail.local>')
+    assert resumed and attempt['rfc_message_id'] == '<first@automail.local>'
+
+    state.complete_send('m1', 'g1')
+    attempt, resumed = state.begin_send('m1', '<third@automail.local>')
+    assert resumed and attempt['gmail_message_id'] == 'g1'
@@ -0,0 +1,61 @@
+import os
+from email.utils import parsedate_to_datetime
+
+COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', '1') == '1'
+# Messages in one thread less than this many seconds apart are answered together
+COALESCE_WINDOW = int(os.getenv('COALESCE_WINDOW', '900'))
+
+
+def email_timestamp(email_content):
+    """Return when an email was received, in seconds since the epoch (0 if unknown)."""
+    if email_content.get('internal_date'):
+        return int(email_content['internal_date']) / 1000
+    try:
+        return parsedate_to_datetime(email_content.get('date', '')).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return 0
+
+
+def join_bodies(messages):
+    """Join the dated bodies of merged messages into one body."""
+    return '\n\n'.join(f"[{message['date'] or 'Earlier message'}]\n{message['body']}" for message in messages)
+
+
+def merge_emails(emails):
+    """Merge emails from one thread, oldest first, into one email answered as the latest."""
+    latest = emails[-1]
+    messages = [{'date': email.get('date', ''), 'body': email['body']} for email in emails]
+    # The separate bodies let prompt compaction strip each message's quoted history
+    merged = dict(latest, body=join_bodies(messages), messages=messages)
+    merged['coalesced'] = [{'id': email['id'], 'labels': email.get('labels', [])} for email in emails[:-1]]
+    return merged
+
+
+def coalesce_emails(emails, window=None):
+    """Group emails per thread into bursts no more than `window` seconds apart and merge each burst.
+
+    Order follows the first email of each burst.
+    """
+    window = COALESCE_WINDOW if window is None else window
+    threads = {}
+    for email in emails:
+        threads.setdefault(email.get('thread_id') or email['id'], []).append(email)
+
+    bursts = []
+    for thread_emails in threads.values():
+        thread_emails.sort(key=email_timestamp)
+        burst = [thread_emails[0]]
+        for email in thread_emails[1:]:
+            if email_timestamp(email) - email_timestamp(burst[-1]) <= window:
+                burst.append(email)
+            else:
+                bursts.append(burst)
+                burst = [email]
+        bursts.append(burst)
+
+    position = {email['id']: index for index, email in enumerate(emails)}
+    bursts.sort(key=lambda burst: min(position[email['id']] for email in burst))
+    merged = [merge_emails(burst) if len(burst) > 1 else burst[0] for burst in bursts]
+    if len(merged) < len(emails):
+        print(f"Coalesced {len(emails)} emails into {len(merged)} generations")
+    return merged